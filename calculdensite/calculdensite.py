@@ -1,12 +1,27 @@
 import geopandas as gpd
+import pandas as pd
+import numpy as np
+import shapely
+import hashlib
+import json
 import os
+import re
+import sys
 import time
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.datametrics import METRICS
+
 class DataLoading():
     def __init__(self, geojson_source):
         self.geojson_source = geojson_source
 
     def loading_from_geojson(self):
+        # Sortie de datageocoding dans le magasin intermédiaire, sinon fichier GeoJSON
+        store = DataStore()
+        if store.exists('geocoding'):
+            return store.read('geocoding')
         if os.path.exists(self.geojson_source):
             geojson = gpd.read_file(self.geojson_source)
             return geojson
@@ -14,17 +29,65 @@ class DataLoading():
             return f"File from {self.geojson_source} doesn't exist"
 
 class DataProcessing():
-    def __init__(self, geojson):
+    # Projection équivalente (LAEA Europe) : les surfaces ne sont pas déformées
+    AREA_CRS = 'EPSG:3035'
+
+    def __init__(self, geojson, cache_source='./cache/area.csv'):
         self.geojson = geojson
-    
+        self.cache_source = cache_source
+
+    def calculate_area(self):
+        """
+        Surface of every commune in km², computed once per geometry.
+
+        Surfaces are cached by geometry hash in a sidecar CSV file, so only new
+        or modified geometries are reprojected. The cache only keeps the
+        geometries of the current input.
+
+        Returns:
+        - ndarray: Surface of every commune in km², NaN for the communes without geometry.
+        """
+        # Géométries absentes : pas de hash ni de surface
+        located = self.geojson.geometry.notna().to_numpy()
+        geometry_hash = pd.Series(None, index=self.geojson.index, dtype=object)
+        geometry_hash[located] = [hashlib.sha1(wkb).hexdigest() for wkb in shapely.to_wkb(self.geojson.geometry.values[located])]
+
+        if os.path.isfile(self.cache_source):
+            cache = pd.read_csv(self.cache_source, index_col='geometry_hash')['SURFACE_KM2']
+        else:
+            cache = pd.Series(dtype=np.float64, name='SURFACE_KM2')
+
+        area = geometry_hash.map(cache).astype(np.float64)
+        missing = area.isna() & located
+        METRICS.count('cache_hits', (located & ~missing).sum())
+        METRICS.count('cache_misses', missing.sum())
+
+        if missing.any():
+            area[missing] = self.geojson.loc[missing, 'geometry'].to_crs(self.AREA_CRS).area.to_numpy() / 1e6
+
+        # Hashes des géométries disparues retirés du cache
+        new_cache = pd.Series(area[located].to_numpy(), index=geometry_hash[located].to_numpy())
+        new_cache = new_cache[~new_cache.index.duplicated()]
+        if missing.any() or not cache.index.sort_values().equals(new_cache.index.sort_values()):
+            os.makedirs(os.path.dirname(self.cache_source) or '.', exist_ok=True)
+            new_cache.rename_axis('geometry_hash').rename('SURFACE_KM2').to_csv(self.cache_source)
+
+        return area.to_numpy(dtype=np.float64)
+
     def calculate_density(self):
-        # Project the geometry to a suitable projected CRS (e.g., EPSG:3857)
-        self.geojson = self.geojson.to_crs(epsg=3857)
+        """
+        Density per km² of every 'CHAT_<year>' and 'CHIEN_<year>' column.
+
+        Returns:
+        - GeoDataFrame: Communes with the 'SURFACE_KM2' and '<column>_DENSITE' columns added.
+        """
+        colonnes = [colonne for colonne in self.geojson.columns if re.match(r"^(CHAT|CHIEN)_\d{4}$", colonne)]
 
-        colonnes = ['CHAT_2017', 'CHAT_2018', 'CHAT_2019', 'CHAT_2020', 'CHIEN_2017', 'CHIEN_2018', 'CHIEN_2019', 'CHIEN_2020']
+        area = self.calculate_area()
+        density = self.geojson[colonnes].to_numpy(dtype=np.float64, na_value=np.nan) / area[:, None]
 
-        for colonne in colonnes:
-            self.geojson[f'{colonne}_DENSITE'] = self.geojson[colonne] / self.geojson['geometry'].area * 1e6
+        self.geojson['SURFACE_KM2'] = area
+        self.geojson[[f'{colonne}_DENSITE' for colonne in colonnes]] = density
 
         return self.geojson
 
@@ -33,40 +96,139 @@ class DataExporting():
     def __init__(self, final_data):
         self.final_data = final_data
 
-    def export_geojson(self, output_path):
+    def prepare(self, precision=None, tolerance=None):
+        """
+        Reproject the data to EPSG:4326, then simplify and round its geometries.
+
+        Simplification keeps the shared borders of the communes when the GEOS
+        coverage simplification is available (shapely >= 2.1), otherwise each
+        geometry is simplified on its own while staying valid.
+
+        Parameters:
+        - precision (int): Number of decimals kept for the coordinates, all if None.
+        - tolerance (float): Simplification tolerance in degrees, none if None.
+
+        Returns:
+        - GeoDataFrame: Data ready to be written.
+        """
+        final_data_export = self.final_data.to_crs(epsg=4326)
+        geometry = final_data_export.geometry.values
+
+        if tolerance:
+            if hasattr(shapely, 'coverage_simplify'):
+                geometry = shapely.coverage_simplify(geometry, tolerance)
+            else:
+                geometry = shapely.simplify(geometry, tolerance, preserve_topology=True)
+
+        if precision is not None:
+            geometry = shapely.transform(geometry, lambda coords: np.round(coords, precision))
+
+        return final_data_export.set_geometry(gpd.GeoSeries(geometry, index=final_data_export.index, crs='EPSG:4326'))
+
+    def export_geojson(self, output_path, precision=None, tolerance=None):
+        """
+        Write the data to a GeoJSON file, one feature at a time.
+
+        Parameters:
+        - output_path (str): Path to the GeoJSON file.
+        - precision (int): Number of decimals kept for the coordinates, all if None.
+        - tolerance (float): Simplification tolerance in degrees, none if None.
+        """
+        if not os.path.exists('./result/'):
+            os.mkdir('./result/')
+
+        final_data_export = self.prepare(precision, tolerance)
+        properties = final_data_export.drop(columns=final_data_export.geometry.name)
+        properties = properties.astype(object).where(properties.notna(), None)
+        columns = list(properties.columns)
+
+        def default(value):
+            return value.item() if isinstance(value, np.generic) else str(value)
+
+        with open(output_path, 'w', encoding='utf-8') as file:
+            file.write('{"type":"FeatureCollection","features":[\n')
+            for i, (geometry, values) in enumerate(zip(final_data_export.geometry.values, properties.itertuples(index=False, name=None))):
+                feature = {
+                    'type': 'Feature',
+                    'properties': dict(zip(columns, values)),
+                    'geometry': shapely.geometry.mapping(geometry) if geometry is not None else None,
+                }
+                file.write((',\n' if i else '') + json.dumps(feature, ensure_ascii=False, separators=(',', ':'), default=default))
+            file.write('\n]}\n')
+
+    def export_flatgeobuf(self, output_path, precision=None, tolerance=None):
+        """
+        Write the data to a FlatGeobuf file with its packed spatial index.
+
+        Parameters:
+        - output_path (str): Path to the FlatGeobuf file.
+        - precision (int): Number of decimals kept for the coordinates, all if None.
+        - tolerance (float): Simplification tolerance in degrees, none if None.
+        """
         if not os.path.exists('./result/'):
             os.mkdir('./result/')
 
-        final_data_export = self.final_data.copy()
-        final_data_export['geometry'] = final_data_export['geometry'].to_crs(epsg=4326)
-        for col in final_data_export.columns:
-            if final_data_export[col].dtype == 'O' and isinstance(final_data_export[col].iloc[0], list):
-                final_data_export[col] = final_data_export[col].astype(str)
-        final_data_export.to_file(output_path, driver='GeoJSON')
+        final_data_export = self.prepare(precision, tolerance)
+        # FlatGeobuf n'a pas de type liste : toute valeur liste ou tableau de la colonne est écrite en texte
+        for col in final_data_export.columns[final_data_export.dtypes == object]:
+            sequences = final_data_export[col].map(lambda value: isinstance(value, (list, tuple, np.ndarray)))
+            if sequences.any():
+                final_data_export.loc[sequences, col] = final_data_export.loc[sequences, col].map(lambda value: str(list(np.asarray(value).tolist())))
+        # Effectifs en entiers nullables, inconnus du pilote : entiers NumPy, ou flottants s'il manque des valeurs
+        for col in final_data_export.columns[[isinstance(dtype, pd.api.extensions.ExtensionDtype) and pd.api.types.is_integer_dtype(dtype)
+                                              for dtype in final_data_export.dtypes]]:
+            values = final_data_export[col]
+            final_data_export[col] = values.astype(np.float64 if values.isna().any() else values.dtype.numpy_dtype)
+        final_data_export.to_file(output_path, driver='FlatGeobuf', SPATIAL_INDEX='YES')
+
+    def export_levels(self, output_path, precision=None, tolerances=(), driver='GeoJSON'):
+        """
+        Write the full-resolution file and one simplified file per tolerance.
+
+        The simplified files are named after the output path with the tolerance
+        as suffix, e.g. "final_data_0.001.geojson".
+
+        Parameters:
+        - output_path (str): Path to the full-resolution file.
+        - precision (int): Number of decimals kept for the coordinates, all if None.
+        - tolerances (iterable of float): Simplification tolerances in degrees.
+        - driver (str): 'GeoJSON' or 'FlatGeobuf'.
+        """
+        export = self.export_flatgeobuf if driver == 'FlatGeobuf' else self.export_geojson
+        root, ext = os.path.splitext(output_path)
+
+        export(output_path, precision)
+        for tolerance in tolerances:
+            export(f'{root}_{tolerance:g}{ext}', precision, tolerance)
         
 class DataPipeline(DataLoading, DataProcessing, DataExporting):
     def __init__(self, data_source):
         super().__init__(data_source)
 
-    def run_process(self, data, output_path):
-        print(f"=========== CALCULATE DENSITY ===========")
-        final_data = DataProcessing(data).calculate_density()        
-        
-        print(f"=========== EXPORT DATA ===========")
-        DataExporting(final_data).export_geojson(output_path)
+    def run_process(self, data, output_path, precision=None, tolerances=(), driver='GeoJSON'):
+        with METRICS.stage('density') as metrics:
+            metrics.rows_in = len(data)
+            print(f"=========== CALCULATE DENSITY ===========")
+            final_data = DataProcessing(data).calculate_density()        
+            
+            print(f"=========== EXPORT DATA ===========")
+            DataStore().write(final_data, 'density')
+            DataExporting(final_data).export_levels(output_path, precision, tolerances, driver)
+            metrics.rows_out = len(final_data)
 
-    def pipeline_running(self, data_source, output_path):
+    def pipeline_running(self, data_source, output_path, precision=None, tolerances=(), driver='GeoJSON'):
         data_load = DataLoading(data_source)
         data = data_load.loading_from_geojson()
         
         start = time.time()
-        self.run_process(data, output_path)
+        self.run_process(data, output_path, precision, tolerances, driver)
         end = time.time()
         print('{:.4f} s'.format(end - start))
+        METRICS.export('calculdensite')
 
 if __name__ == "__main__":
     data_source = "./data/data_join.geojson"
     output_path = "./result/final_data.geojson"
 
     pipeline = DataPipeline(data_source)
-    pipeline.pipeline_running(data_source, output_path)
+    pipeline.pipeline_running(data_source, output_path, precision=5, tolerances=(0.001, 0.005))
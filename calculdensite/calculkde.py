@@ -0,0 +1,289 @@
+import pandas as pd
+import numpy as np
+import pyproj
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.dataschema import ENCODING, read_dtypes, pad_codes, apply_schema
+from datacommon.datametrics import METRICS
+
+try:
+    import rasterio
+    from rasterio.transform import from_origin
+except ImportError:
+    rasterio = None
+
+# Lambert-93, projection métrique de la France métropolitaine
+GRID_CRS = 'EPSG:2154'
+# Emprise de la France métropolitaine et de la Corse en Lambert-93 (xmin, ymin, xmax, ymax), en mètres
+FRANCE_EXTENT = (99000.0, 6040000.0, 1245000.0, 7115000.0)
+SPECIES = ['CHAT', 'CHIEN']
+
+def fast_size(size):
+    """
+    Smallest product of 2, 3 and 5 not below size, the FFT is much faster on such lengths.
+
+    Parameters:
+    - size (int): Minimum length.
+
+    Returns:
+    - int: Length of the transform.
+    """
+    best = 2 ** int(np.ceil(np.log2(size)))
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            candidate = power35 * 2 ** max(int(np.ceil(np.log2(size / power35))), 0)
+            best = min(best, candidate)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+class DataLoading():
+    def __init__(self, data_source):
+        self.data_source = data_source
+
+    def loading_year(self, year):
+        """
+        Geocoded communes of a year, from the "grouping" stage of the store or from "<year>-geocode.csv".
+
+        Parameters:
+        - year (int): Year of the data.
+
+        Returns:
+        - DataFrame: Communes with 'LON', 'LAT' and the count of every species.
+        """
+        store = DataStore()
+        if store.exists('grouping', year):
+            return apply_schema(store.read('grouping', year))
+        return pad_codes(pd.read_csv(os.path.join(self.data_source, f"{year}-geocode.csv"), header=0, sep=';',
+                                     dtype=read_dtypes(), encoding=ENCODING))
+
+class DataProcessing():
+    """
+    Class computing a kernel density raster of the animals.
+
+    The points are binned on a regular grid in Lambert-93, weighted by the
+    count of every species, then convolved with a truncated Gaussian kernel
+    through FFT: the cost depends on the size of the grid, not on the number
+    of points.
+    """
+
+    def __init__(self, data, resolution=1000, bandwidth=2000, extent=FRANCE_EXTENT):
+        """
+        Initialize the DataProcessing class.
+
+        Parameters:
+        - data (DataFrame): Communes with 'LON', 'LAT' (EPSG:4326) and the count of every species.
+        - resolution (float): Size of a cell in meters.
+        - bandwidth (float): Standard deviation of the Gaussian kernel in meters.
+        - extent (tuple): Extent of the grid in Lambert-93 (xmin, ymin, xmax, ymax).
+        """
+        self.data = data
+        self.resolution = float(resolution)
+        self.bandwidth = float(bandwidth)
+
+        # Grille calée sur les multiples de la résolution, d'un raster à l'autre les cellules coïncident
+        xmin, ymin, xmax, ymax = extent
+        self.x0 = np.floor(xmin / self.resolution) * self.resolution
+        self.y0 = np.floor(ymin / self.resolution) * self.resolution
+        self.nx = int(np.ceil((xmax - self.x0) / self.resolution))
+        self.ny = int(np.ceil((ymax - self.y0) / self.resolution))
+
+    def project(self):
+        """
+        Lambert-93 coordinates and weights of the geocoded communes.
+
+        Returns:
+        - tuple: x and y in meters, and weights of shape (species, n).
+        """
+        lon = pd.to_numeric(self.data['LON'], errors='coerce').to_numpy(dtype=np.float64)
+        lat = pd.to_numeric(self.data['LAT'], errors='coerce').to_numpy(dtype=np.float64)
+        weights = np.stack([pd.to_numeric(self.data[species], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+                            for species in SPECIES])
+
+        located = np.isfinite(lon) & np.isfinite(lat)
+        transformer = pyproj.Transformer.from_crs('EPSG:4326', GRID_CRS, always_xy=True)
+        x, y = transformer.transform(lon[located], lat[located])
+        return x, y, weights[:, located]
+
+    def binning(self):
+        """
+        Count of every species in every cell, the points outside the extent are left out.
+
+        Returns:
+        - ndarray: Counts of shape (species, ny, nx), the first row being the southernmost.
+        """
+        x, y, weights = self.project()
+        cells_x = np.floor((x - self.x0) / self.resolution).astype(np.int64)
+        cells_y = np.floor((y - self.y0) / self.resolution).astype(np.int64)
+        inside = (cells_x >= 0) & (cells_x < self.nx) & (cells_y >= 0) & (cells_y < self.ny)
+
+        cells = cells_y[inside] * self.nx + cells_x[inside]
+        counts = np.stack([np.bincount(cells, weights=species[inside], minlength=self.ny * self.nx) for species in weights])
+        return counts.reshape(len(SPECIES), self.ny, self.nx)
+
+    def kernel(self):
+        """
+        Gaussian kernel sampled on the cells, truncated at four bandwidths and summing to one.
+
+        Returns:
+        - ndarray: Kernel of shape (2 * radius + 1, 2 * radius + 1).
+        """
+        sigma = self.bandwidth / self.resolution
+        radius = max(int(np.ceil(4 * sigma)), 1)
+        offsets = np.arange(-radius, radius + 1, dtype=np.float64)
+        profile = np.exp(-0.5 * (offsets / sigma) ** 2)
+        kernel = np.outer(profile, profile)
+        return kernel / kernel.sum()
+
+    def calculate_density(self):
+        """
+        Kernel density of every species in animals per km².
+
+        Returns:
+        - ndarray: Density of shape (species, ny, nx) in float32, the first row being the northernmost.
+        """
+        counts = self.binning()
+        kernel = self.kernel()
+        radius = kernel.shape[0] // 2
+
+        # Convolution linéaire : zéros autour de la grille pour que les bords ne se replient pas
+        shape = (fast_size(self.ny + 2 * radius), fast_size(self.nx + 2 * radius))
+        spectrum = np.fft.rfft2(counts, s=shape) * np.fft.rfft2(kernel, s=shape)
+        density = np.fft.irfft2(spectrum, s=shape)[:, radius:radius + self.ny, radius:radius + self.nx]
+
+        # Résidus d'arrondi de la FFT ramenés à zéro, puis passage en animaux par km²
+        density = np.clip(density, 0, None) / (self.resolution / 1000) ** 2
+        return density[:, ::-1].astype(np.float32)
+
+    def metadata(self, year):
+        """
+        Georeferencing of the raster, written next to it.
+
+        Parameters:
+        - year (int): Year of the data.
+
+        Returns:
+        - dict: CRS, origin (top left corner), resolution, size, bandwidth and bands.
+        """
+        return {
+            'year': year,
+            'crs': GRID_CRS,
+            'origin': [self.x0, self.y0 + self.ny * self.resolution],
+            'resolution': self.resolution,
+            'width': self.nx,
+            'height': self.ny,
+            'bandwidth': self.bandwidth,
+            'bands': SPECIES,
+            'unit': 'animals/km2',
+        }
+
+class DataExporting():
+
+    def __init__(self, output_source):
+        self.output_source = output_source
+
+    def export_memmap(self, density, metadata):
+        """
+        Write the raster to a NumPy file readable with np.load(path, mmap_mode='r'), with its JSON sidecar.
+
+        Parameters:
+        - density (ndarray): Output of calculate_density.
+        - metadata (dict): Output of metadata.
+
+        Returns:
+        - str: Path to the NumPy file.
+        """
+        os.makedirs(self.output_source, exist_ok=True)
+        path = os.path.join(self.output_source, f"kde-{metadata['year']}.npy")
+
+        raster = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=density.shape)
+        raster[:] = density
+        raster.flush()
+        del raster
+
+        with open(os.path.join(self.output_source, f"kde-{metadata['year']}.json"), 'w', encoding='utf-8') as file:
+            json.dump(metadata, file, indent=2)
+        return path
+
+    def export_geotiff(self, density, metadata):
+        """
+        Write the raster to a tiled and compressed GeoTIFF, one band per species, if rasterio is installed.
+
+        Parameters:
+        - density (ndarray): Output of calculate_density.
+        - metadata (dict): Output of metadata.
+
+        Returns:
+        - str or None: Path to the GeoTIFF file, None without rasterio.
+        """
+        if rasterio is None:
+            return None
+
+        os.makedirs(self.output_source, exist_ok=True)
+        path = os.path.join(self.output_source, f"kde-{metadata['year']}.tif")
+        profile = {
+            'driver': 'GTiff', 'dtype': 'float32', 'count': density.shape[0],
+            'width': metadata['width'], 'height': metadata['height'], 'crs': metadata['crs'],
+            'transform': from_origin(*metadata['origin'], metadata['resolution'], metadata['resolution']),
+            'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate', 'predictor': 3,
+        }
+        with rasterio.open(path, 'w', **profile) as raster:
+            raster.write(density)
+            raster.descriptions = tuple(metadata['bands'])
+        return path
+
+class DataPipeline(DataLoading, DataProcessing, DataExporting):
+    def __init__(self, data_source):
+        super().__init__(data_source)
+
+    def run_process(self, years, output_source, resolution=1000, bandwidth=2000):
+        """
+        Build the kernel density raster of every year.
+
+        Parameters:
+        - years (iterable of int): Years to process.
+        - output_source (str): Directory of the rasters.
+        - resolution (float): Size of a cell in meters.
+        - bandwidth (float): Standard deviation of the Gaussian kernel in meters.
+
+        Returns:
+        - None
+        """
+        data_load = DataLoading(self.data_source)
+        data_export = DataExporting(output_source)
+
+        for year in years:
+            with METRICS.stage('kde', year) as metrics:
+                data = data_load.loading_year(year)
+                metrics.rows_in = len(data)
+
+                print(f"=========== CALCULATE KDE for {year} ===========")
+                data_process = DataProcessing(data, resolution, bandwidth)
+                density = data_process.calculate_density()
+                metrics.rows_out = int(density.shape[1] * density.shape[2])
+
+                print(f"=========== EXPORT KDE for {year} ===========")
+                metadata = data_process.metadata(year)
+                data_export.export_memmap(density, metadata)
+                data_export.export_geotiff(density, metadata)
+
+    def pipeline_running(self, data_source, output_source, years=(2017, 2018, 2019, 2020), resolution=1000, bandwidth=2000):
+        start = time.time()
+        self.run_process(years, output_source, resolution, bandwidth)
+        end = time.time()
+        print('{:.4f} s'.format(end - start))
+        METRICS.export('calculkde')
+
+if __name__ == "__main__":
+    data_source = "../datageocoding/data/"
+    output_source = "./result/kde/"
+
+    pipeline = DataPipeline(data_source)
+    pipeline.pipeline_running(data_source, output_source)
@@ -0,0 +1,317 @@
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+import shapely
+import mapbox_vector_tile
+import sqlite3
+import hashlib
+import gzip
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.datametrics import METRICS
+
+# Demi-étendue du monde en Web Mercator (EPSG:3857), en mètres
+WORLD_EXTENT = 20037508.342789244
+
+class DataLoading():
+    def __init__(self, geojson_source):
+        self.geojson_source = geojson_source
+
+    def loading_from_geojson(self):
+        # Sortie de calculdensite dans le magasin intermédiaire, sinon fichier GeoJSON
+        store = DataStore()
+        if store.exists('density'):
+            return store.read('density')
+        if os.path.exists(self.geojson_source):
+            geojson = gpd.read_file(self.geojson_source)
+            return geojson
+        else:
+            return f"File from {self.geojson_source} doesn't exist"
+
+class DataProcessing():
+    """
+    Class for cutting the density layer into a pyramid of vector tiles.
+    """
+    LAYER = 'communes'
+    EXTENT = 4096
+    # Hash des communes sans géométrie
+    NO_GEOMETRY = 'none'
+
+    def __init__(self, geojson, min_zoom=0, max_zoom=10):
+        """
+        Initialize the DataProcessing class.
+
+        Parameters:
+        - geojson (GeoDataFrame): Output of calculdensite with the '<column>_DENSITE' columns.
+        - min_zoom (int): Lowest zoom level of the pyramid.
+        - max_zoom (int): Highest zoom level of the pyramid.
+        """
+        colonnes = ['insee_com'] + [colonne for colonne in ['nom_comm'] if colonne in geojson.columns]
+        colonnes += [colonne for colonne in geojson.columns if re.match(r"^(CHAT|CHIEN)_\d{4}_DENSITE$", colonne)]
+
+        self.geojson = geojson[colonnes + [geojson.geometry.name]].to_crs(epsg=3857).reset_index(drop=True)
+        self.attributes = colonnes
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.simplified = {}
+
+    def communes_index(self):
+        """
+        Hash and bounds of every commune, used to find the tiles to rebuild.
+
+        Communes without geometry share a fixed hash and have NaN bounds,
+        they are in no tile.
+
+        Returns:
+        - DataFrame: 'hash', 'minx', 'miny', 'maxx' and 'maxy' indexed by 'insee_com'.
+        """
+        # Géométries absentes : ni hash de la géométrie, ni tuile
+        located = self.geojson.geometry.notna().to_numpy()
+        attributes = pd.util.hash_pandas_object(self.geojson[self.attributes], index=False).to_numpy()[located]
+        wkb = shapely.to_wkb(self.geojson.geometry.values[located])
+        hashes = np.full(len(self.geojson), self.NO_GEOMETRY, dtype=object)
+        hashes[located] = [hashlib.sha1(geometry + int(value).to_bytes(8, 'little')).hexdigest() for geometry, value in zip(wkb, attributes)]
+
+        index = pd.DataFrame(self.geojson.geometry.bounds.to_numpy(), columns=['minx', 'miny', 'maxx', 'maxy'])
+        index.insert(0, 'hash', hashes)
+        index.index = pd.Index(self.geojson['insee_com'], name='insee_com')
+        return index
+
+    def tiles_of_bounds(self, bounds):
+        """
+        Tiles of every zoom level touched by the given bounds.
+
+        Parameters:
+        - bounds (ndarray): Bounds in EPSG:3857, shape (n, 4), the rows with NaN (no geometry) are ignored.
+
+        Returns:
+        - set of tuple: Tiles as (zoom, x, y), y counted from the top (XYZ scheme).
+        """
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        bounds = bounds[np.isfinite(bounds).all(axis=1)]
+        tiles = set()
+
+        for zoom in range(self.min_zoom, self.max_zoom + 1):
+            count = 2 ** zoom
+            size = 2 * WORLD_EXTENT / count
+            x0 = np.clip(np.floor((bounds[:, 0] + WORLD_EXTENT) / size), 0, count - 1).astype(np.int64)
+            x1 = np.clip(np.floor((bounds[:, 2] + WORLD_EXTENT) / size), 0, count - 1).astype(np.int64)
+            y0 = np.clip(np.floor((WORLD_EXTENT - bounds[:, 3]) / size), 0, count - 1).astype(np.int64)
+            y1 = np.clip(np.floor((WORLD_EXTENT - bounds[:, 1]) / size), 0, count - 1).astype(np.int64)
+
+            for xa, xb, ya, yb in zip(x0, x1, y0, y1):
+                tiles.update((zoom, x, y) for x in range(xa, xb + 1) for y in range(ya, yb + 1))
+
+        return tiles
+
+    def changed_tiles(self, previous_index, current_index):
+        """
+        Tiles covering the communes that were added, removed or modified.
+
+        Parameters:
+        - previous_index (DataFrame or None): Index of the communes of the previous build.
+        - current_index (DataFrame): Index of the current communes.
+
+        Returns:
+        - set of tuple: Tiles to rebuild as (zoom, x, y).
+        """
+        if previous_index is None:
+            return self.tiles_of_bounds(current_index[['minx', 'miny', 'maxx', 'maxy']].to_numpy())
+
+        joined = previous_index.join(current_index, how='outer', lsuffix='_old')
+        changed = joined[joined['hash_old'] != joined['hash']]
+
+        bounds = np.concatenate([changed[['minx_old', 'miny_old', 'maxx_old', 'maxy_old']].dropna().to_numpy(),
+                                 changed[['minx', 'miny', 'maxx', 'maxy']].dropna().to_numpy()])
+        return self.tiles_of_bounds(bounds)
+
+    def simplified_geometry(self, zoom):
+        """
+        Geometries simplified to the pixel size of a zoom level, computed once per level.
+
+        Parameters:
+        - zoom (int): Zoom level.
+
+        Returns:
+        - ndarray: Simplified geometries.
+        """
+        if zoom not in self.simplified:
+            pixel = 2 * WORLD_EXTENT / (2 ** zoom * 256)
+            self.simplified[zoom] = shapely.simplify(self.geojson.geometry.values, pixel, preserve_topology=True)
+        return self.simplified[zoom]
+
+    def render_tile(self, zoom, x, y):
+        """
+        Encode one tile as a gzipped Mapbox Vector Tile.
+
+        Parameters:
+        - zoom (int): Zoom level.
+        - x (int): Column of the tile.
+        - y (int): Row of the tile, counted from the top.
+
+        Returns:
+        - bytes or None: Tile data, None if no commune touches the tile.
+        """
+        size = 2 * WORLD_EXTENT / 2 ** zoom
+        bounds = (-WORLD_EXTENT + x * size, WORLD_EXTENT - (y + 1) * size, -WORLD_EXTENT + (x + 1) * size, WORLD_EXTENT - y * size)
+
+        candidates = self.geojson.sindex.query(shapely.box(*bounds))
+        if len(candidates) == 0:
+            return None
+
+        # Marge d'un pixel pour éviter les coutures entre tuiles
+        buffer = size / 256
+        geometries = shapely.clip_by_rect(self.simplified_geometry(zoom)[candidates],
+                                          bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+
+        # Passage en coordonnées de tuile et orientation des anneaux (extérieur horaire,
+        # intérieurs anti-horaires) en une seule opération sur toutes les géométries
+        origin = np.array([bounds[0], bounds[1]])
+        geometries = shapely.transform(geometries, lambda coords: np.round((coords - origin) / size * self.EXTENT))
+        geometries = shapely.normalize(geometries)
+
+        kept = ~shapely.is_empty(geometries)
+        properties = self.geojson.loc[candidates[kept], self.attributes]
+        properties = properties.astype(object).where(properties.notna(), None).to_dict('records')
+
+        features = [{'geometry': geometry, 'properties': {key: value for key, value in props.items() if value is not None}}
+                    for geometry, props in zip(geometries[kept], properties)]
+        if not features:
+            return None
+
+        tile = mapbox_vector_tile.encode([{'name': self.LAYER, 'features': features}],
+                                         default_options={'extents': self.EXTENT, 'check_winding_order': False})
+        return gzip.compress(tile)
+
+class DataExporting():
+    """
+    Class for writing the tiles to an MBTiles (SQLite) container.
+    """
+    def __init__(self, mbtiles_path):
+        self.mbtiles_path = mbtiles_path
+
+    def connect(self):
+        """
+        Open the MBTiles file, creating its tables if needed.
+
+        Returns:
+        - sqlite3.Connection: Connection to the MBTiles file.
+        """
+        connection = sqlite3.connect(self.mbtiles_path)
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+                                              PRIMARY KEY (zoom_level, tile_column, tile_row));
+            CREATE TABLE IF NOT EXISTS communes (insee_com TEXT PRIMARY KEY, hash TEXT,
+                                                 minx REAL, miny REAL, maxx REAL, maxy REAL);
+        """)
+        return connection
+
+    def load_index(self, connection):
+        """
+        Index of the communes of the previous build.
+
+        Returns:
+        - DataFrame or None: Index of the communes, None if the container is empty.
+        """
+        index = pd.read_sql_query("SELECT * FROM communes", connection, index_col='insee_com')
+        return index if len(index) else None
+
+    def write_tiles(self, connection, tiles, index, metadata):
+        """
+        Replace the given tiles, the communes index and the metadata.
+
+        Parameters:
+        - connection (sqlite3.Connection): Connection to the MBTiles file.
+        - tiles (iterable): Tiles as (zoom, x, y, data), data None to delete the tile.
+        - index (DataFrame): Index of the current communes.
+        - metadata (dict): MBTiles metadata.
+
+        Returns:
+        - None
+        """
+        with connection:
+            for zoom, x, y, data in tiles:
+                # MBTiles numérote les lignes depuis le bas (schéma TMS)
+                row = 2 ** zoom - 1 - y
+                if data is None:
+                    connection.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (zoom, x, row))
+                else:
+                    connection.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (zoom, x, row, data))
+
+            connection.execute("DELETE FROM communes")
+            connection.executemany("INSERT INTO communes VALUES (?, ?, ?, ?, ?, ?)", index.reset_index().itertuples(index=False, name=None))
+            connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", metadata.items())
+
+class DataPipeline(DataLoading, DataProcessing, DataExporting):
+    def __init__(self, data_source):
+        super().__init__(data_source)
+
+    def run_process(self, data, mbtiles_path, min_zoom=0, max_zoom=10):
+        """
+        Build or update the tile pyramid of the density layer.
+
+        Only the tiles touched by communes added, removed or modified since the
+        previous build are rendered again.
+
+        Parameters:
+        - data (GeoDataFrame): Output of calculdensite.
+        - mbtiles_path (str): Path to the MBTiles file.
+        - min_zoom (int): Lowest zoom level of the pyramid.
+        - max_zoom (int): Highest zoom level of the pyramid.
+
+        Returns:
+        - None
+        """
+        with METRICS.stage('tiles') as metrics:
+            metrics.rows_in = len(data)
+            data_process = DataProcessing(data, min_zoom, max_zoom)
+            data_export = DataExporting(mbtiles_path)
+            connection = data_export.connect()
+
+            print(f"=========== FIND CHANGED TILES ===========")
+            current_index = data_process.communes_index()
+            tiles = sorted(data_process.changed_tiles(data_export.load_index(connection), current_index))
+
+            print(f"=========== RENDER {len(tiles)} TILES ===========")
+            rendered = [(zoom, x, y, data_process.render_tile(zoom, x, y)) for zoom, x, y in tiles]
+            metrics.rows_out = len(rendered)
+
+            bounds = data.to_crs(epsg=4326).total_bounds
+            metadata = {
+                'name': 'densite',
+                'format': 'pbf',
+                'minzoom': str(min_zoom),
+                'maxzoom': str(max_zoom),
+                'bounds': ','.join(f'{value:.6f}' for value in bounds),
+                'json': json.dumps({'vector_layers': [{'id': DataProcessing.LAYER, 'minzoom': min_zoom, 'maxzoom': max_zoom,
+                                                       'fields': {colonne: 'String' if colonne in ('insee_com', 'nom_comm') else 'Number'
+                                                                  for colonne in data_process.attributes}}]}),
+            }
+
+            print(f"=========== EXPORT TILES ===========")
+            data_export.write_tiles(connection, rendered, current_index, metadata)
+            connection.close()
+
+    def pipeline_running(self, data_source, mbtiles_path, min_zoom=0, max_zoom=10):
+        data_load = DataLoading(data_source)
+        data = data_load.loading_from_geojson()
+
+        start = time.time()
+        self.run_process(data, mbtiles_path, min_zoom, max_zoom)
+        end = time.time()
+        print('{:.4f} s'.format(end - start))
+        METRICS.export('densitytiles')
+
+if __name__ == "__main__":
+    data_source = "./result/final_data.geojson"
+    mbtiles_path = "./result/densite.mbtiles"
+
+    pipeline = DataPipeline(data_source)
+    pipeline.pipeline_running(data_source, mbtiles_path)
@@ -0,0 +1,311 @@
+import importlib.util
+import json
+import numpy as np
+import pandas as pd
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datagenerator import DataExporting, DataGenerating
+
+# Racine du dépôt, pour charger les scripts des étapes
+ROOT_SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Marqueur de la ligne de sortie portant les mesures d'un cas
+RESULT_MARKER = 'BENCHMARK_RESULT '
+
+def load_script(path):
+    """
+    Import a stage script from its path, e.g. join-tables.py which is not a valid module name.
+
+    Args:
+        path (str): Path to the script, relative to the root of the repository.
+
+    Returns:
+        module: The imported script.
+    """
+    name = os.path.splitext(os.path.basename(path))[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT_SOURCE, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class DataCase():
+    """
+    Class running one stage on one synthetic dataset, inside the benchmark subprocess.
+
+    The DataPipeline classes read their paths from module globals, as in their
+    __main__ blocks, so the globals are set before instantiating them.
+    """
+
+    def __init__(self, source, geojson_source, year=2019):
+        """
+        Initializes the DataCase instance.
+
+        Args:
+            source (str): Directory of the synthetic dataset of one scale.
+            geojson_source (str): Path to the GeoJSON file of the communes.
+            year (int): Year of the dataset.
+        """
+        self.source = source
+        self.geojson_source = geojson_source
+        self.year = year
+
+    def pipeline(self, module):
+        module.data_source, module.geojson_source = self.source, self.geojson_source
+        return module.DataPipeline()
+
+    def grouping(self):
+        module = load_script('datacleaning/datagrouping.py')
+        chunks = pd.read_csv(os.path.join(self.source, f'{self.year}.csv'), header=0, sep=',', chunksize=1000)
+        self.pipeline(module).run_process(module.DataLoading(self.source, self.geojson_source), chunks, self.year)
+
+    def grouping2(self):
+        module = load_script('datacleaning2/datacleaning2.py')
+        chunks = pd.read_csv(os.path.join(self.source, f'data{self.year}.csv'), header=0, sep=',', chunksize=1000)
+        self.pipeline(module).run_process(module.DataLoading(self.source, self.geojson_source), chunks, self.year)
+
+    def geocoding(self):
+        module = load_script('datageocoding/datageocoding.py')
+        self.pipeline(module).run_process([self.year], module.DataLoading(self.source, self.geojson_source))
+
+    def density(self):
+        self.geocoding()
+        module = load_script('calculdensite/calculdensite.py')
+        data = module.DataStore().read('geocoding')
+        module.DataPipeline(self.source).run_process(data, './result/final_data.geojson')
+
+    def run_process(self, stage):
+        """
+        Run a stage and return the measures it recorded.
+
+        Args:
+            stage (str): 'grouping', 'grouping2', 'geocoding' or 'density'.
+
+        Returns:
+            list of dict: Records of the datametrics collector.
+        """
+        getattr(self, stage)()
+        from datacommon.datametrics import METRICS
+        return METRICS.records
+
+class DataBenchmark():
+    """
+    Class running the stages on the synthetic datasets of every scale.
+
+    Each stage and scale runs in its own subprocess, with its own intermediate
+    store and caches in a temporary directory, so the peak RSS of a case is not
+    inflated by the previous ones and every cache starts cold.
+    """
+    STAGES = ['grouping', 'grouping2', 'geocoding', 'density']
+
+    def __init__(self, data_source, geojson_source, year=2019, timeout=None):
+        """
+        Initializes the DataBenchmark instance.
+
+        Args:
+            data_source (str): Directory of the synthetic datasets, as written by datagenerator.
+            geojson_source (str): Path to the GeoJSON file of the communes.
+            year (int): Year of the datasets.
+            timeout (float): Maximum duration of a case in seconds, no limit if None.
+        """
+        self.data_source = data_source
+        self.geojson_source = os.path.abspath(geojson_source)
+        self.year = year
+        self.timeout = timeout
+
+    def run_case(self, stage, scale):
+        """
+        Run one stage on the dataset of one scale.
+
+        Args:
+            stage (str): Name of the stage.
+            scale (float): Scale of the dataset.
+
+        Returns:
+            dict: Measures of the stage, with 'status' 'ok', 'failed' or 'timeout'.
+        """
+        source = os.path.abspath(DataExporting(self.data_source).scale_source(scale))
+        record = {'stage': stage, 'scale': scale}
+
+        with tempfile.TemporaryDirectory() as work_source:
+            environment = {**os.environ, 'DATASTORE_SOURCE': os.path.join(work_source, 'store')}
+            command = [sys.executable, os.path.abspath(__file__), 'case', stage, source, self.geojson_source, str(self.year)]
+            start = time.perf_counter()
+            try:
+                process = subprocess.run(command, cwd=work_source, env=environment, capture_output=True, text=True,
+                                         timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                return {**record, 'status': 'timeout', 'wall_s': round(time.perf_counter() - start, 4)}
+
+        results = [line[len(RESULT_MARKER):] for line in process.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+        if process.returncode != 0 or not results:
+            print(process.stderr[-2000:])
+            return {**record, 'status': 'failed'}
+
+        # La mesure de l'étape est le dernier enregistrement à son nom, l'étape englobante se terminant en dernier
+        measures = [measure for measure in json.loads(results[-1]) if measure['stage'] == stage]
+        return {**record, **measures[-1], 'status': 'ok'}
+
+    def run_process(self, stages=None, scales=(1, 10, 100)):
+        """
+        Run every stage on every scale.
+
+        Args:
+            stages (list): Names of the stages, all if None.
+            scales (iterable): Scales of the datasets.
+
+        Returns:
+            pd.DataFrame: One row per stage and scale.
+        """
+        results = []
+        for stage in stages or self.STAGES:
+            for scale in scales:
+                print(f"=========== BENCHMARK {stage} x{scale:g} ===========")
+                results.append(self.run_case(stage, scale))
+                print({key: results[-1].get(key) for key in ('status', 'rows_in', 'wall_s', 'peak_rss_mb')})
+        return pd.DataFrame(results)
+
+    @staticmethod
+    def scaling(results):
+        """
+        Scaling exponent of the time and memory of every stage.
+
+        The exponent is the slope of log(measure) against log(rows_in): about 1
+        for a linear stage, 2 for a quadratic one.
+
+        Args:
+            results (pd.DataFrame): Output of run_process.
+
+        Returns:
+            pd.DataFrame: 'time_exponent' and 'memory_exponent' by stage.
+        """
+        exponents = {}
+        for stage, group in results[results['status'] == 'ok'].groupby('stage'):
+            group = group[group['rows_in'] > 0]
+            if group['rows_in'].nunique() < 2:
+                continue
+            x = np.log(group['rows_in'].astype(float))
+            exponents[stage] = {
+                'time_exponent': round(np.polyfit(x, np.log(group['wall_s'].astype(float).clip(lower=1e-4)), 1)[0], 2),
+                'memory_exponent': round(np.polyfit(x, np.log(group['peak_rss_mb'].astype(float)), 1)[0], 2),
+            }
+        return pd.DataFrame.from_dict(exponents, orient='index').rename_axis('stage')
+
+    def export(self, results, output_source='./result/'):
+        """
+        Export the curves and the scaling exponents.
+
+        Args:
+            results (pd.DataFrame): Output of run_process.
+            output_source (str): Directory of the reports.
+        """
+        os.makedirs(output_source, exist_ok=True)
+        results.to_csv(os.path.join(output_source, 'benchmark.csv'), sep=';', index=False)
+        results.to_json(os.path.join(output_source, 'benchmark.json'), orient='records', indent=2)
+        self.scaling(results).to_csv(os.path.join(output_source, 'scaling.csv'), sep=';')
+
+class DataMatching():
+    """
+    Class comparing the engines of the fuzzy tier of CommuneMatcher on recall and throughput.
+
+    Names of communes of the GeoJSON are corrupted with the typos of
+    datagenerator, so that none of them is found by the exact tiers, and
+    every engine searches them among the choices of a CommuneMatcher. A name
+    is recalled when the engine returns a commune of the same normalized name.
+    """
+
+    def __init__(self, geojson_source, n_names=5000, seed=0):
+        """
+        Initializes the DataMatching instance.
+
+        Args:
+            geojson_source (str): Path to the GeoJSON file of the communes.
+            n_names (int): Number of corrupted names.
+            seed (int): Seed of the random generator.
+        """
+        self.geojson_source = geojson_source
+        self.n_names = n_names
+        self.seed = seed
+
+    def queries(self, choices):
+        """
+        Corrupted names and the normalized name they come from.
+
+        Args:
+            choices (list): Normalized names of the matcher.
+
+        Returns:
+            tuple: Normalized corrupted names and expected names, the corrupted names absent from the choices.
+        """
+        from datacommon.datanormalize import normalize_city
+
+        rng = np.random.default_rng(self.seed)
+        expected = pd.Series(choices).iloc[rng.choice(len(choices), size=self.n_names)].reset_index(drop=True)
+        generator = DataGenerating(pd.DataFrame({'VILLE': expected}), seed=self.seed)
+        names = normalize_city(pd.Series([generator.typo(name.upper()) for name in expected])).fillna('')
+
+        # Une faute qui donne le nom d'une autre commune n'est pas une recherche floue
+        fuzzy = ~names.isin(set(choices)) & (names != '')
+        return names[fuzzy].tolist(), expected[fuzzy].tolist()
+
+    def run_process(self, engines=('rapidfuzz', 'ngram'), score_cutoff=90):
+        """
+        Measure every engine on the same corrupted names.
+
+        Args:
+            engines (iterable): Names of the engines, see datamatch.search_engine.
+            score_cutoff (float): Minimum score of a match.
+
+        Returns:
+            pd.DataFrame: Build time, search time, throughput, match rate and recall by engine.
+        """
+        import geopandas as gpd
+        from datacommon.datamatch import CommuneMatcher, search_engine
+
+        matcher = CommuneMatcher(gpd.read_file(self.geojson_source), score_cutoff=score_cutoff)
+        names, expected = self.queries(matcher.choices)
+
+        results = []
+        for engine in engines:
+            start = time.perf_counter()
+            search = search_engine(engine, matcher.choices, score_cutoff)
+            build = time.perf_counter() - start
+
+            start = time.perf_counter()
+            found = search.search(names)
+            wall = time.perf_counter() - start
+
+            recalled = sum(position >= 0 and matcher.choices[position] == name for position, name in zip(found, expected))
+            results.append({'engine': type(search).__name__, 'names': len(names), 'build_s': round(build, 4),
+                            'wall_s': round(wall, 4), 'names_per_s': round(len(names) / wall, 1),
+                            'match_rate': round(float((found >= 0).mean()), 4), 'recall': round(recalled / len(names), 4)})
+        return pd.DataFrame(results)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['case']:
+        # Exécution d'un cas dans le sous-processus lancé par DataBenchmark.run_case
+        stage, source, geojson_source, year = sys.argv[2:6]
+        records = DataCase(source, geojson_source, int(year)).run_process(stage)
+        print(RESULT_MARKER + json.dumps(records))
+    elif sys.argv[1:2] == ['matching']:
+        # Comparaison des moteurs de recherche floue, GeoJSON des communes en argument optionnel
+        geojson_source = sys.argv[2] if len(sys.argv) > 2 else "../datacleaning/data-cleaned/communes/communes.geojson"
+        results = DataMatching(geojson_source).run_process()
+        os.makedirs('./result/', exist_ok=True)
+        results.to_csv('./result/matching.csv', sep=';', index=False)
+        print(results.to_string(index=False))
+    else:
+        data_source = "./data/"
+        geojson_source = "../datacleaning/data-cleaned/communes/communes.geojson"
+
+        benchmark = DataBenchmark(data_source, geojson_source)
+        start = time.time()
+        results = benchmark.run_process(scales=(1, 10, 100))
+        benchmark.export(results)
+        print(benchmark.scaling(results))
+        end = time.time()
+        print('{:.4f} s'.format(end - start))
@@ -0,0 +1,319 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import os
+
+# Nombre de lignes d'une année I-CAD réelle (2019 : ~60 000 lignes), soit l'échelle 1x
+BASE_ROWS = 60000
+
+class DataLoading():
+    """
+    Class for loading the commune reference the synthetic rows are drawn from.
+    """
+    def __init__(self, commune_source, geojson_source=None):
+        """
+        Initialize the DataLoading class.
+
+        Parameters:
+        - commune_source (str): Path to the commune.csv file of the La Poste postal codes.
+        - geojson_source (str): Path to the GeoJSON file of the communes, needed for the coordinates.
+        """
+        self.commune_source = commune_source
+        self.geojson_source = geojson_source
+
+    def loading_reference(self):
+        """
+        Load the communes with their postal code and, if available, their coordinates.
+
+        Returns:
+        - DataFrame: 'CODE INSEE', 'VILLE', 'CODE POSTAL' and, with a GeoJSON file, 'LON' and 'LAT'.
+        """
+        reference = pd.read_csv(self.commune_source, sep=';', encoding='latin-1', dtype=str)
+        reference = reference.iloc[:, :3]
+        reference.columns = ['CODE INSEE', 'VILLE', 'CODE POSTAL']
+        reference = reference.dropna().drop_duplicates(['CODE INSEE', 'CODE POSTAL']).reset_index(drop=True)
+
+        if self.geojson_source and os.path.exists(self.geojson_source):
+            communes = gpd.read_file(self.geojson_source)
+            points = communes.geometry.representative_point()
+            coordinates = pd.DataFrame({'CODE INSEE': communes['insee_com'].astype(str).str.zfill(5),
+                                        'LON': points.x.to_numpy(), 'LAT': points.y.to_numpy()})
+            reference = reference.merge(coordinates.drop_duplicates('CODE INSEE'), on='CODE INSEE', how='inner')
+
+        return reference
+
+class DataGenerating():
+    """
+    Class for generating synthetic I-CAD-like rows at any scale.
+
+    Rows are drawn from the commune reference with a heavy-tailed weight per
+    commune, and the city names and postal codes are corrupted the way the
+    real extracts are: typos, "CEDEX" suffixes, "ST"/"STE" abbreviations,
+    hyphens, case, and truncated or shifted postal codes.
+    """
+    SPECIES = ['CHAT', 'CHIEN']
+
+    # Probabilité de chaque altération par ligne
+    NOISE = {
+        'saint': 0.6,
+        'hyphen': 0.3,
+        'cedex': 0.02,
+        'typo': 0.05,
+        'case': 0.1,
+        'postal': 0.05,
+    }
+
+    def __init__(self, reference, seed=0, noise=None):
+        """
+        Initialize the DataGenerating class.
+
+        Parameters:
+        - reference (DataFrame): Output of DataLoading.loading_reference.
+        - seed (int): Seed of the random generator, the same seed gives the same rows.
+        - noise (dict): Probability of each corruption, the defaults of NOISE if None.
+        """
+        self.reference = reference
+        self.rng = np.random.default_rng(seed)
+        self.noise = {**self.NOISE, **(noise or {})}
+        # Quelques grandes communes concentrent la plupart des animaux
+        weights = self.rng.pareto(1.2, len(reference)) + 1
+        self.weights = weights / weights.sum()
+
+    def draw(self, n_rows):
+        """
+        Draw communes for n_rows rows.
+
+        Parameters:
+        - n_rows (int): Number of rows.
+
+        Returns:
+        - DataFrame: Rows of the reference, with repetitions.
+        """
+        index = self.rng.choice(len(self.reference), size=n_rows, p=self.weights)
+        return self.reference.iloc[index].reset_index(drop=True)
+
+    def typo(self, name):
+        """
+        Apply one random edit (deletion, insertion, substitution or swap) to a name.
+        """
+        if len(name) < 3:
+            return name
+        position = int(self.rng.integers(1, len(name) - 1))
+        letter = chr(int(self.rng.integers(ord('A'), ord('Z') + 1)))
+        edit = self.rng.integers(4)
+        if edit == 0:
+            return name[:position] + name[position + 1:]
+        if edit == 1:
+            return name[:position] + letter + name[position:]
+        if edit == 2:
+            return name[:position] + letter + name[position + 1:]
+        return name[:position - 1] + name[position] + name[position - 1] + name[position + 1:]
+
+    def noisy_city(self, names):
+        """
+        Corrupt the city names.
+
+        Parameters:
+        - names (Series): Clean names of the communes, in upper case.
+
+        Returns:
+        - Series: Names as typed in the I-CAD extracts.
+        """
+        names = names.copy()
+        n_rows = len(names)
+        draw = lambda key: self.rng.random(n_rows) < self.noise[key]
+
+        mask = draw('saint')
+        names[mask] = names[mask].str.replace(r'\bSAINTE\b', 'STE', regex=True).str.replace(r'\bSAINT\b', 'ST', regex=True)
+
+        mask = draw('hyphen')
+        names[mask] = names[mask].str.replace(' ', '-', regex=False)
+
+        mask = draw('typo')
+        names[mask] = [self.typo(name) for name in names[mask]]
+
+        mask = draw('cedex')
+        suffix = np.where(self.rng.random(n_rows) < 0.5, ' CEDEX', pd.Series(self.rng.integers(1, 20, n_rows)).map(' CEDEX {:02d}'.format))
+        names[mask] = names[mask] + suffix[mask]
+
+        mask = draw('case')
+        names[mask] = np.where(self.rng.random(mask.sum()) < 0.5, names[mask].str.lower(), names[mask].str.title())
+
+        return names
+
+    def noisy_postal(self, codes):
+        """
+        Corrupt the postal codes.
+
+        Parameters:
+        - codes (Series): Postal codes on five digits.
+
+        Returns:
+        - Series: Postal codes with a leading zero lost, the department only, a space, or a wrong digit.
+        """
+        codes = codes.copy()
+        mask = self.rng.random(len(codes)) < self.noise['postal']
+        kind = self.rng.integers(4, size=len(codes))
+
+        codes[mask & (kind == 0)] = codes[mask & (kind == 0)].str.lstrip('0')
+        codes[mask & (kind == 1)] = codes[mask & (kind == 1)].str[:2]
+        codes[mask & (kind == 2)] = codes[mask & (kind == 2)].str[:2] + ' ' + codes[mask & (kind == 2)].str[2:4]
+        wrong = mask & (kind == 3)
+        codes[wrong] = codes[wrong].str[:4] + pd.Series(self.rng.integers(10, size=len(codes))).astype(str)[wrong]
+
+        return codes
+
+    def population(self, n_rows):
+        # La plupart des lignes ne comptent qu'un ou deux animaux
+        return self.rng.geometric(0.4, size=n_rows)
+
+    def icad_rows(self, n_rows, year):
+        """
+        Raw I-CAD rows, like datacleaning/data/2019.csv.
+
+        Parameters:
+        - n_rows (int): Number of rows.
+        - year (int): Year of the rows.
+
+        Returns:
+        - DataFrame: 'ANNEE', 'ESPECE', 'CODE POSTAL', 'VILLE' and 'POPULATION'.
+        """
+        rows = self.draw(n_rows)
+        return pd.DataFrame({
+            'ANNEE': str(year),
+            'ESPECE': self.rng.choice(self.SPECIES, size=n_rows),
+            'CODE POSTAL': self.noisy_postal(rows['CODE POSTAL']),
+            'VILLE': self.noisy_city(rows['VILLE']),
+            'POPULATION': self.population(n_rows),
+        })
+
+    def icad2_rows(self, n_rows, year):
+        """
+        Raw rows of the older extracts read by datacleaning2.
+
+        Parameters:
+        - n_rows (int): Number of rows.
+        - year (int): Year of the rows.
+
+        Returns:
+        - DataFrame: 'Annee', 'Espece', 'Code postal', 'Ville' and 'Population'.
+        """
+        rows = self.icad_rows(n_rows, year)
+        return rows.rename(columns={'ANNEE': 'Annee', 'ESPECE': 'Espece', 'CODE POSTAL': 'Code postal',
+                                    'VILLE': 'Ville', 'POPULATION': 'Population'})
+
+    def cleaned_rows(self, n_rows):
+        """
+        Geocoded rows as written by datacleaning, read by datagrouping.
+
+        'VILLE' holds the name returned by the geocoder and 'VILLE_2' the name
+        typed in the extract, in lower case.
+
+        Parameters:
+        - n_rows (int): Number of rows.
+
+        Returns:
+        - DataFrame: 'ESPECE', 'CODE POSTAL', 'VILLE', 'POPULATION', 'COORDONNEES' and 'VILLE_2'.
+        """
+        self.require_coordinates()
+        rows = self.draw(n_rows)
+        return pd.DataFrame({
+            'ESPECE': self.rng.choice(self.SPECIES, size=n_rows),
+            'CODE POSTAL': self.noisy_postal(rows['CODE POSTAL']),
+            'VILLE': rows['VILLE'].str.title().str.replace(' ', '-', regex=False),
+            'POPULATION': self.population(n_rows),
+            'COORDONNEES': '[' + rows['LON'].map('{:.6f}'.format) + ', ' + rows['LAT'].map('{:.6f}'.format) + ']',
+            'VILLE_2': self.noisy_city(rows['VILLE']).str.lower(),
+        })
+
+    def geocode_rows(self, n_rows):
+        """
+        Grouped rows with coordinates, like datageocoding/data/<year>-geocode.csv.
+
+        Points are spread around the commune so that a few fall outside of it.
+
+        Parameters:
+        - n_rows (int): Number of rows.
+
+        Returns:
+        - DataFrame: 'VILLE_3', 'CHAT', 'CHIEN', 'LON', 'LAT', 'CODE POSTAL' and 'CODE INSEE'.
+        """
+        self.require_coordinates()
+        rows = self.draw(n_rows)
+        return pd.DataFrame({
+            'VILLE_3': rows['VILLE'],
+            'CHAT': self.population(n_rows) * 10,
+            'CHIEN': self.population(n_rows) * 10,
+            'LON': rows['LON'] + self.rng.normal(0, 0.005, n_rows),
+            'LAT': rows['LAT'] + self.rng.normal(0, 0.005, n_rows),
+            'CODE POSTAL': rows['CODE POSTAL'],
+            'CODE INSEE': rows['CODE INSEE'],
+        })
+
+    def require_coordinates(self):
+        if 'LON' not in self.reference:
+            raise ValueError("The reference has no coordinates, a GeoJSON file of the communes is required")
+
+class DataExporting():
+    """
+    Class for writing the synthetic datasets in the layout the stages read.
+    """
+    def __init__(self, output_source):
+        """
+        Initialize the DataExporting class.
+
+        Parameters:
+        - output_source (str): Directory of the datasets, one subdirectory per scale.
+        """
+        self.output_source = output_source
+
+    def scale_source(self, scale):
+        return os.path.join(self.output_source, f'x{scale:g}')
+
+    def export_scale(self, generator, scale, year=2019, base_rows=BASE_ROWS):
+        """
+        Write the datasets of one scale.
+
+        Parameters:
+        - generator (DataGenerating): Generator of the rows.
+        - scale (float): Multiple of base_rows.
+        - year (int): Year of the rows.
+        - base_rows (int): Number of rows of the 1x scale.
+
+        Returns:
+        - str: Directory of the datasets.
+        """
+        n_rows = int(base_rows * scale)
+        source = self.scale_source(scale)
+        os.makedirs(source, exist_ok=True)
+
+        generator.icad_rows(n_rows, year).to_csv(os.path.join(source, f'{year}-icad.csv'), index=False)
+        generator.icad2_rows(n_rows, year).to_csv(os.path.join(source, f'data{year}.csv'), index=False)
+        if 'LON' in generator.reference:
+            generator.cleaned_rows(n_rows).to_csv(os.path.join(source, f'{year}.csv'), index=False)
+            # Les fichiers géocodés sont déjà regroupés : environ une ligne pour deux lignes I-CAD
+            generator.geocode_rows(n_rows // 2).to_csv(os.path.join(source, f'{year}-geocode.csv'), sep=';',
+                                                       index=False, encoding='utf-8-sig')
+        return source
+
+class DataPipeline(DataLoading, DataExporting):
+    """
+    Class generating the synthetic datasets of every scale.
+    """
+    def __init__(self, commune_source, geojson_source, output_source):
+        DataLoading.__init__(self, commune_source, geojson_source)
+        DataExporting.__init__(self, output_source)
+
+    def pipeline_running(self, scales=(1, 10, 100), year=2019, base_rows=BASE_ROWS, seed=0):
+        reference = self.loading_reference()
+        for scale in scales:
+            print(f"=========== GENERATE x{scale:g} ({int(base_rows * scale)} ROWS) ===========")
+            self.export_scale(DataGenerating(reference, seed), scale, year, base_rows)
+
+if __name__ == "__main__":
+    commune_source = "../datacleaning/data/commune.csv"
+    geojson_source = "../datacleaning/data-cleaned/communes/communes.geojson"
+    output_source = "./data/"
+
+    pipeline = DataPipeline(commune_source, geojson_source, output_source)
+    pipeline.pipeline_running(scales=(1, 10, 100))
@@ -4,9 +4,25 @@ import asyncio
 import time
 import concurrent.futures
 import cachetools
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.dataschema import read_dtypes, pad_codes
+from datacommon.datametrics import METRICS
+from datacommon.datanormalize import normalize_city
+from datacommon.dataclient import service_client
+from datacommon.datadelta import DataDelta, code_version
 
 cache = cachetools.LRUCache(maxsize=1000)
 
+# Version du code, les lignes mémorisées par une autre version sont retraitées
+VERSION = code_version(os.path.abspath(__file__))
+# Groupes géocodés avant le filtrage des échecs, conservés pour corriger une année livrée
+GROUPS = 'cleaning-groups'
+KEYS = ['ESPECE', 'CODE POSTAL', 'VILLE_2']
+
 # Chargement des données
 class DataLoading():
     
@@ -14,16 +30,18 @@ class DataLoading():
     Classe pour charger les données à partir d'un fichier Excel
     """
     
-    def __init__(self, excel_source):
+    def __init__(self, excel_source, year=2017):
         
         """
         Initialisation des attributs de l'instance DataLaoding
         
         Args : 
             excel_source (str) : Chemin relatif ou absolu qui pointe vers le fichier Excel
+            year (int) : Année à charger, qui correspond au nom de la feuille Excel
         """
 
         self.excel_source = excel_source
+        self.year = year
     
     def loading_from_xlsx(self):
         
@@ -39,8 +57,8 @@ class DataLoading():
             loader = DataLoading("data.xlsx")
             data = loader.loading_from_xlsx()
         """
-        data = pd.read_excel(self.excel_source, sheet_name="2017")
-        return data
+        data = pd.read_excel(self.excel_source, sheet_name=str(self.year), dtype=read_dtypes())
+        return pad_codes(data)
     
     
 # Traitement de nettoyage
@@ -78,9 +96,9 @@ class DataProcessing():
         """
         
         df = self.dataset.copy()
-        df['VILLE'] = df['VILLE'].str.lower().str.replace("-", " ").str.replace(",", "")
-        df['CODE POSTAL'] = df['CODE POSTAL'].apply(lambda x: x[1:] + '0' if x.startswith('00') else x)
-        df_group = df.groupby(['ESPECE', 'CODE POSTAL', 'VILLE'])['POPULATION'].sum().reset_index()
+        df['VILLE'] = normalize_city(df['VILLE'])
+        df['CODE POSTAL'] = df['CODE POSTAL'].where(~df['CODE POSTAL'].str.startswith('00'), df['CODE POSTAL'].str[1:] + '0')
+        df_group = df.groupby(['ESPECE', 'CODE POSTAL', 'VILLE'], observed=True)['POPULATION'].sum().reset_index()
         return df_group
 
     @staticmethod
@@ -105,7 +123,9 @@ class DataProcessing():
         # Présence et gestion du cache
         cached_result = cache.get(cache_key)
         if cached_result:
+            METRICS.count('cache_hits')
             return cached_result
+        METRICS.count('cache_misses')
 
         # Paramétrage pour la requête du géocodage
         params = {
@@ -145,20 +165,62 @@ class DataProcessing():
 class DataExporting():
     
     """
-    Classe pour l'exportation des données au format Excel'
+    Classe pour l'exportation des données vers le magasin intermédiaire et, en option, au format Excel
     """
     
-    def __init__(self, output_file):
+    def __init__(self, output_file=None):
         
         """
         Initialisation des attributs de l'instance DataExporting
         
         Args:
-            output_file (str): Chemin relatif ou absolu qui pointe vers le fichier Excel.
+            output_file (str): Chemin relatif ou absolu qui pointe vers le rapport Excel, aucun rapport si None.
         """
         
         self.output_file = output_file
     
+    def export_store(self, df, year):
+        
+        """
+        Fonction d'exportation d'un DataFrame Pandas vers le magasin intermédiaire (étape "cleaning").
+
+        Args:
+            df (pd.DataFrame): Le DataFrame à exporter.
+            year (int): Année des données.
+
+        Returns:
+            None
+
+        Example:
+            exporter = DataExporting()
+            exporter.export_store(dataframe_to_export, 2017)
+        """
+        
+        if 'COORDONNEES' in df:
+            df = df.assign(COORDONNEES=self.format_coordinates(df['COORDONNEES']))
+        DataStore().write(df, 'cleaning', year)
+    
+    @staticmethod
+    def format_coordinates(coordinates):
+        
+        """
+        Fonction de mise en forme des coordonnées du géocodeur en texte "[lon, lat]", comme dans les CSV
+        lus par datagrouping : une liste serait écrite dans le magasin comme un tableau, relu sous forme
+        de ndarray.
+
+        Args:
+            coordinates (pd.Series): Coordonnées en listes (ou ndarray relus du magasin), en texte ou manquantes.
+
+        Returns:
+            pd.Series: Les coordonnées en texte, les manquantes inchangées.
+
+        Example:
+            DataExporting.format_coordinates(pd.Series([[4.92, 46.15]]))  # "[4.92, 46.15]"
+        """
+        
+        return coordinates.map(lambda coord: coord if isinstance(coord, str) else
+                               '[' + ', '.join(str(float(value)) for value in coord) + ']', na_action='ignore')
+    
     def export_xlsx(self, df):
         
         """
@@ -188,73 +250,148 @@ class DataPipeline(DataLoading, DataProcessing, DataExporting):
         - exportation des données
     """
     
-    def __init__(self, excel_source, output_file):
+    def __init__(self, excel_source, output_file=None, year=2017):
         
         """
         Initialise une instance de la classe DataPipeline.
 
         Args:
             excel_source (str) : Chemin relatif ou absolu qui pointe vers le fichier Excel
-            output_file (str): Chemin relatif ou absolu qui pointe vers le fichier Excel.
+            output_file (str): Chemin relatif ou absolu qui pointe vers le rapport Excel, aucun rapport si None.
+            year (int) : Année à traiter
         """
         
-        super().__init__(excel_source)
+        super().__init__(excel_source, year)
         self.output_file = output_file
 
-    # Run du script
-    async def async_pipeline_running(self):
+    async def geocoding(self, group_data):
         
         """
-        Fonction asynchrone qui exécute le pipeline de traitement de données.
+        Fonction asynchrone de géocodage par lot des groupes, par le service résident s'il est lancé.
 
-        Returns:
-            None
+        Args:
+            group_data (pd.DataFrame): Groupes avec 'VILLE' et 'CODE POSTAL'.
 
-        Example:
-            pipeline = DataPipeline("data.xlsx", "output.xlsx")
-            asyncio.run(pipeline.async_pipeline_running())
+        Returns:
+            pd.DataFrame: Les groupes avec 'COORDONNEES', 'VILLE' (corrigée) et 'VILLE_2' (d'origine).
         """
         
-        self.dataset = self.loading_from_xlsx()[:50]
-        process = DataProcessing(self.dataset)
-        group_data = process.data_format()
-
         # Définition de la taille de lot pour le traitement asynchrone
         batch_size = 50
 
         coord_list = []
         ville_list = []
-        ville_2_list = []
+
+        # Service résident s'il est lancé : son cache de géocodage est conservé d'une exécution à l'autre
+        service = service_client()
 
         # Utilisation d'un client HTTP asynchrone
         async with httpx.AsyncClient() as client:
-            
+        
             # Boucle sur le traitement par lot des données
             for i in range(0, len(group_data), batch_size):
                 batch = group_data[i:i+batch_size]
 
-                tasks = []
+                if service:
+                    rows = batch[['VILLE', 'CODE POSTAL']].astype(object).where(batch[['VILLE', 'CODE POSTAL']].notna(), None)
+                    batch_results = service.geocode(rows.to_dict('records'))
+                else:
+                    tasks = []
 
-                for _, row in batch.iterrows():
-                    tasks.append(process.geocoder(row))
+                    for _, row in batch.iterrows():
+                        tasks.append(DataProcessing.geocoder(row))
 
-                # Traitement en parallèle par lot
-                batch_results = await asyncio.gather(*tasks)
+                    # Traitement en parallèle par lot
+                    batch_results = await asyncio.gather(*tasks)
 
                  # Collecte des résultats de gécodage par lot
                 for result in batch_results:
                     if result:
-                        coord, ville, ville_2 = result
+                        coord, ville, _ = result
                         coord_list.append(coord)
                         ville_list.append(ville)
-                        ville_2_list.append(ville_2)
 
+        # Nom d'origine conservé même en cas d'échec, c'est la clé des groupes d'une livraison à l'autre
+        group_data['VILLE_2'] = group_data['VILLE']
         group_data['COORDONNEES'] = coord_list
         group_data['VILLE'] = ville_list
-        group_data['VILLE_2'] = ville_2_list
+        return group_data
+
+    def patch_groups(self, groups, added, removed, rows):
+        
+        """
+        Fonction de correction des groupes géocodés d'une année déjà livrée : les populations
+        des lignes ajoutées sont additionnées, celles des lignes retirées soustraites, et seules
+        les villes jamais géocodées sont à géocoder.
+
+        Args:
+            groups (pd.DataFrame): Les groupes géocodés de la livraison précédente.
+            added (pd.DataFrame): Les lignes ajoutées depuis.
+            removed (pd.DataFrame): Les lignes retirées depuis.
+            rows (pd.DataFrame): Toutes les lignes de la livraison, pour retirer les groupes vides.
+
+        Returns:
+            tuple: Les groupes dont la ville est déjà géocodée, et ceux à géocoder.
+        """
+        
+        # Nom normalisé de la ville d'origine, clé des groupes géocodés
+        def contributions(data):
+            return DataProcessing(data).data_format().rename(columns={'VILLE': 'VILLE_2'})
+
+        patched = DataDelta.patch(groups, contributions(added), contributions(removed), KEYS, ['POPULATION'],
+                                  present=contributions(rows))
+        # Les géocodages en échec sont retentés
+        return DataDelta.reuse(patched.drop(columns=['COORDONNEES', 'VILLE']), groups[groups['COORDONNEES'].notna()],
+                               ['VILLE_2', 'CODE POSTAL'], ['COORDONNEES', 'VILLE'])
+
+    # Run du script
+    async def async_pipeline_running(self, delta=True):
+        
+        """
+        Fonction asynchrone qui exécute le pipeline de traitement de données.
+
+        Quand la livraison précédente de l'année est dans le magasin, seules les lignes
+        ajoutées ou retirées depuis sont traitées.
+
+        Args:
+            delta (bool): Traiter seulement les lignes modifiées depuis la livraison précédente.
+
+        Returns:
+            None
+
+        Example:
+            pipeline = DataPipeline("data.xlsx", "output.xlsx")
+            asyncio.run(pipeline.async_pipeline_running())
+        """
+        
+        with METRICS.stage('cleaning', self.year) as metrics:
+            self.dataset = self.loading_from_xlsx()[:50]
+            columns = list(self.dataset.columns)
+            metrics.rows_in = len(self.dataset)
+
+            data_delta = DataDelta('cleaning', VERSION)
+            previous = data_delta.previous(self.year) if delta and DataStore().exists(GROUPS, self.year) else None
+
+            if previous is None:
+                process = DataProcessing(self.dataset)
+                group_data = await self.geocoding(process.data_format())
+            else:
+                added, removed, kept = data_delta.diff(self.dataset, previous, columns)
+                print(f"=========== DELTA for {self.year}: {len(added)} added, {len(removed)} removed ===========")
+                known, unknown = self.patch_groups(DataStore().read(GROUPS, self.year), added, removed, self.dataset)
+                unknown = await self.geocoding(unknown.assign(VILLE=unknown['VILLE_2']))
+                group_data = pd.concat([known, unknown], ignore_index=True)[known.columns]
         
-        group_data = group_data.dropna(subset=['VILLE', 'COORDONNEES', 'VILLE_2'])
-        self.export_xlsx(group_data)
+            group_data['COORDONNEES'] = self.format_coordinates(group_data['COORDONNEES'])
+            metrics.match(group_data['VILLE'].notna().sum(), len(group_data))
+            DataStore().write(group_data, GROUPS, self.year)
+            data_delta.commit(self.dataset, self.year, columns)
+
+            group_data = group_data.dropna(subset=['VILLE', 'COORDONNEES', 'VILLE_2'])
+            metrics.rows_out = len(group_data)
+            self.export_store(group_data, self.year)
+            if self.output_file:
+                self.export_xlsx(group_data)
         
 if __name__ == "__main__":
     
@@ -269,3 +406,4 @@ if __name__ == "__main__":
     execution_time = end_time - start_time
 
     print(f"Le script a été exécuté en {execution_time} secondes.")
+    METRICS.export('datacleaning')
@@ -1,10 +1,26 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from rapidfuzz import utils, fuzz, process
+from rapidfuzz import fuzz
 import os
 from joblib import Parallel, delayed
 import time
-import re
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.dataschema import ENCODING, read_dtypes, pad_codes, apply_schema
+from datacommon.dataquery import DataQuery
+from datacommon.datametrics import METRICS
+from datacommon.datanormalize import normalize_city
+from datacommon.datamatch import CommuneMatcher
+from datacommon.dataclient import RemoteMatcher, service_client
+from datacommon.datadelta import DataDelta, FINGERPRINT, code_version, fingerprint
+
+# Version du code, les lignes mémorisées par une autre version sont retraitées
+VERSION = code_version(os.path.abspath(__file__))
+# Groupes par ville avec leur commune, conservés pour corriger une année livrée
+GROUPS = 'grouping-groups'
 
 class DataLoading():
     """
@@ -24,20 +40,36 @@ class DataLoading():
 
     def loading_from_xlsx(self):
         """
-        Load data from CSV files within the data source directory.
+        Load the cleaned data of every year by chunks.
+
+        Each year is read from the "cleaning" stage of the intermediate store
+        when it has been written there, otherwise from the CSV file of the year
+        within the data source directory.
 
         Returns:
-            tuple: DataFrames for different years (e.g., df2017, df2018, df2019).
+            tuple: Chunk iterators for different years (e.g., df2017, df2018, df2019).
         """
         if os.path.exists(self.data_source):
-            df2017 = pd.read_csv(os.path.join(self.data_source, "2017.csv"), header=0, sep=',', chunksize=1000)
-            df2018 = pd.read_csv(os.path.join(self.data_source, "2018.csv"), header=0, sep=',', chunksize=1000)
-            df2019 = pd.read_csv(os.path.join(self.data_source, "2019.csv"), header=0, sep=',', chunksize=1000)
-            df2020 = pd.read_csv(os.path.join(self.data_source, "2020.csv"), header=0, sep=',', chunksize=1000)
-            return df2017, df2018, df2019, df2020
+            return tuple(self.loading_year(year) for year in [2017, 2018, 2019, 2020])
         else:
             return f"File from {self.data_source} doesn't exist"
 
+    def loading_year(self, year):
+        """
+        Load the cleaned data of a single year by chunks.
+
+        Args:
+            year (int): Year of the data.
+
+        Returns:
+            iterator: Chunks of 1000 rows of the cleaned data.
+        """
+        store = DataStore()
+        if store.exists('cleaning', year):
+            return (apply_schema(chunk) for chunk in store.read_chunks('cleaning', year, chunksize=1000))
+        return (pad_codes(chunk) for chunk in pd.read_csv(os.path.join(self.data_source, f"{year}.csv"), header=0, sep=',',
+                                                          chunksize=1000, dtype=read_dtypes(), encoding=ENCODING))
+
     def loading_from_geojson(self):
         """
         Load GeoJSON data from the specified source file.
@@ -56,92 +88,87 @@ class DataProcessing():
     This class handles data processing and cleaning.
     """
 
-    def __init__(self, data, geojson):
+    def __init__(self, data, geojson, matcher=None, engine=None):
         """
         Initializes the DataProcessing instance.
 
         Args:
             data (pd.DataFrame): The data to be processed.
             geojson (geopandas.GeoDataFrame): GeoJSON data for additional information.
+            matcher (RemoteMatcher): Matcher of the resident service, a CommuneMatcher on geojson is built if None.
+            engine (str): Engine of the fuzzy matching, 'rapidfuzz' or 'ngram', the default of datamatch if None.
         """
         self.data = data
         self.geojson = geojson
+        self.matcher = matcher
+        self.engine = engine
 
-    def verify_corres(self, chunk, val):
+    def verify_corres(self, chunk):
         """
         Verify and clean the correspondence of data.
 
+        The city returned by the geocoder ('VILLE') is compared with the city
+        of the I-CAD file ('VILLE_2'), both normalized; when they are too
+        different the geocoding is discarded.
+
         Args:
             chunk (pd.DataFrame): Data chunk to be processed.
-            val (int): Offset value for indexing.
 
         Returns:
             list: Processed data chunks.
         """
-        processed_chunks = []
-        for i, ville in enumerate(chunk['VILLE']):
-            i = i + val
-            original_ville = chunk.loc[i, 'VILLE_2']
-            original_ville = original_ville.replace('-', ' ').replace('/', 'sur')
-            ville = ville.replace('st', 'saint').replace('-', ' ')
-
-            if len(ville.split()) != len(original_ville.split()):
-                original_ville = ' '.join(original_ville.split())
-
-            original_ville = ''.join([l for l in original_ville if not l.isdigit()])
-            original_ville = original_ville.replace('st', 'saint')
-            original_ville = original_ville.replace('cedex', '')
-            original_ville = re.sub(r"\(.*?\)", "", original_ville)
+        ville = normalize_city(chunk['VILLE']).fillna('')
+        original_ville = normalize_city(chunk['VILLE_2']).fillna('')
+        scores = np.array([fuzz.ratio(a, b) for a, b in zip(ville, original_ville)])
 
-            if fuzz.ratio(ville, original_ville, processor=utils.default_process) < 80:
-                chunk.loc[i, 'VILLE'] = ''
-                chunk.loc[i, 'COORDONNEES'] = ''
+        chunk.loc[scores < 80, ['VILLE', 'COORDONNEES']] = ''
 
-        # Append the processed chunk to the list of processed chunks
-        processed_chunks.append(chunk)
-
-        return processed_chunks
+        return [chunk]
     
     def verify_with_geojson(self, verify_data):
-        geojson_list = self.geojson['nom_comm'].str.replace('-', ' ').str.replace('/', 'sur').str.replace('st', 'saint')
-        processed_list = [utils.default_process(name) for name in geojson_list]
-        
-        for (i, value) in enumerate(verify_data['VILLE_2']):
-            value = value.replace('-', '').replace('/', 'sur').replace('st', 'saint').replace('-', ' ').replace('cedex', '')
-            value = ''.join([l for l in value if not l.isdigit()])
-            value = re.sub(r"\(.*?\)", "", value)
-            
-            match = process.extractOne(value, processed_list, processor=utils.default_process, score_cutoff=93)
+        """
+        Search the commune of every 'VILLE_2' among the communes of the GeoJSON.
 
-            if match:
-                verify_data.loc[i, 'VILLE_3'] = self.geojson.loc[match[2], 'nom_comm']
-                verify_data.loc[i, 'CODE POSTAL'] = self.geojson.loc[match[2], 'postal_code']
-                verify_data.loc[i, 'CODE INSEE'] = self.geojson.loc[match[2], 'insee_com']
-                verify_data.loc[i, 'LON'] = self.geojson.loc[match[2], 'geo_point_2d']['lon']
-                verify_data.loc[i, 'LAT'] = self.geojson.loc[match[2], 'geo_point_2d']['lat']
-                verify_data.loc[i, 'COORDONNEES'] = f'[{self.geojson.loc[match[2], "geo_point_2d"]["lon"]}, {self.geojson.loc[match[2], "geo_point_2d"]["lat"]}]'
+        Former communes merged into a "commune nouvelle" are resolved through
+        the Insee table before any fuzzy matching, see CommuneMatcher.
 
-        return verify_data
+        Args:
+            verify_data (pd.DataFrame): Grouped data.
 
-    def group(self, verified_data):
+        Returns:
+            pd.DataFrame: Data with 'VILLE_3', the codes and the coordinates of the matched communes.
+        """
+        if self.matcher is None:
+            self.matcher = CommuneMatcher(self.geojson, score_cutoff=93, engine=self.engine)
+
+        positions = self.matcher.match(verify_data['VILLE_2'])
+        return self.matcher.assign(verify_data, positions, 'VILLE_3')
+
+    def group(self, verified_data, backend='pandas'):
         """
         Group and aggregate data based on 'VILLE' and 'ESPECE'.
 
         Args:
             verified_data (pd.DataFrame): Processed data with 'VILLE' cleaned.
+            backend (str): 'pandas', or 'duckdb' to aggregate out of core.
 
         Returns:
             pd.DataFrame: Grouped data with population sums for different species.
         """
-        verified_data = verified_data[verified_data['VILLE'] != '']
-        pivoted = pd.pivot_table(verified_data, values='POPULATION', index=['VILLE'], columns=['ESPECE'], aggfunc='sum')
-        pivoted = pivoted.reset_index()
-        pivoted = pivoted.fillna(0)
-
-        add_ville_2 = verified_data.groupby('VILLE')['VILLE_2'].first().reset_index()
-        add_coordonnees = verified_data.groupby('VILLE')['COORDONNEES'].first().reset_index()
-        grouped_data = pd.merge(pivoted, add_ville_2, on='VILLE')
-        grouped_data = pd.merge(grouped_data, add_coordonnees, on='VILLE')
+        if backend == 'duckdb':
+            with DataQuery() as query:
+                grouped_data = query.pivot_species(verified_data, ['VILLE'], 'ESPECE', 'POPULATION', ['VILLE_2', 'COORDONNEES'])
+        else:
+            verified_data = verified_data[verified_data['VILLE'] != '']
+            pivoted = pd.pivot_table(verified_data, values='POPULATION', index=['VILLE'], columns=['ESPECE'], aggfunc='sum', observed=True)
+            pivoted.columns = pivoted.columns.astype(str)
+            pivoted = pivoted.reset_index()
+            pivoted = pivoted.fillna(0)
+
+            add_ville_2 = verified_data.groupby('VILLE')['VILLE_2'].first().reset_index()
+            add_coordonnees = verified_data.groupby('VILLE')['COORDONNEES'].first().reset_index()
+            grouped_data = pd.merge(pivoted, add_ville_2, on='VILLE')
+            grouped_data = pd.merge(grouped_data, add_coordonnees, on='VILLE')
         
         # Mise à jour du champs LAT et LON
         grouped_data['LON'] = grouped_data['COORDONNEES'].str.split().str[0].str.replace('[', '').str.replace(',', '')
@@ -172,7 +199,8 @@ class DataProcessing():
             pd.DataFrame: Data with empty values grouped by 'VILLE_2'.
         """
         verified_data = verified_data[verified_data['VILLE'] == '']
-        pivoted = pd.pivot_table(verified_data, values='POPULATION', index=['VILLE_2'], columns=['ESPECE'], aggfunc='sum')
+        pivoted = pd.pivot_table(verified_data, values='POPULATION', index=['VILLE_2'], columns=['ESPECE'], aggfunc='sum', observed=True)
+        pivoted.columns = pivoted.columns.astype(str)
         pivoted = pivoted.reset_index()
         pivoted = pivoted.fillna(0)
 
@@ -184,6 +212,54 @@ class DataProcessing():
 
         return empty_values
 
+    def patch_groups(self, groups, added, removed, rows):
+        """
+        Patch the groups of group and add_empty_values with the added and removed rows.
+
+        Args:
+            groups (pd.DataFrame): Groups of the previous delivery, with their commune.
+            added (pd.DataFrame): Added rows, through verify_corres.
+            removed (pd.DataFrame): Removed rows, as stored.
+            rows (pd.DataFrame): All the rows of the delivery, to drop the groups left empty.
+
+        Returns:
+            pd.DataFrame: Patched groups, by 'VILLE' then by 'VILLE_2' for the rows without 'VILLE'.
+        """
+        patched = []
+        for key, selected, aggregate in (('VILLE', lambda data: data['VILLE'] != '', self.group),
+                                         ('VILLE_2', lambda data: data['VILLE'] == '', self.add_empty_values)):
+            contributions = [aggregate(data) if selected(data).any() else pd.DataFrame(columns=[key, 'CHAT', 'CHIEN'])
+                             for data in (added, removed)]
+            patched.append(DataDelta.patch(groups[selected(groups)], *contributions, [key], ['CHAT', 'CHIEN'],
+                                           present=rows[selected(rows)]))
+        return pd.concat(patched, ignore_index=True)
+
+    def reuse_matches(self, groups, matches):
+        """
+        Copy to the groups the commune already found for their 'VILLE_2'.
+
+        Args:
+            groups (pd.DataFrame): Groups to match.
+            matches (pd.DataFrame): Groups of the previous delivery, through verify_with_geojson.
+
+        Returns:
+            tuple: Groups with a known 'VILLE_2' and their commune, and groups left to match.
+        """
+        if 'VILLE_3' not in matches:
+            return groups.iloc[:0], groups
+
+        table = matches.drop_duplicates('VILLE_2').set_index('VILLE_2')
+        known = groups['VILLE_2'].isin(table.index)
+        reused = groups[known].copy()
+        for column in ['VILLE_3', 'CODE POSTAL', 'CODE INSEE']:
+            reused[column] = reused['VILLE_2'].map(table[column])
+
+        # Les groupes sans commune gardent leurs propres coordonnées
+        matched = reused['VILLE_3'].notna()
+        for column in ['LON', 'LAT', 'COORDONNEES']:
+            reused.loc[matched, column] = reused.loc[matched, 'VILLE_2'].map(table[column])
+        return reused, groups[~known]
+
 class DataExporting():
     """
     This class handles exporting processed data.
@@ -194,28 +270,27 @@ class DataExporting():
         Initializes the DataExporting instance.
 
         Args:
-            output_sheet (str): Name of the output sheet.
+            output_sheet (str): Name of the output sheet, i.e. the year of the data.
             final_data (pd.DataFrame): Final processed data.
         """
         self.output_sheet = output_sheet
         self.final_data = final_data
 
-    def export_csv(self):
+    def export_store(self):
         """
-        Export the final data to an Excel file.
-
-        Saves the data to an Excel file with optional appending.
+        Export the final data to the "grouping" stage of the intermediate store.
+        """
+        DataStore().write(self.final_data, 'grouping', self.output_sheet)
 
+    def export_xlsx(self):
+        """
+        Export the final data to an Excel report, one workbook per year.
         """
         if not os.path.exists('./result/'):
             os.mkdir('./result/')
 
-        if os.path.isfile(f'./result/{self.output_sheet}.xlsx'):
-            with pd.ExcelWriter(f'./result/{self.output_sheet}.xlsx', engine='openpyxl', mode="a") as writer:
-                self.final_data.to_excel(writer, sheet_name=str(self.output_sheet), header=True, index=True)
-        else:
-            with pd.ExcelWriter(f'./result/{self.output_sheet}.xlsx', engine='openpyxl', mode="w") as writer:
-                self.final_data.to_excel(writer, sheet_name=str(self.output_sheet), header=True, index=True)
+        with pd.ExcelWriter(f'./result/{self.output_sheet}.xlsx', engine='openpyxl', mode="w") as writer:
+            self.final_data.to_excel(writer, sheet_name=str(self.output_sheet), header=True, index=True)
 
 class DataPipeline(DataLoading, DataProcessing, DataExporting):
     """
@@ -225,38 +300,81 @@ class DataPipeline(DataLoading, DataProcessing, DataExporting):
     def __init__(self):
         super().__init__(data_source, geojson_source)
 
-    def run_process(self, data_load, df, year):
-        geojson = data_load.loading_from_geojson()
-
-        processed_data = []
-        val = 0
-        data_process = DataProcessing(df, geojson)
-        print(f"=========== GROUP DATA for {year} ===========")
-        for chunk in df:  # Iterate through chunks
-            verified_chunk = data_process.verify_corres(chunk, val)
-            processed_data.extend(verified_chunk)
-            val += 100
+    def run_process(self, data_load, df, year, report=False, backend='pandas', delta=True, engine=None):
+        """
+        Group, match and export the data of a year.
 
-        verified_data = pd.concat(processed_data, ignore_index=True)
+        When the previous delivery of the year is in the store, only the rows
+        added since go through verify_corres, the stored groups are patched
+        with the added and removed rows, and only the cities never seen are
+        matched with the GeoJSON.
 
-        print(f"=========== GROUP DATA for {year} ===========")
-        grouped_data = data_process.group(verified_data)
-        
-        print(f"=========== ADD EMPTY VALUES for {year} ===========")
-        empty_values = data_process.add_empty_values(verified_data)
-        
-        print(f"=========== SEARCH CORRES WITH GEOJSON FOR {year} ===========")
-        grouped_data2 = data_process.verify_with_geojson(grouped_data)
-        empty_values2 = data_process.verify_with_geojson(empty_values)
-        
-        data_concatenated = pd.concat([grouped_data2, empty_values2])
-        
-        print(f"=========== FINAL GROUPING FOR {year} ===========")
-        data_final = data_process.final_grouping(data_concatenated)
-        
-        data_export = DataExporting(year, data_final)
-        print(f"=========== EXPORT DATA for {year} ===========")
-        data_export.export_csv()
+        Args:
+            data_load (DataLoading): Loader of the GeoJSON.
+            df (iterable): Chunks of the cleaned data.
+            year (int): Year of the data.
+            report (bool): Also export an Excel report.
+            backend (str): 'pandas', or 'duckdb' to aggregate out of core.
+            delta (bool): Process only the rows changed since the previous delivery.
+            engine (str): Engine of the fuzzy matching, 'rapidfuzz' or 'ngram', the default of datamatch if None.
+        """
+        with METRICS.stage('grouping', year) as metrics:
+            chunks = list(df)
+            data = pd.concat(chunks, ignore_index=True)
+            columns = list(data.columns)
+            metrics.rows_in = len(data)
+
+            data_delta = DataDelta('grouping', VERSION)
+            previous = data_delta.previous(year) if delta and DataStore().exists(GROUPS, year) else None
+
+            processed_data = []
+            data_process = DataProcessing(data, None, engine=engine)
+            print(f"=========== GROUP DATA for {year} ===========")
+            if previous is None:
+                for chunk in chunks:  # Iterate through chunks
+                    verified_chunk = data_process.verify_corres(chunk)
+                    processed_data.extend(verified_chunk)
+
+                # Empreinte des lignes livrées, avant que verify_corres ne vide 'VILLE' et 'COORDONNEES'
+                verified_data = pd.concat(processed_data, ignore_index=True).assign(**{FINGERPRINT: fingerprint(data, columns).to_numpy()})
+                grouped_data = data_process.group(verified_data, backend)
+
+                print(f"=========== ADD EMPTY VALUES for {year} ===========")
+                empty_values = data_process.add_empty_values(verified_data)
+                groups = pd.concat([grouped_data, empty_values], ignore_index=True)
+                known, unknown = groups.iloc[:0], groups
+            else:
+                added, removed, kept = data_delta.diff(data, previous, columns)
+                print(f"=========== DELTA for {year}: {len(added)} added, {len(removed)} removed ===========")
+                added = data_process.verify_corres(added)[0] if len(added) else added
+                verified_data = pd.concat([kept, added], ignore_index=True)
+
+                matches = DataStore().read(GROUPS, year)
+                groups = data_process.patch_groups(matches, added, removed, verified_data)
+                known, unknown = data_process.reuse_matches(groups, matches)
+
+            print(f"=========== SEARCH CORRES WITH GEOJSON FOR {year} ===========")
+            if len(unknown):
+                # Le service résident évite de recharger les communes et de reconstruire l'index
+                client = service_client()
+                data_process.matcher = RemoteMatcher(client, score_cutoff=93, engine=engine) if client else None
+                data_process.geojson = data_load.loading_from_geojson() if data_process.matcher is None else None
+                unknown = data_process.verify_with_geojson(unknown)
+
+            data_concatenated = pd.concat([known, unknown], ignore_index=True)
+            metrics.match(data_concatenated['VILLE_3'].notna().sum() if 'VILLE_3' in data_concatenated else 0, len(data_concatenated))
+            
+            print(f"=========== FINAL GROUPING FOR {year} ===========")
+            data_final = data_process.final_grouping(data_concatenated)
+            metrics.rows_out = len(data_final)
+            
+            data_export = DataExporting(year, data_final)
+            print(f"=========== EXPORT DATA for {year} ===========")
+            data_export.export_store()
+            DataStore().write(data_concatenated, GROUPS, year)
+            data_delta.commit(verified_data, year)
+            if report:
+                data_export.export_xlsx()
 
     def pipeline_running(self, data_source, geojson_source):
         """
@@ -277,6 +395,7 @@ class DataPipeline(DataLoading, DataProcessing, DataExporting):
         Parallel(n_jobs=4, prefer="threads")(delayed(DataPipeline().run_process)(data_load, df, years[year]) for year, df in enumerate(df_list))
         end = time.time()
         print('{:.4f} s'.format(end - start))
+        METRICS.export('datagrouping')
 
 if __name__ == "__main__":
     data_source = "./data-cleaned/"
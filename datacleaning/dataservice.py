@@ -0,0 +1,166 @@
+import argparse
+import asyncio
+import geopandas as gpd
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datamatch import ENGINE, CommuneMatcher
+from datacleaning import DataProcessing as CleaningProcessing
+
+class DataService():
+    """
+    Class holding the reference data of the matching and geocoding, kept in memory.
+
+    The communes are read once, a CommuneMatcher is built per score cutoff
+    and engine on first use and keeps its memo between requests, and the geocoding
+    goes through DataProcessing.geocoder of datacleaning, with its cache.
+    """
+
+    def __init__(self, geojson_source):
+        """
+        Initializes the DataService instance.
+
+        Args:
+            geojson_source (str): Path to the GeoJSON file of the communes.
+        """
+        self.geojson_source = geojson_source
+        self.geojson = gpd.read_file(geojson_source)
+        self.matchers = {}
+        self.lock = threading.Lock()
+        # Les requêtes arrivent sur plusieurs threads : le memo et les statistiques des matchers ne sont pas partagés sans verrou
+        self.matching = threading.Lock()
+        self.started_at = time.time()
+
+    def matcher(self, score_cutoff, engine=ENGINE):
+        """
+        Matcher of a score cutoff and an engine, built on first use.
+
+        Args:
+            score_cutoff (float): Minimum score of the fuzzy tier.
+            engine (str): Engine of the fuzzy tier, 'rapidfuzz' or 'ngram'.
+
+        Returns:
+            CommuneMatcher: Matcher shared by the requests.
+        """
+        with self.lock:
+            if (score_cutoff, engine) not in self.matchers:
+                self.matchers[(score_cutoff, engine)] = CommuneMatcher(self.geojson, score_cutoff=score_cutoff, engine=engine)
+            return self.matchers[(score_cutoff, engine)]
+
+    def match(self, payload):
+        """
+        Match a batch of cities, one batch at a time.
+
+        Args:
+            payload (dict): 'cities', 'postal_codes' (optional), 'score_cutoff' and 'engine' (optional).
+
+        Returns:
+            dict: 'positions' of every city and the records of the matched 'communes'.
+        """
+        matcher = self.matcher(float(payload.get('score_cutoff', 90)), payload.get('engine') or ENGINE)
+        cities = pd.Series(payload['cities'], dtype=object)
+        postal_codes = payload.get('postal_codes')
+        with self.matching:
+            positions = matcher.match(cities, None if postal_codes is None else pd.Series(postal_codes, dtype=object))
+            communes = matcher.communes(positions)
+        return {'positions': positions.tolist(), 'communes': communes}
+
+    def geocode(self, payload):
+        """
+        Geocode a batch of cities with the BAN.
+
+        Args:
+            payload (dict): 'rows', each with 'VILLE' and 'CODE POSTAL'.
+
+        Returns:
+            dict: 'results', the coordinates, corrected name and original name of every city.
+        """
+        async def gather():
+            return await asyncio.gather(*(CleaningProcessing.geocoder(row) for row in payload['rows']))
+
+        return {'results': [list(result) for result in asyncio.run(gather())]}
+
+    def health(self):
+        """
+        State of the service.
+
+        Returns:
+            dict: Source and number of communes, matchers built and uptime.
+        """
+        return {'status': 'ok', 'geojson': self.geojson_source, 'communes': len(self.geojson),
+                'matchers': {f'{engine}:{cutoff:g}': dict(matcher.statistics) for (cutoff, engine), matcher in self.matchers.items()},
+                'uptime_s': round(time.time() - self.started_at, 1)}
+
+def handler(service):
+    """
+    HTTP handler bound to a service.
+
+    Args:
+        service (DataService): Service answering the requests.
+
+    Returns:
+        type: Subclass of BaseHTTPRequestHandler.
+    """
+    class DataHandler(BaseHTTPRequestHandler):
+        ROUTES = {'/match': service.match, '/geocode': service.geocode}
+
+        def answer(self, status, body):
+            content = json.dumps(body, default=str).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.answer(200, service.health())
+            else:
+                self.answer(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            route = self.ROUTES.get(self.path)
+            if route is None:
+                self.answer(404, {'error': f'unknown path {self.path}'})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if not isinstance(payload, dict):
+                    raise TypeError(f'expected a JSON object, got {type(payload).__name__}')
+                self.answer(200, route(payload))
+            except (KeyError, TypeError, ValueError) as error:
+                self.answer(400, {'error': repr(error)})
+
+        def log_message(self, format, *args):
+            # Une ligne par lot reçu suffit, sans l'horodatage du serveur
+            print(f"{self.command} {self.path} {args[1] if len(args) > 1 else ''}")
+
+    return DataHandler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Service local de correspondance des communes et de géocodage")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--geojson', default='./data-cleaned/communes/communes.geojson')
+    arguments = parser.parse_args()
+
+    start = time.time()
+    service = DataService(arguments.geojson)
+    # Index du seuil de datacleaning2 et de datagrouping construits dès le démarrage
+    service.matcher(90.0)
+    service.matcher(93.0)
+    print('{:.4f} s'.format(time.time() - start))
+
+    server = ThreadingHTTPServer((arguments.host, arguments.port), handler(service))
+    print(f"=========== SERVICE LISTENING ON http://{arguments.host}:{arguments.port} ===========")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,11 +1,20 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from rapidfuzz import process, utils
-from unidecode import unidecode
+from rapidfuzz import fuzz
 import os
 import rapidfuzz
+import sys
 from joblib import Parallel, delayed
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.dataschema import ENCODING, read_dtypes
+from datacommon.datametrics import METRICS
+from datacommon.dataquery import DataQuery
+from datacommon.datanormalize import normalize_city
+from datacommon.datamatch import ENGINE, search_engine
+
 # Chargement des données
 class DataLaoding():
     def __init__(self, data_source, geojson_source):
@@ -14,7 +23,8 @@ class DataLaoding():
 
     def loading_from_xlsx(self):
         if os.path.exists(self.data_source) == True:
-            df2017 = pd.read_csv(os.path.join(self.data_source, "2017.csv"), header=0, sep=',', nrows=100, chunksize = 20)
+            df2017 = pd.read_csv(os.path.join(self.data_source, "2017.csv"), header=0, sep=',', nrows=100, chunksize = 20,
+                                 dtype=read_dtypes(), encoding=ENCODING)
             # df2018 = pd.read_csv(os.path.join(self.data_source, "2018.csv"), header=0, sep=',', nrows=300, chunksize = 50)
             # df2019 = pd.read_csv(os.path.join(self.data_source, "2019.csv"), header=0, sep=',', nrows=300, chunksize = 50)
             # df2020 = pd.read_csv(os.path.join(self.data_source, "2020.csv"), header=0, sep=',', nrows=300, chunksize = 50)
@@ -31,40 +41,48 @@ class DataLaoding():
 
 # Traitement de nettoyage
 class DataProcessing():
-    def __init__(self, data, geojson):
+    def __init__(self, data, geojson, engine=ENGINE):
         self.data = data
         self.geojson = geojson
+        self.engine = engine
+
+    def group_data(self, backend='pandas'):
+        if backend == 'duckdb':
+            with DataQuery() as query:
+                return query.pivot_species(query.load_chunks(self.data), ['VILLE'], 'ESPECE', 'POPULATION')
 
-    def group_data(self):
         chunks = pd.DataFrame()
 
         for chunk in self.data:
-            grouped = chunk.groupby(['VILLE', 'ESPECE'])['POPULATION'].sum().reset_index()
+            grouped = chunk.groupby(['VILLE', 'ESPECE'], observed=True)['POPULATION'].sum().reset_index()
             chunks = pd.concat([chunks, grouped], ignore_index=True)
 
-        grouped_data = chunks.groupby(['VILLE', 'ESPECE'])['POPULATION'].sum().unstack(fill_value=0).reset_index()
+        grouped_data = chunks.groupby(['VILLE', 'ESPECE'], observed=True)['POPULATION'].sum().unstack(fill_value=0)
+        grouped_data.columns = grouped_data.columns.astype(str)
+        grouped_data = grouped_data.reset_index()
         return grouped_data
 
     def format_data(self):
-        self.geojson['new_com'] = self.geojson['nom_de_la_commune'].str.lower()
-        self.geojson['new_com'] = self.geojson['new_com'].apply(unidecode)
-        self.geojson['new_com'] = self.geojson['new_com'].str.replace(' ', '')
+        self.geojson['new_com'] = normalize_city(self.geojson['nom_de_la_commune']).fillna('')
 
     def search_corres(self, grouped_data):
-        geojson_list = self.geojson['new_com']
-        processed_list = [utils.default_process(name) for name in geojson_list]
+        processed_list = self.geojson['new_com'].tolist()
+        codes, values = pd.factorize(normalize_city(grouped_data['VILLE']))
 
-        for (i, value) in enumerate(grouped_data['VILLE']):
-            value = value.lower()
-            value = unidecode(value)
-            value = value.replace(' ', '')
-            match = process.extractOne(value, processed_list, processor=None, score_cutoff=93)
+        # Chaque nom distinct n'est recherché qu'une fois
+        found = search_engine(self.engine, processed_list, score_cutoff=93).search(values)
+        positions = np.append(found, -1)[codes]
+        matched = positions >= 0
 
-            if match:
-                grouped_data.loc[i, 'NEW_VILLE'] = self.geojson.loc[match[2], 'nom_de_la_commune']
-                grouped_data.loc[i, 'CODE POSTAL'] = self.geojson.loc[match[2], 'code_postal']
-                grouped_data.loc[i, 'SCORE'] = match[1]
-                grouped_data.loc[i, 'code_insee'] = self.geojson.loc[match[2], 'code_commune_insee']
+        # Score du nom retenu, quel que soit le moteur qui l'a trouvé
+        scores = np.array([fuzz.WRatio(value, processed_list[position]) if position >= 0 else np.nan
+                           for value, position in zip(values, found)] + [np.nan])[codes]
+
+        communes = self.geojson.iloc[positions[matched]]
+        grouped_data.loc[matched, 'NEW_VILLE'] = communes['nom_de_la_commune'].to_numpy()
+        grouped_data.loc[matched, 'CODE POSTAL'] = communes['code_postal'].to_numpy()
+        grouped_data.loc[matched, 'SCORE'] = scores[matched]
+        grouped_data.loc[matched, 'code_insee'] = communes['code_commune_insee'].to_numpy()
 
         return grouped_data
 
@@ -77,7 +95,10 @@ class DataExporting():
         self.output_file = output_file
         self.final_data = final_data
 
-    def export_csv(self):
+    def export_store(self, year):
+        DataStore().write(self.final_data, 'jointables', year)
+
+    def export_xlsx(self):
         with pd.ExcelWriter(self.output_file, engine='openpyxl', mode='w') as writer:
             self.final_data.to_excel(writer, sheet_name='Sheet1', header=True, index=True)
 
@@ -88,20 +109,26 @@ class DataPipeline(DataLaoding, DataProcessing, DataExporting):
         super().__init__(data_source, geojson_source)
 
     # Run du script
-    def pipeline_running(self, data_source, geojson_source):
+    def pipeline_running(self, data_source, geojson_source, backend='pandas', report=False):
         data_load = DataLaoding(data_source, geojson_source)
         df2017 = data_load.loading_from_xlsx()
         geojson = data_load.loading_from_geojson()
 
-        data_process = DataProcessing(df2017, geojson)
-        grouped_data = data_process.group_data()
-        data_process.format_data()
-        corres_data = data_process.search_corres(grouped_data)
+        with METRICS.stage('jointables', 2017) as metrics:
+            data_process = DataProcessing(df2017, geojson)
+            grouped_data = data_process.group_data(backend)
+            data_process.format_data()
+            corres_data = data_process.search_corres(grouped_data)
+            metrics.rows_out = len(corres_data)
+            metrics.match(corres_data['NEW_VILLE'].notna().sum() if 'NEW_VILLE' in corres_data else 0, len(corres_data))
         # final_data = data_process.final_treatment(corres_data)
 
         output_file = f'./result_2017.xlsx'
         data_export = DataExporting(output_file, corres_data)
-        data_export.export_csv()
+        data_export.export_store(2017)
+        if report:
+            data_export.export_xlsx()
+        METRICS.export('join-tables')
 
 if __name__ == "__main__":
     data_source = "./data/"
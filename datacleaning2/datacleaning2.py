@@ -1,23 +1,40 @@
 import pandas as pd
 import geopandas as gpd
-from rapidfuzz import utils, process
 import os
 from joblib import Parallel, delayed
 import time
-import re
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.dataschema import ENCODING, read_dtypes, pad_codes, apply_schema
+from datacommon.dataquery import DataQuery
+from datacommon.datametrics import METRICS
+from datacommon.datamatch import CommuneMatcher
+from datacommon.dataclient import RemoteMatcher, service_client
+from datacommon.datadelta import DataDelta, code_version
+
+# Version du code, les lignes mémorisées par une autre version sont retraitées
+VERSION = code_version(os.path.abspath(__file__))
+# Colonnes écrites par la correspondance d'une ligne, fonction de sa ville et de son code postal
+MATCHED = ['VILLE_2', 'CODE POSTAL', 'CODE INSEE', 'LON', 'LAT', 'COORDONNEES']
 
 class DataLoading():
     def __init__(self, data_source, geojson_source):
         self.data_source = data_source
         self.geojson_source = geojson_source
 
+    def loading_csv(self, name):
+        return (pad_codes(chunk) for chunk in pd.read_csv(os.path.join(self.data_source, name), header=0, sep=',', chunksize=1000,
+                                                          dtype=read_dtypes(), encoding=ENCODING))
+
     def loading_from_xlsx(self):
         if os.path.exists(self.data_source):
-            df2013 = pd.read_csv(os.path.join(self.data_source, "data2013.csv"), header=0, sep=',', chunksize=1000)
-            df2014 = pd.read_csv(os.path.join(self.data_source, "data2014.csv"), header=0, sep=',', chunksize=1000)
-            df2015 = pd.read_csv(os.path.join(self.data_source, "data2015.csv"), header=0, sep=',', chunksize=1000)
-            df2016 = pd.read_csv(os.path.join(self.data_source, "data2016.csv"), header=0, sep=',', chunksize=1000)
-            df2019 = pd.read_csv(os.path.join(self.data_source, "data2019.csv"), header=0, sep=',', chunksize=1000)
+            df2013 = self.loading_csv("data2013.csv")
+            df2014 = self.loading_csv("data2014.csv")
+            df2015 = self.loading_csv("data2015.csv")
+            df2016 = self.loading_csv("data2016.csv")
+            df2019 = self.loading_csv("data2019.csv")
             return df2013, df2014, df2015, df2016, df2019
         else:
             return f"File from {self.data_source} doesn't exist"
@@ -31,48 +48,37 @@ class DataLoading():
 
 class DataProcessing():
 
-    def __init__(self, geojson):
+    def __init__(self, geojson, matcher=None, engine=None):
         self.geojson = geojson
+        self.matcher = matcher
+        self.engine = engine
     
-    def search_corres(self, chunk, val):
-        geojson_list = self.geojson['nom_comm'].str.replace('-', ' ').str.replace('/', 'sur').str.replace('st', 'saint')
-        processed_list = [utils.default_process(name) for name in geojson_list]
-        
-        processed_chunks = []
-        
-        for (i, value) in enumerate(chunk['Ville']):
-            i = i + val
-            value = str(value)            
-            value = value.replace('-', '').replace('/', 'sur').replace('st', 'saint').replace('-', ' ').replace('cedex', '')
-            value = ''.join([l for l in value if not l.isdigit()])
-            value = re.sub(r"\(.*?\)", "", value)
-            
-            match = process.extractOne(value, processed_list, processor=utils.default_process, score_cutoff=90)
-            
-            if match:
-                chunk.loc[i, 'VILLE_2'] = self.geojson.loc[match[2], 'nom_comm']
-                chunk.loc[i, 'CODE POSTAL'] = self.geojson.loc[match[2], 'postal_code']
-                chunk.loc[i, 'CODE INSEE'] = self.geojson.loc[match[2], 'insee_com']
-                chunk.loc[i, 'LON'] = self.geojson.loc[match[2], 'geo_point_2d']['lon']
-                chunk.loc[i, 'LAT'] = self.geojson.loc[match[2], 'geo_point_2d']['lat']
-                chunk.loc[i, 'COORDONNEES'] = f'[{self.geojson.loc[match[2], "geo_point_2d"]["lon"]}, {self.geojson.loc[match[2], "geo_point_2d"]["lat"]}]'
-            
-        processed_chunks.append(chunk)
-        
-        return processed_chunks
-
-    def group(self, verified_data):
-        verified_data = verified_data[verified_data['VILLE_2'] != '']
-        pivoted = pd.pivot_table(verified_data, values='Population', index=['VILLE_2'], columns=['Espece'], aggfunc='sum')
-        pivoted = pivoted.reset_index()
-        pivoted = pivoted.fillna(0)
-
-        add_ville_2 = verified_data.groupby('VILLE_2')['CODE INSEE'].first().reset_index()
-        add_coordonnees = verified_data.groupby('VILLE_2')['COORDONNEES'].first().reset_index()
-        add_code_postal = verified_data.groupby('VILLE_2')['CODE POSTAL'].first().reset_index()
-        grouped_data = pd.merge(pivoted, add_ville_2, on='VILLE_2')
-        grouped_data = pd.merge(grouped_data, add_coordonnees, on='VILLE_2')
-        grouped_data = pd.merge(grouped_data, add_code_postal, on='VILLE_2')
+    def search_corres(self, chunk):
+        # Communes fusionnées résolues par la table de l'Insee avant la recherche floue
+        if self.matcher is None:
+            self.matcher = CommuneMatcher(self.geojson, score_cutoff=90, engine=self.engine)
+
+        positions = self.matcher.match(chunk['Ville'], chunk['Code postal'])
+        return [self.matcher.assign(chunk, positions, 'VILLE_2')]
+
+    def group(self, verified_data, backend='pandas'):
+        if backend == 'duckdb':
+            with DataQuery() as query:
+                grouped_data = query.pivot_species(verified_data, ['VILLE_2'], 'Espece', 'Population',
+                                                   ['CODE INSEE', 'COORDONNEES', 'CODE POSTAL'])
+        else:
+            verified_data = verified_data[verified_data['VILLE_2'] != '']
+            pivoted = pd.pivot_table(verified_data, values='Population', index=['VILLE_2'], columns=['Espece'], aggfunc='sum', observed=True)
+            pivoted.columns = pivoted.columns.astype(str)
+            pivoted = pivoted.reset_index()
+            pivoted = pivoted.fillna(0)
+
+            add_ville_2 = verified_data.groupby('VILLE_2')['CODE INSEE'].first().reset_index()
+            add_coordonnees = verified_data.groupby('VILLE_2')['COORDONNEES'].first().reset_index()
+            add_code_postal = verified_data.groupby('VILLE_2')['CODE POSTAL'].first().reset_index()
+            grouped_data = pd.merge(pivoted, add_ville_2, on='VILLE_2')
+            grouped_data = pd.merge(grouped_data, add_coordonnees, on='VILLE_2')
+            grouped_data = pd.merge(grouped_data, add_code_postal, on='VILLE_2')
         
         # Mise à jour du champs LAT et LON
         grouped_data['LON'] = grouped_data['COORDONNEES'].str.split().str[0].str.replace('[', '').str.replace(',', '')
@@ -80,46 +86,103 @@ class DataProcessing():
 
         return grouped_data
 
+    def contributions(self, rows):
+        """
+        Aggregates of some rows only, to patch the aggregates of a year.
+
+        Args:
+            rows (pd.DataFrame): Matched rows.
+
+        Returns:
+            pd.DataFrame: Output of group, empty if no row was matched.
+        """
+        if 'VILLE_2' not in rows or not (rows['VILLE_2'].notna() & (rows['VILLE_2'] != '')).any():
+            return pd.DataFrame(columns=['VILLE_2', 'CHAT', 'CHIEN'])
+        return self.group(rows)
+
 class DataExporting():
 
     def __init__(self, output_sheet, final_data):
         self.output_sheet = output_sheet
         self.final_data = final_data
 
-    def export_csv(self):
+    def export_store(self):
+        DataStore().write(self.final_data, 'grouping2', self.output_sheet)
+
+    def export_xlsx(self):
         if not os.path.exists('./result/'):
             os.mkdir('./result/')
 
-        if os.path.isfile(f'./result/{self.output_sheet}.xlsx'):
-            with pd.ExcelWriter(f'./result/{self.output_sheet}.xlsx', engine='openpyxl', mode="a") as writer:
-                self.final_data.to_excel(writer, sheet_name=str(self.output_sheet), header=True, index=True)
-        else:
-            with pd.ExcelWriter(f'./result/{self.output_sheet}.xlsx', engine='openpyxl', mode="w") as writer:
-                self.final_data.to_excel(writer, sheet_name=str(self.output_sheet), header=True, index=True)
+        with pd.ExcelWriter(f'./result/{self.output_sheet}.xlsx', engine='openpyxl', mode="w") as writer:
+            self.final_data.to_excel(writer, sheet_name=str(self.output_sheet), header=True, index=True)
 
 class DataPipeline(DataLoading, DataProcessing, DataExporting):
     def __init__(self):
         super().__init__(data_source, geojson_source)
 
-    def run_process(self, data_load, df, year):
-        geojson = data_load.loading_from_geojson()
-
-        processed_data = []
-        val = 0
-        data_process = DataProcessing(geojson)
-        print(f"=========== VERIFICATION DATA for {year} ===========")
-        for _, chunk in enumerate(df):  
-            verified_chunk = data_process.search_corres(chunk, val)
-            processed_data.extend(verified_chunk)
-            val += 1000
-
-        verified_data = pd.concat(processed_data, ignore_index=True)
-        print(f"=========== GROUP DATA for {year} ===========")
-        grouped_data = data_process.group(verified_data)
-                
-        data_export = DataExporting(year, grouped_data)
-        print(f"=========== EXPORT DATA for {year} ===========")
-        data_export.export_csv()
+    def run_process(self, data_load, df, year, report=False, backend='pandas', delta=True, engine=None):
+        """
+        Match, group and export the data of a year.
+
+        When the rows of the previous delivery of the year are in the store,
+        only the rows added since are matched, and the stored aggregates are
+        patched with the contributions of the added and removed rows.
+
+        Args:
+            data_load (DataLoading): Loader of the GeoJSON.
+            df (iterable): Chunks of the delivery.
+            year (int): Year of the delivery.
+            report (bool): Also export an Excel report.
+            backend (str): 'pandas', or 'duckdb' to aggregate out of core.
+            delta (bool): Process only the rows changed since the previous delivery.
+            engine (str): Engine of the fuzzy matching, 'rapidfuzz' or 'ngram', the default of datamatch if None.
+        """
+        with METRICS.stage('grouping2', year) as metrics:
+            chunks = list(df)
+            data = pd.concat(chunks, ignore_index=True)
+            columns = list(data.columns)
+            metrics.rows_in = len(data)
+
+            data_delta = DataDelta('grouping2', VERSION)
+            previous = data_delta.previous(year) if delta and DataStore().exists('grouping2', year) else None
+            if previous is not None:
+                added, removed, kept = data_delta.diff(data, previous, columns)
+                reused, added = data_delta.reuse(added, previous, ['Ville', 'Code postal'], MATCHED)
+                chunks = [added]
+                print(f"=========== DELTA for {year}: {len(reused) + len(added)} added, {len(removed)} removed ===========")
+
+            # Le service résident évite de recharger les communes et de reconstruire l'index
+            client = service_client()
+            matcher = RemoteMatcher(client, score_cutoff=90, engine=engine) if client else None
+            geojson = data_load.loading_from_geojson() if matcher is None and sum(map(len, chunks)) else None
+
+            processed_data = []
+            data_process = DataProcessing(geojson, matcher, engine)
+            print(f"=========== VERIFICATION DATA for {year} ===========")
+            for _, chunk in enumerate(chunks):  
+                verified_chunk = data_process.search_corres(chunk) if len(chunk) else [chunk]
+                processed_data.extend(verified_chunk)
+
+            verified_data = pd.concat(processed_data if previous is None else [reused] + processed_data, ignore_index=True)
+            metrics.match(verified_data['VILLE_2'].notna().sum() if 'VILLE_2' in verified_data else 0, len(verified_data))
+
+            print(f"=========== GROUP DATA for {year} ===========")
+            if previous is None:
+                grouped_data = apply_schema(data_process.group(verified_data, backend))
+                data_delta.commit(verified_data, year, columns)
+            else:
+                rows = pd.concat([kept, verified_data], ignore_index=True)
+                grouped_data = DataDelta.patch(DataStore().read('grouping2', year), data_process.contributions(verified_data),
+                                               data_process.contributions(removed), ['VILLE_2'], ['CHAT', 'CHIEN'],
+                                               present=rows[rows['VILLE_2'].notna() & (rows['VILLE_2'] != '')])
+                data_delta.commit(rows, year)
+            metrics.rows_out = len(grouped_data)
+                    
+            data_export = DataExporting(year, grouped_data)
+            print(f"=========== EXPORT DATA for {year} ===========")
+            data_export.export_store()
+            if report:
+                data_export.export_xlsx()
 
     def pipeline_running(self, data_source, geojson_source):
         data_load = DataLoading(data_source, geojson_source)
@@ -131,6 +194,7 @@ class DataPipeline(DataLoading, DataProcessing, DataExporting):
         Parallel(n_jobs=5, prefer="threads")(delayed(DataPipeline().run_process)(data_load, df, years[year]) for year, df in enumerate(df_list))
         end = time.time()
         print('{:.4f} s'.format(end - start))
+        METRICS.export('datacleaning2')
 
 if __name__ == "__main__":
     data_source = "./data/"
@@ -0,0 +1,138 @@
+import httpx
+import numpy as np
+import pandas as pd
+import os
+
+from datacommon.datamatch import ENGINE, assign_communes
+
+# Adresse du service de correspondance et de géocodage (datacleaning/dataservice.py)
+SERVICE_URL = os.environ.get('DATASERVICE_URL', 'http://127.0.0.1:8765')
+
+class DataClient():
+    """
+    Class calling the resident matching and geocoding service.
+
+    The service keeps the communes, their normalized names and the caches in
+    memory between runs; the pipelines use it when it answers and fall back
+    to their own matching otherwise.
+    """
+
+    def __init__(self, url=SERVICE_URL, timeout=60.0):
+        """
+        Initializes the DataClient instance.
+
+        Args:
+            url (str): Address of the service.
+            timeout (float): Maximum duration of a request in seconds.
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def available(self):
+        """
+        Whether the service is running.
+
+        Returns:
+            bool: True if the service answered its health check.
+        """
+        try:
+            return httpx.get(f'{self.url}/health', timeout=0.5).status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    def post(self, path, payload):
+        """
+        Send a batch to the service.
+
+        Args:
+            path (str): Endpoint, e.g. '/match'.
+            payload (dict): JSON body.
+
+        Returns:
+            dict: JSON answer.
+        """
+        response = httpx.post(f'{self.url}{path}', json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def geocode(self, rows):
+        """
+        Geocode a batch of cities, as DataProcessing.geocoder of datacleaning.
+
+        Args:
+            rows (list of dict): 'VILLE' and 'CODE POSTAL' of every city.
+
+        Returns:
+            list of tuple: Coordinates, corrected name and original name of every city.
+        """
+        return [tuple(result) for result in self.post('/geocode', {'rows': rows})['results']]
+
+class RemoteMatcher():
+    """
+    Class with the interface of CommuneMatcher, matching through the service.
+
+    The records of the communes received are kept, so that assign does not
+    need the GeoJSON.
+    """
+
+    def __init__(self, client, score_cutoff=90, engine=None):
+        """
+        Initializes the RemoteMatcher instance.
+
+        Args:
+            client (DataClient): Client of the service.
+            score_cutoff (float): Minimum score of the fuzzy tier.
+            engine (str): Engine of the fuzzy tier, 'rapidfuzz' or 'ngram', ENGINE if None.
+        """
+        self.client = client
+        self.score_cutoff = score_cutoff
+        self.engine = engine or ENGINE
+        self.communes = {}
+
+    def match(self, cities, postal_codes=None):
+        """
+        Position in the GeoJSON of the service of the commune of every city.
+
+        Args:
+            cities (pd.Series): City names.
+            postal_codes (pd.Series): Postal codes of the cities, to tell homonyms apart.
+
+        Returns:
+            ndarray: Position of every city, -1 when it was not matched.
+        """
+        payload = {
+            'cities': cities.astype(object).where(cities.notna(), None).tolist(),
+            'postal_codes': None if postal_codes is None else postal_codes.astype(object).where(postal_codes.notna(), None).tolist(),
+            'score_cutoff': self.score_cutoff,
+            'engine': self.engine,
+        }
+        answer = self.client.post('/match', payload)
+        self.communes.update({int(position): commune for position, commune in answer['communes'].items()})
+        return np.array(answer['positions'], dtype=np.int64)
+
+    def assign(self, data, positions, name_column):
+        """
+        Write the name, codes and coordinates of the matched communes.
+
+        Args:
+            data (pd.DataFrame): Data with one row per position.
+            positions (ndarray): Output of match.
+            name_column (str): Column receiving the name of the commune.
+
+        Returns:
+            pd.DataFrame: data, with the matched rows filled.
+        """
+        matched = positions >= 0
+        communes = pd.DataFrame([self.communes[position] for position in positions[matched]],
+                                columns=['nom_comm', 'postal_code', 'insee_com', 'geo_point_2d'])
+        return assign_communes(data, matched, communes, name_column)
+
+def service_client():
+    """
+    Client of the service if it is running.
+
+    Returns:
+        DataClient or None: Client, None when the service does not answer.
+    """
+    client = DataClient()
+    return client if client.available() else None
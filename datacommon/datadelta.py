@@ -0,0 +1,201 @@
+import glob
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from datacommon.datastore import DataStore
+from datacommon.dataschema import apply_schema
+
+# Code partagé par les étapes, une modification invalide les lignes mémorisées
+COMMON_SOURCE = os.path.dirname(os.path.abspath(__file__))
+
+FINGERPRINT = 'FINGERPRINT'
+OCCURRENCE = 'OCCURRENCE'
+VERSION = 'VERSION'
+
+def code_version(*paths):
+    """
+    Hash of the code of a stage and of datacommon.
+
+    Args:
+        *paths (str): Scripts of the stage.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(paths) + sorted(glob.glob(os.path.join(COMMON_SOURCE, '*.py'))):
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def fingerprint(data, columns):
+    """
+    Hash of every row over some columns.
+
+    Values are compared as strings, so that the same row read with other
+    dtypes (e.g. from the CSV or from the store) keeps its fingerprint.
+
+    Args:
+        data (pd.DataFrame): Rows to hash.
+        columns (list): Columns identifying a row.
+
+    Returns:
+        pd.Series: One unsigned 64-bit hash per row.
+    """
+    values = data[columns].astype(object).where(data[columns].notna(), '').astype(str)
+    return pd.util.hash_pandas_object(values, index=False)
+
+class DataDelta():
+    """
+    Class computing the rows added and removed between two deliveries of a year.
+
+    The rows of the last delivery are kept in the store, stage
+    '<stage>-rows', with their fingerprint and whatever the stage computed
+    for them (e.g. the matched commune). Deliveries are compared as
+    multisets: a row present twice and delivered once more is added once.
+    A changed row is the removal of its old version and the addition of
+    the new one.
+    """
+
+    def __init__(self, stage, version, store=None):
+        """
+        Initializes the DataDelta instance.
+
+        Args:
+            stage (str): Name of the stage.
+            version (str): Version of the code of the stage, see code_version.
+            store (DataStore): Intermediate store, the shared one if None.
+        """
+        self.stage = f'{stage}-rows'
+        self.version = version
+        self.store = store or DataStore()
+
+    def previous(self, year):
+        """
+        Rows of the last delivery, if they were processed by the same code.
+
+        Args:
+            year (int): Year of the delivery.
+
+        Returns:
+            pd.DataFrame or None: Stored rows, None if there are none or if the code changed since.
+        """
+        if not self.store.exists(self.stage, year):
+            return None
+        rows = self.store.read(self.stage, year)
+        if len(rows) and rows[VERSION].iloc[0] != self.version:
+            return None
+        return rows.drop(columns=VERSION)
+
+    @staticmethod
+    def numbered(data):
+        """
+        Key of every row, its fingerprint and its occurrence among identical rows.
+
+        Args:
+            data (pd.DataFrame): Rows with a fingerprint.
+
+        Returns:
+            pd.MultiIndex: Key of every row.
+        """
+        return pd.MultiIndex.from_arrays([data[FINGERPRINT], data.groupby(FINGERPRINT).cumcount()])
+
+    def diff(self, data, previous, columns):
+        """
+        Rows added and removed since the last delivery.
+
+        Args:
+            data (pd.DataFrame): New delivery.
+            previous (pd.DataFrame): Output of previous.
+            columns (list): Columns identifying a row of the delivery.
+
+        Returns:
+            tuple: Added rows of data, removed rows of previous and kept rows of previous.
+        """
+        data = data.assign(**{FINGERPRINT: fingerprint(data, columns).to_numpy()})
+        current, stored = self.numbered(data), self.numbered(previous)
+
+        added = data[~current.isin(stored)].reset_index(drop=True)
+        removed = previous[~stored.isin(current)].reset_index(drop=True)
+        kept = previous[stored.isin(current)].reset_index(drop=True)
+        return added, removed, kept
+
+    @staticmethod
+    def reuse(added, previous, keys, columns):
+        """
+        Copy to the added rows what was computed for previous rows with the same keys.
+
+        A corrected row often keeps its city: its match is taken from the
+        stored rows instead of being computed again.
+
+        Args:
+            added (pd.DataFrame): Added rows, from diff.
+            previous (pd.DataFrame): Output of previous.
+            keys (list): Columns the computed columns depend on, e.g. the city and the postal code.
+            columns (list): Computed columns to copy.
+
+        Returns:
+            tuple: Added rows with their copied columns, and added rows left to compute.
+        """
+        columns = [column for column in columns if column in previous]
+        seen = pd.Series(np.arange(len(previous)), index=fingerprint(previous, keys).to_numpy())
+        seen = seen[~seen.index.duplicated()]
+        positions = pd.Series(fingerprint(added, keys).to_numpy()).map(seen)
+        found = positions.notna().to_numpy()
+
+        reused = added[found].drop(columns=columns, errors='ignore').reset_index(drop=True)
+        values = previous.iloc[positions[found].astype(np.int64)][columns].reset_index(drop=True)
+        return pd.concat([reused, values], axis=1), added[~found].reset_index(drop=True)
+
+    def commit(self, rows, year, columns=None):
+        """
+        Store the rows of the delivery, for the next diff.
+
+        Args:
+            rows (pd.DataFrame): Processed rows, with their fingerprint unless columns is given.
+            year (int): Year of the delivery.
+            columns (list): Columns identifying a row, to fingerprint rows that have none.
+        """
+        if columns is not None:
+            rows = rows.assign(**{FINGERPRINT: fingerprint(rows, columns).to_numpy()})
+        self.store.write(rows.assign(**{VERSION: self.version}).reset_index(drop=True), self.stage, year)
+
+    @staticmethod
+    def patch(aggregates, added, removed, keys, values, present=None):
+        """
+        Add the contributions of the added rows to aggregates and subtract those of the removed rows.
+
+        The other columns keep their value in aggregates; new keys take
+        the one of the added rows. The known columns are cast to the shared
+        dtypes, as after a full run.
+
+        Args:
+            aggregates (pd.DataFrame): Aggregates of the last delivery.
+            added (pd.DataFrame): Aggregates of the added rows, same keys and values.
+            removed (pd.DataFrame): Aggregates of the removed rows, same keys and values.
+            keys (list): Columns of the key of the aggregates.
+            values (list): Summed columns.
+            present (pd.DataFrame): Keys that still have rows, the others are dropped; all kept if None.
+
+        Returns:
+            pd.DataFrame: Patched aggregates, with the columns of aggregates.
+        """
+        # Sommes signées, les effectifs sont lus en entiers non signés
+        def signed(data, sign=1):
+            return data.assign(**{value: sign * data[value].astype('float64') for value in values if value in data})
+
+        data = pd.concat([signed(aggregates), signed(added), signed(removed, -1)], ignore_index=True)
+        data[values] = data[values].fillna(0)
+
+        others = {column: 'first' for column in data.columns if column not in keys and column not in values}
+        patched = data.groupby(keys, as_index=False, sort=False, dropna=False, observed=True).agg({**{value: 'sum' for value in values}, **others})
+
+        if present is not None:
+            remaining = pd.MultiIndex.from_frame(present[keys].drop_duplicates())
+            patched = patched[pd.MultiIndex.from_frame(patched[keys]).isin(remaining)]
+        patched = patched.astype({value: aggregates[value].dtype for value in values})
+        return apply_schema(patched[[column for column in aggregates.columns if column in patched] +
+                                    [column for column in patched.columns if column not in aggregates]].reset_index(drop=True))
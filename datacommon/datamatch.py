@@ -0,0 +1,397 @@
+import numpy as np
+import pandas as pd
+import os
+from collections import Counter
+from rapidfuzz import process
+
+from datacommon.datametrics import METRICS
+from datacommon.datanormalize import normalize_city
+
+try:
+    from sklearn.feature_extraction.text import TfidfVectorizer
+except ImportError:
+    TfidfVectorizer = None
+
+# Communes de l'Insee (avec communes déléguées, associées et arrondissements municipaux)
+MERGER_SOURCE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'datacleaning', 'data', 'v_commune_2023.csv')
+# Moteur de la recherche floue par défaut, 'rapidfuzz' ou 'ngram'
+ENGINE = os.environ.get('DATAMATCH_ENGINE', 'rapidfuzz')
+
+def department(codes):
+    """
+    Department of INSEE or postal codes, comparable between both.
+
+    Corsica ('2A', '2B' and postal '20') is '20', overseas departments keep
+    three digits.
+
+    Args:
+        codes (pd.Series): INSEE or postal codes.
+
+    Returns:
+        pd.Series: Department of every code, '' when unknown.
+    """
+    codes = codes.astype(str).fillna('')
+    departments = codes.str[:2].replace({'2A': '20', '2B': '20'})
+    departments = departments.where(departments != '97', codes.str[:3])
+    return departments.where(codes.str.fullmatch(r'[0-9][0-9AB]\d{2,3}'), '')
+
+def loading_mergers(merger_source=MERGER_SOURCE):
+    """
+    Names of every commune of the Insee table with the current commune it belongs to.
+
+    Delegated ('COMD') and associated ('COMA') communes and municipal
+    arrondissements ('ARM') point to their 'COMPARENT'; current communes
+    ('COM') to themselves. Every commune is listed under its name with and
+    without article, e.g. "L'Abergement-Clémenciat" and "Abergement-Clémenciat".
+
+    Args:
+        merger_source (str): Path to v_commune_<year>.csv.
+
+    Returns:
+        pd.DataFrame: 'NAME' (normalized), 'DEP' of the listed commune and 'CODE' of the current commune.
+    """
+    communes = pd.read_csv(merger_source, dtype=str, usecols=['TYPECOM', 'COM', 'NCCENR', 'LIBELLE', 'COMPARENT'])
+    communes['CODE'] = communes['COMPARENT'].where(communes['TYPECOM'] != 'COM', communes['COM'])
+    communes['DEP'] = department(communes['COM'])
+
+    names = pd.concat([communes.assign(NAME=communes['LIBELLE']), communes.assign(NAME=communes['NCCENR'])])
+    names['NAME'] = normalize_city(names['NAME'])
+    names = names.dropna(subset=['NAME', 'CODE'])
+    # Les communes actuelles d'abord, leur nom prime sur celui d'une ancienne commune homonyme
+    names = names.sort_values('TYPECOM', key=lambda typecom: typecom != 'COM', kind='stable')
+    return names.drop_duplicates(['NAME', 'DEP', 'CODE'])[['NAME', 'DEP', 'CODE']].reset_index(drop=True)
+
+class FuzzyEngine():
+    """
+    Class searching names among choices by edit distance, scanning every choice.
+    """
+
+    def __init__(self, choices, score_cutoff=90):
+        """
+        Initializes the FuzzyEngine instance.
+
+        Args:
+            choices (list): Normalized names to search among.
+            score_cutoff (float): Minimum score of a match.
+        """
+        self.choices = choices
+        self.score_cutoff = score_cutoff
+
+    def search(self, names):
+        """
+        Best choice of every name.
+
+        Args:
+            names (list): Normalized names.
+
+        Returns:
+            ndarray: Index of the best choice of every name, -1 below score_cutoff.
+        """
+        matches = [process.extractOne(name, self.choices, processor=None, score_cutoff=self.score_cutoff) for name in names]
+        return np.array([match[2] if match else -1 for match in matches], dtype=np.int64)
+
+class NgramEngine(FuzzyEngine):
+    """
+    Class searching names among choices by TF-IDF of their character n-grams.
+
+    The choices are vectorized once; the candidates of a batch of names are
+    the top_k choices of one sparse matrix product, re-ranked with the
+    rapidfuzz scorer of FuzzyEngine so that scores and cutoffs keep their
+    meaning.
+    """
+    BATCH_SIZE = 512
+
+    def __init__(self, choices, score_cutoff=90, top_k=10, ngram_range=(2, 3), rerank=True):
+        """
+        Initializes the NgramEngine instance.
+
+        Args:
+            choices (list): Normalized names to search among.
+            score_cutoff (float): Minimum score of a match, rapidfuzz score or cosine similarity x 100 without rerank.
+            top_k (int): Number of candidates of every name.
+            ngram_range (tuple): Lengths of the character n-grams.
+            rerank (bool): Re-rank the candidates with rapidfuzz, the best cosine similarity is kept otherwise.
+        """
+        super().__init__(choices, score_cutoff)
+        self.top_k = min(top_k, len(choices))
+        self.rerank = rerank
+        self.vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=ngram_range, dtype=np.float32)
+        self.matrix = self.vectorizer.fit_transform(choices).T.tocsr()
+
+    def candidates(self, names):
+        """
+        Choices with the highest cosine similarity to every name.
+
+        Args:
+            names (list): Normalized names.
+
+        Returns:
+            tuple: Indices and similarities of the candidates, both of shape (len(names), top_k), best first.
+        """
+        indices = np.empty((len(names), self.top_k), dtype=np.int64)
+        similarities = np.empty((len(names), self.top_k), dtype=np.float32)
+
+        for start in range(0, len(names), self.BATCH_SIZE):
+            batch = (self.vectorizer.transform(names[start:start + self.BATCH_SIZE]) @ self.matrix).toarray()
+            top = np.argpartition(-batch, self.top_k - 1, axis=1)[:, :self.top_k]
+            order = np.argsort(-np.take_along_axis(batch, top, axis=1), axis=1)
+            indices[start:start + len(batch)] = np.take_along_axis(top, order, axis=1)
+            similarities[start:start + len(batch)] = np.take_along_axis(batch, indices[start:start + len(batch)], axis=1)
+        return indices, similarities
+
+    def search(self, names):
+        """
+        Best choice of every name.
+
+        Args:
+            names (list): Normalized names.
+
+        Returns:
+            ndarray: Index of the best choice of every name, -1 below score_cutoff.
+        """
+        names = list(names)
+        if not names or not self.top_k:
+            return np.full(len(names), -1, dtype=np.int64)
+
+        indices, similarities = self.candidates(names)
+        if not self.rerank:
+            return np.where(similarities[:, 0] * 100 >= self.score_cutoff, indices[:, 0], -1)
+
+        positions = np.full(len(names), -1, dtype=np.int64)
+        for row, name in enumerate(names):
+            match = process.extractOne(name, [self.choices[index] for index in indices[row]], processor=None,
+                                       score_cutoff=self.score_cutoff)
+            if match:
+                positions[row] = indices[row, match[2]]
+        return positions
+
+def search_engine(engine, choices, score_cutoff=90):
+    """
+    Fuzzy search engine by name.
+
+    Args:
+        engine (str): 'rapidfuzz', or 'ngram' which falls back to 'rapidfuzz' without scikit-learn.
+        choices (list): Normalized names to search among.
+        score_cutoff (float): Minimum score of a match.
+
+    Returns:
+        FuzzyEngine: Engine of the choices.
+    """
+    if engine == 'ngram':
+        if TfidfVectorizer is not None:
+            return NgramEngine(choices, score_cutoff)
+        print("scikit-learn is not installed, the fuzzy search falls back to rapidfuzz")
+    elif engine != 'rapidfuzz':
+        raise ValueError(f"Unknown engine {engine}, expected 'rapidfuzz' or 'ngram'")
+    return FuzzyEngine(choices, score_cutoff)
+
+class CommuneMatcher():
+    """
+    Class matching city names to the communes of a GeoJSON, by tiers.
+
+    1. the exact normalized name of a commune of the GeoJSON;
+    2. the name of a commune of the Insee table, merged or not, resolved to
+       the current commune it belongs to ("commune nouvelle");
+    3. fuzzy matching against both lists, above score_cutoff, with the
+       engine given by search_engine.
+
+    The first two tiers try the department of the postal code first when it
+    is given, then any department. Only the names left by the first two
+    tiers are searched, in one batch per call of match, and every distinct
+    name is resolved once per matcher.
+    """
+
+    def __init__(self, geojson, score_cutoff=90, merger_source=MERGER_SOURCE, engine=None):
+        """
+        Initializes the CommuneMatcher instance.
+
+        Args:
+            geojson (GeoDataFrame): Communes with 'insee_com', 'nom_comm', 'postal_code' and 'geo_point_2d'.
+            score_cutoff (float): Minimum score of the fuzzy tier.
+            merger_source (str): Path to v_commune_<year>.csv, no merger tier if the file is missing.
+            engine (str): Engine of the fuzzy tier, 'rapidfuzz' or 'ngram', ENGINE if None.
+        """
+        self.geojson = geojson.reset_index(drop=True)
+        self.score_cutoff = score_cutoff
+        self.memo = {}
+        self.statistics = Counter()
+
+        communes = pd.DataFrame({'NAME': normalize_city(self.geojson['nom_comm']).fillna(''),
+                                 'DEP': department(self.geojson['insee_com'])})
+        communes['POSITION'] = np.arange(len(communes))
+        positions = pd.Series(communes['POSITION'].to_numpy(), index=self.geojson['insee_com'].astype(str))
+        positions = positions[~positions.index.duplicated()]
+
+        if os.path.isfile(merger_source):
+            mergers = loading_mergers(merger_source)
+            mergers['POSITION'] = mergers['CODE'].map(positions)
+            mergers = mergers.dropna(subset=['POSITION']).astype({'POSITION': np.int64})
+        else:
+            mergers = pd.DataFrame(columns=['NAME', 'DEP', 'CODE', 'POSITION'])
+
+        self.exact_department = self.lookup(communes, ['NAME', 'DEP'])
+        self.exact = self.lookup(communes, ['NAME'])
+        self.merger_department = self.lookup(mergers, ['NAME', 'DEP'])
+        self.merger = self.lookup(mergers[~mergers.duplicated('NAME', keep=False)], ['NAME'])
+
+        # Liste du rang 3 : communes du GeoJSON puis noms de l'Insee absents du GeoJSON
+        choices = pd.concat([communes, mergers[~mergers['NAME'].isin(communes['NAME'])]]).drop_duplicates('NAME')
+        self.choices = choices['NAME'].tolist()
+        self.choice_positions = choices['POSITION'].to_numpy()
+        self.engine = search_engine(engine or ENGINE, self.choices, score_cutoff)
+
+    @staticmethod
+    def lookup(data, keys):
+        """
+        Position of the first commune of every key.
+
+        Args:
+            data (pd.DataFrame): Names with their 'POSITION' in the GeoJSON.
+            keys (list): Columns of the key.
+
+        Returns:
+            dict: Position by name, or by (name, department).
+        """
+        data = data.drop_duplicates(keys)
+        index = data[keys[0]] if len(keys) == 1 else pd.MultiIndex.from_frame(data[keys])
+        return dict(zip(index, data['POSITION']))
+
+    def lookup_tiers(self, name, department):
+        """
+        Position of the commune of a normalized name by the exact and merger tiers.
+
+        Args:
+            name (str): Normalized name.
+            department (str): Department of the postal code, '' if unknown.
+
+        Returns:
+            int or None: Position in the GeoJSON, -1 for an empty name, None if the fuzzy tier is needed.
+        """
+        if not name:
+            self.statistics['unmatched'] += 1
+            return -1
+
+        for tier, table, key in (('exact', self.exact_department, (name, department)),
+                                 ('merger', self.merger_department, (name, department)),
+                                 ('exact', self.exact, name),
+                                 ('merger', self.merger, name)):
+            if key in table:
+                self.statistics[tier] += 1
+                return table[key]
+        return None
+
+    def fuzzy(self, names):
+        """
+        Position of the commune of normalized names by the fuzzy tier.
+
+        Args:
+            names (list): Normalized names left by lookup_tiers.
+
+        Returns:
+            ndarray: Position in the GeoJSON of every name, -1 when it was not matched.
+        """
+        found = self.engine.search(names)
+        self.statistics['fuzzy'] += int((found >= 0).sum())
+        self.statistics['unmatched'] += int((found < 0).sum())
+        return np.where(found >= 0, self.choice_positions[found], -1)
+
+    def resolve(self, name, department):
+        """
+        Position of the commune of a normalized name, -1 if there is none.
+
+        Args:
+            name (str): Normalized name.
+            department (str): Department of the postal code, '' if unknown.
+
+        Returns:
+            int: Position in the GeoJSON.
+        """
+        position = self.lookup_tiers(name, department)
+        return self.fuzzy([name])[0] if position is None else position
+
+    def match(self, cities, postal_codes=None):
+        """
+        Position in the GeoJSON of the commune of every city.
+
+        Args:
+            cities (pd.Series): City names.
+            postal_codes (pd.Series): Postal codes of the cities, to tell homonyms apart.
+
+        Returns:
+            ndarray: Position of every city, -1 when it was not matched.
+        """
+        names = normalize_city(cities).fillna('')
+        departments = department(postal_codes) if postal_codes is not None else pd.Series('', index=names.index)
+        codes, keys = pd.factorize(pd.MultiIndex.from_arrays([names.to_numpy(), departments.to_numpy()]))
+
+        missing = [key for key in keys if key not in self.memo]
+        METRICS.count('cache_hits', len(keys) - len(missing))
+        METRICS.count('cache_misses', len(missing))
+
+        # Les noms laissés par les rangs exacts sont cherchés en un seul lot, une fois par nom
+        pending = {}
+        for name, code in missing:
+            position = self.lookup_tiers(name, code)
+            if position is None:
+                pending.setdefault(name, []).append((name, code))
+            else:
+                self.memo[(name, code)] = position
+        for position, pending_keys in zip(self.fuzzy(list(pending)), pending.values()):
+            self.memo.update(dict.fromkeys(pending_keys, int(position)))
+
+        positions = np.array([self.memo[key] for key in keys] + [-1], dtype=np.int64)
+        return positions[codes]
+
+    def communes(self, positions):
+        """
+        Name, codes and coordinates of the communes at some positions.
+
+        Args:
+            positions (iterable): Positions in the GeoJSON.
+
+        Returns:
+            dict: Record of every position, as sent by the matching service.
+        """
+        columns = ['nom_comm', 'postal_code', 'insee_com', 'geo_point_2d']
+        positions = sorted({int(position) for position in positions if position >= 0})
+        return dict(zip(positions, self.geojson.loc[positions, columns].to_dict('records')))
+
+    def assign(self, data, positions, name_column):
+        """
+        Write the name, codes and coordinates of the matched communes.
+
+        Args:
+            data (pd.DataFrame): Data with one row per position.
+            positions (ndarray): Output of match.
+            name_column (str): Column receiving the name of the commune.
+
+        Returns:
+            pd.DataFrame: data, with the matched rows filled.
+        """
+        matched = positions >= 0
+        return assign_communes(data, matched, self.geojson.iloc[positions[matched]], name_column)
+
+def assign_communes(data, matched, communes, name_column):
+    """
+    Write the name, codes and coordinates of communes on the matched rows.
+
+    Args:
+        data (pd.DataFrame): Data to fill.
+        matched (ndarray): Mask of the matched rows.
+        communes (pd.DataFrame): 'nom_comm', 'postal_code', 'insee_com' and 'geo_point_2d' of every matched row.
+        name_column (str): Column receiving the name of the commune.
+
+    Returns:
+        pd.DataFrame: data, with the matched rows filled.
+    """
+    lon = communes['geo_point_2d'].str.get('lon').to_numpy()
+    lat = communes['geo_point_2d'].str.get('lat').to_numpy()
+
+    data.loc[matched, name_column] = communes['nom_comm'].to_numpy()
+    data.loc[matched, 'CODE POSTAL'] = communes['postal_code'].to_numpy()
+    data.loc[matched, 'CODE INSEE'] = communes['insee_com'].to_numpy()
+    data.loc[matched, 'LON'] = lon
+    data.loc[matched, 'LAT'] = lat
+    data.loc[matched, 'COORDONNEES'] = [f'[{x}, {y}]' for x, y in zip(lon, lat)]
+    return data
@@ -0,0 +1,234 @@
+import cProfile
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from datacommon.datastore import STORE_SOURCE
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Rapports de mesure par défaut, à côté du magasin intermédiaire
+REPORT_SOURCE = os.path.join(STORE_SOURCE, 'metrics')
+
+FIELDS = ['stage', 'year', 'started_at', 'wall_s', 'cpu_s', 'peak_rss_mb', 'rows_in', 'rows_out', 'rows_per_s',
+          'cache_hits', 'cache_misses', 'matched', 'match_attempts', 'match_rate', 'profile']
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the process since it started, in MB.
+
+    Uses resource where available (ru_maxrss is in KB on Linux and in bytes on
+    macOS), then psutil, and None if neither is available.
+
+    Returns:
+        float or None: Peak RSS in MB.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    return round(getattr(memory, 'peak_wset', memory.rss) / (1024 * 1024), 1)
+
+class StageMetrics():
+    """
+    Class holding the measures of one stage, or of one year of a stage.
+
+    The counters are filled by the pipeline while the stage runs, the timings
+    and memory are recorded when the stage ends.
+    """
+
+    def __init__(self, stage, year=None):
+        """
+        Initializes the StageMetrics instance.
+
+        Args:
+            stage (str): Name of the stage.
+            year (int): Year processed, None for the whole stage.
+        """
+        self.stage = stage
+        self.year = year
+        self.started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.wall_s = None
+        self.cpu_s = None
+        self.peak_rss_mb = None
+        self.rows_in = 0
+        self.rows_out = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.matched = 0
+        self.match_attempts = 0
+        self.profile = None
+
+    def count(self, name, value=1):
+        """
+        Increment a counter, e.g. 'cache_hits' or 'rows_in'.
+
+        Args:
+            name (str): Name of the counter.
+            value (int): Increment.
+        """
+        setattr(self, name, getattr(self, name) + int(value))
+
+    def match(self, matched, attempts):
+        """
+        Record the outcome of a matching step.
+
+        Args:
+            matched (int): Number of values accepted.
+            attempts (int): Number of values tried.
+        """
+        self.count('matched', matched)
+        self.count('match_attempts', attempts)
+
+    def record(self):
+        """
+        Measures of the stage as a flat dictionary.
+
+        Returns:
+            dict: One value per field of the report.
+        """
+        record = {field: getattr(self, field, None) for field in FIELDS}
+        record['rows_per_s'] = round(self.rows_in / self.wall_s, 1) if self.wall_s else None
+        record['match_rate'] = round(self.matched / self.match_attempts, 4) if self.match_attempts else None
+        return record
+
+class DataMetrics():
+    """
+    Class collecting the measures of the pipeline stages.
+
+    Stages are measured with the stage context manager; code running inside a
+    stage, even deep in a DataProcessing method, adds to its counters with
+    count. CPU time and peak RSS are those of the process, so stages running
+    in parallel threads share them.
+    """
+
+    def __init__(self, report_source=REPORT_SOURCE, profile=None):
+        """
+        Initializes the DataMetrics instance.
+
+        Args:
+            report_source (str): Directory of the reports and profiles.
+            profile (bool): Sample a cProfile per stage, from the DATAMETRICS_PROFILE environment variable if None.
+        """
+        self.report_source = report_source
+        self.profile = os.environ.get('DATAMETRICS_PROFILE') == '1' if profile is None else profile
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def current(self):
+        """
+        Innermost stage running in the current thread.
+
+        Returns:
+            StageMetrics or None: Current stage, None outside of a stage.
+        """
+        stack = getattr(self.local, 'stack', [])
+        return stack[-1] if stack else None
+
+    def count(self, name, value=1):
+        """
+        Increment a counter of the current stage, does nothing outside of a stage.
+
+        Args:
+            name (str): Name of the counter.
+            value (int): Increment.
+        """
+        metrics = self.current()
+        if metrics is not None:
+            metrics.count(name, value)
+
+    @contextmanager
+    def stage(self, stage, year=None):
+        """
+        Measure a stage.
+
+        Example:
+            with METRICS.stage('grouping', 2017) as metrics:
+                metrics.rows_in = len(data)
+
+        Args:
+            stage (str): Name of the stage.
+            year (int): Year processed, None for the whole stage.
+
+        Yields:
+            StageMetrics: Measures of the stage.
+        """
+        metrics = StageMetrics(stage, year)
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append(metrics)
+
+        # Seule l'étape la plus externe est profilée, les années imbriquées y figurent
+        profiler = None
+        if self.profile and len(self.local.stack) == 1:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Un seul profileur actif à la fois : l'étape parallèle n'est pas profilée
+                profiler = None
+
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield metrics
+        finally:
+            metrics.wall_s = round(time.perf_counter() - wall_start, 4)
+            metrics.cpu_s = round(time.process_time() - cpu_start, 4)
+            metrics.peak_rss_mb = peak_rss_mb()
+            self.local.stack.pop()
+
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.report_source, exist_ok=True)
+                metrics.profile = os.path.join(self.report_source, f'{stage}-{"all" if year is None else year}.prof')
+                profiler.dump_stats(metrics.profile)
+
+            with self.lock:
+                self.records.append(metrics.record())
+
+    def export(self, name):
+        """
+        Export the measures collected so far.
+
+        The JSON report holds the last run, the CSV report keeps the history of
+        the runs so that regressions can be spotted.
+
+        Args:
+            name (str): Name of the reports, e.g. the name of the script.
+
+        Returns:
+            str: Path to the JSON report.
+        """
+        os.makedirs(self.report_source, exist_ok=True)
+        json_path = os.path.join(self.report_source, f'{name}.json')
+        csv_path = os.path.join(self.report_source, f'{name}.csv')
+
+        with self.lock:
+            records = list(self.records)
+
+        with open(json_path, 'w', encoding='utf-8') as file:
+            json.dump(records, file, indent=2)
+
+        new_file = not os.path.exists(csv_path)
+        with open(csv_path, 'a', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=FIELDS, delimiter=';')
+            if new_file:
+                writer.writeheader()
+            writer.writerows(records)
+
+        return json_path
+
+# Collecteur partagé par les étapes d'un même script
+METRICS = DataMetrics()
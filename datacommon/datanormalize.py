@@ -0,0 +1,81 @@
+import threading
+
+import pandas as pd
+
+# Règles appliquées dans l'ordre aux noms déjà en minuscules et sans accents
+RULES = [
+    (r'\(.*?\)', ' '),      # mentions entre parenthèses
+    (r'\d+', ' '),          # chiffres (codes postaux, arrondissements, CEDEX 01)
+    (r'/', ' sur '),        # "Bar/Seine" → "bar sur seine"
+    (r'[^a-z ]+', ' '),     # tirets, apostrophes et ponctuation
+    (r'\bcedex\b', ' '),
+    (r'\bste\b', 'sainte'),
+    (r'\bst\b', 'saint'),
+    (r'\s+', ' '),
+]
+
+# Ligatures que la décomposition Unicode ne sépare pas
+LIGATURES = {'œ': 'oe', 'æ': 'ae'}
+
+# Noms déjà normalisés, partagés par les étapes et les années d'un même processus
+MEMO = {}
+MEMO_SIZE = 1_000_000
+# Étapes lancées sur plusieurs threads et service résident : vidage, ajout et lecture du memo d'un seul tenant
+MEMO_LOCK = threading.Lock()
+
+def normalize_values(values):
+    """
+    Apply the normalization rules to distinct values, column-wise.
+
+    Args:
+        values (pd.Series): Distinct city names.
+
+    Returns:
+        pd.Series: Normalized names, aligned with values.
+    """
+    names = values.astype(str).str.lower()
+    for ligature, replacement in LIGATURES.items():
+        names = names.str.replace(ligature, replacement, regex=False)
+    names = names.str.normalize('NFKD').str.encode('ascii', errors='ignore').str.decode('ascii')
+
+    for pattern, replacement in RULES:
+        names = names.str.replace(pattern, replacement, regex=True)
+    return names.str.strip()
+
+def normalize_city(cities):
+    """
+    Normalize city names so that the I-CAD names and the reference names compare equal.
+
+    Names are lowercased, stripped of accents, of the mentions between
+    parentheses, of the digits and of "cedex"; "/" becomes "sur", hyphens and
+    punctuation become spaces, and "st"/"ste" become "saint"/"sainte".
+
+    Every distinct name is normalized once: the column is factorized, only
+    the names not already memoized are processed, and the result is mapped
+    back to the rows.
+
+    Example:
+        normalize_city(pd.Series(['ST-ETIENNE CEDEX 01', 'Bar/Seine (10)']))
+        # → ['saint etienne', 'bar sur seine']
+
+    Args:
+        cities (pd.Series): City names, missing values allowed.
+
+    Returns:
+        pd.Series: Normalized names with the index of cities, missing values kept.
+    """
+    codes, uniques = pd.factorize(cities)
+    uniques = pd.Series(uniques, dtype=object)
+
+    with MEMO_LOCK:
+        missing = ~uniques.isin(MEMO.keys())
+        if missing.any():
+            if len(MEMO) + missing.sum() > MEMO_SIZE:
+                MEMO.clear()
+                missing[:] = True
+            MEMO.update(zip(uniques[missing], normalize_values(uniques[missing])))
+
+        normalized = uniques.map(MEMO).to_numpy(dtype=object)
+    result = pd.Series(normalized.take(codes), index=cities.index, dtype=object)
+    result[codes < 0] = None
+    return result.astype(pd.StringDtype('pyarrow'))
@@ -0,0 +1,153 @@
+import duckdb
+import numpy as np
+import pandas as pd
+import tempfile
+import os
+
+from datacommon.datastore import DataStore
+from datacommon.dataschema import apply_schema
+
+class DataQuery():
+    """
+    Class for running the CHAT/CHIEN aggregations with DuckDB.
+
+    Aggregations are expressed as SQL queries over a DataFrame, a stream of
+    chunks, CSV files or the Parquet partitions of the intermediate store.
+    For the CSV and Parquet files and the tables of load_chunks, DuckDB
+    spills to its temporary directory when the data does not fit in the
+    memory limit, so several years can be aggregated in a single pass. A
+    DataFrame is already in memory, it is only queried in place.
+
+    The connection is closed by close, or at the end of a with block:
+
+        with DataQuery() as query:
+            grouped = query.pivot_species(data, ['VILLE'])
+    """
+
+    def __init__(self, memory_limit='2GB', temp_directory=None):
+        """
+        Initializes the DataQuery instance.
+
+        Args:
+            memory_limit (str): Memory limit of DuckDB, e.g. '2GB'.
+            temp_directory (str): Directory used to spill to disk, a temporary one if None.
+        """
+        self.connection = duckdb.connect()
+        self.connection.execute(f"SET memory_limit = '{memory_limit}'")
+        self.connection.execute(f"SET temp_directory = '{temp_directory or tempfile.gettempdir()}'")
+        self.connection.execute("SET preserve_insertion_order = true")
+
+    def close(self):
+        """
+        Close the DuckDB connection and drop its tables.
+        """
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def load_chunks(self, chunks, name='source'):
+        """
+        Load a stream of DataFrame chunks into a DuckDB table, one chunk at a time.
+
+        Args:
+            chunks (iterable): DataFrame chunks, e.g. from pd.read_csv with a chunksize.
+            name (str): Name of the table.
+
+        Returns:
+            str: Name of the table.
+        """
+        self.connection.execute(f"DROP TABLE IF EXISTS {name}")
+        start = 0
+        for chunk in chunks:
+            self.connection.register('chunk_frame', chunk.assign(_row=np.arange(start, start + len(chunk))))
+            if start == 0:
+                self.connection.execute(f"CREATE TABLE {name} AS SELECT * FROM chunk_frame")
+            else:
+                self.connection.execute(f"INSERT INTO {name} BY NAME SELECT * FROM chunk_frame")
+            self.connection.unregister('chunk_frame')
+            start += len(chunk)
+        return name
+
+    def relation(self, source):
+        """
+        SQL expression reading a source with a '_row' column keeping the input order.
+
+        Args:
+            source (pd.DataFrame or str): DataFrame, CSV or Parquet path (globs allowed), or a table from load_chunks.
+
+        Returns:
+            str: SQL expression usable in a FROM clause.
+        """
+        if isinstance(source, pd.DataFrame):
+            self.connection.register('source_frame', source.assign(_row=np.arange(len(source))))
+            return 'source_frame'
+
+        if source.endswith('.parquet'):
+            return (f"(SELECT *, row_number() OVER (ORDER BY filename, file_row_number) AS _row "
+                    f"FROM read_parquet('{source}', hive_partitioning = true, filename = true, file_row_number = true))")
+
+        if source.endswith('.csv'):
+            return f"(SELECT *, row_number() OVER () AS _row FROM read_csv_auto('{source}', header = true))"
+
+        return source
+
+    @staticmethod
+    def stage_source(stage, store=None):
+        """
+        Glob of every Parquet partition of a stage of the intermediate store.
+
+        The partition year is available as the 'year' column.
+
+        Args:
+            stage (str): Name of the stage.
+            store (DataStore): Intermediate store, the default one if None.
+
+        Returns:
+            str: Glob of the Parquet files of the stage.
+        """
+        store = store or DataStore()
+        return os.path.join(store.store_source, f'stage={stage}', '*', '*.parquet')
+
+    def pivot_species(self, source, keys, species_column='ESPECE', value_column='POPULATION',
+                      first_columns=(), species=('CHAT', 'CHIEN')):
+        """
+        Sum the value by keys for every species, one column per species.
+
+        Rows with a null or empty last key are ignored. The first non-null
+        value of each of the first_columns is kept, in input order, like the
+        pandas groupby().first(). The known columns are cast to the shared
+        dtypes, e.g. the counts to UInt32, like the pandas backends.
+
+        Args:
+            source (pd.DataFrame or str): Source accepted by relation.
+            keys (list): Grouping columns, e.g. ['VILLE'] or ['year', 'VILLE'].
+            species_column (str): Column holding the species.
+            value_column (str): Column holding the counts.
+            first_columns (iterable): Columns to keep with their first value.
+            species (iterable): Species to pivot into columns.
+
+        Returns:
+            pd.DataFrame: One row per key, sorted by key, with one column per species.
+        """
+        quote = lambda column: '"' + column.replace('"', '""') + '"'
+
+        # DuckDB ne distingue pas la casse : "CODE POSTAL" désignerait aussi la colonne brute "Code postal"
+        if isinstance(source, pd.DataFrame):
+            source = source[list(dict.fromkeys([*keys, species_column, value_column, *first_columns]))]
+
+        select = [quote(key) for key in keys]
+        select += [f"COALESCE(SUM({quote(value_column)}) FILTER (WHERE {quote(species_column)} = '{espece}'), 0) AS {quote(espece)}"
+                   for espece in species]
+        select += [f"first({quote(column)} ORDER BY _row) FILTER (WHERE {quote(column)} IS NOT NULL) AS {quote(column)}"
+                   for column in first_columns]
+
+        query = (f"SELECT {', '.join(select)} FROM {self.relation(source)} "
+                 f"WHERE {quote(keys[-1])} IS NOT NULL AND CAST({quote(keys[-1])} AS VARCHAR) <> '' "
+                 f"GROUP BY {', '.join(quote(key) for key in keys)} "
+                 f"ORDER BY {', '.join(quote(key) for key in keys)}")
+
+        return apply_schema(self.connection.execute(query).df())
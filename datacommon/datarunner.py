@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import STORE_SOURCE
+
+# Racine du dépôt, les chemins des étapes y sont relatifs
+ROOT_SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class Stage():
+    """
+    Class describing a stage of the pipeline.
+
+    A stage is a script run from its own directory, with the files and store
+    stages it reads as inputs and the ones it writes as outputs. Paths are
+    relative to the root of the repository.
+    """
+
+    def __init__(self, name, script, inputs=(), outputs=()):
+        """
+        Initializes the Stage instance.
+
+        Args:
+            name (str): Name of the stage.
+            script (str): Path to the script, run with its directory as working directory.
+            inputs (iterable): Files or directories read by the stage.
+            outputs (iterable): Files or directories written by the stage.
+        """
+        self.name = name
+        self.script = script
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+def store_stage(stage):
+    return os.path.relpath(os.path.join(STORE_SOURCE, f'stage={stage}'), ROOT_SOURCE)
+
+STAGES = [
+    Stage('cleaning', 'datacleaning/datacleaning.py',
+          inputs=['datacleaning/data/dataset.xlsx'],
+          outputs=[store_stage('cleaning')]),
+    Stage('grouping', 'datacleaning/datagrouping.py',
+          inputs=[store_stage('cleaning'), 'datacleaning/data-cleaned/communes/communes.geojson'],
+          outputs=[store_stage('grouping')]),
+    Stage('geocoding', 'datageocoding/datageocoding.py',
+          inputs=[store_stage('grouping'), 'datageocoding/data'],
+          outputs=[store_stage('geocoding')]),
+    Stage('density', 'calculdensite/calculdensite.py',
+          inputs=[store_stage('geocoding')],
+          outputs=[store_stage('density'), 'calculdensite/result/final_data.geojson']),
+    Stage('tiles', 'calculdensite/densitytiles.py',
+          inputs=[store_stage('density')],
+          outputs=['calculdensite/result/densite.mbtiles']),
+    Stage('kde', 'calculdensite/calculkde.py',
+          inputs=[store_stage('grouping'), 'datageocoding/data'],
+          outputs=['calculdensite/result/kde']),
+    Stage('correction', 'datacorrection/data2019correction.py',
+          inputs=[store_stage('geocoding')],
+          outputs=[store_stage('correction')]),
+    Stage('trend', 'datacorrection/datatrend.py',
+          inputs=[store_stage('geocoding')],
+          outputs=[store_stage('trend'), 'datacorrection/result/trend.csv']),
+    Stage('cube', 'datacorrection/datacube.py',
+          inputs=[store_stage('geocoding'), store_stage('density'), 'datacleaning/data/v_commune_2023.csv'],
+          outputs=[store_stage('cube')]),
+    Stage('model', 'model/datamodel.py',
+          inputs=[store_stage('geocoding'), 'model/data_variable', 'model/datavariable.py'],
+          outputs=['model/result']),
+]
+
+class DataRunner():
+    """
+    Class running the stages of the pipeline as a DAG.
+
+    A stage depends on the stages writing one of its inputs. Before running a
+    stage, the content of its inputs and the code of its script and of
+    datacommon are hashed; the stage is skipped when the hash is the one of
+    its last successful run and its outputs exist. Independent branches, e.g.
+    density and correction, run concurrently.
+    """
+
+    def __init__(self, stages=STAGES, state_file=os.path.join(STORE_SOURCE, 'runner-state.json'), max_workers=4):
+        """
+        Initializes the DataRunner instance.
+
+        Args:
+            stages (list of Stage): Stages of the pipeline.
+            state_file (str): JSON file keeping the hash of the last successful run of each stage.
+            max_workers (int): Number of stages run at the same time.
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_file = state_file
+        self.max_workers = max_workers
+
+    def dependencies(self, stage):
+        """
+        Stages writing one of the inputs of a stage.
+
+        Args:
+            stage (Stage): Stage of the pipeline.
+
+        Returns:
+            set of str: Names of the upstream stages.
+        """
+        inside = lambda path, parent: os.path.normpath(path) == os.path.normpath(parent) or \
+            os.path.normpath(path).startswith(os.path.normpath(parent) + os.sep)
+        return {other.name for other in self.stages.values() if other is not stage and
+                any(inside(i, o) or inside(o, i) for i in stage.inputs for o in other.outputs)}
+
+    def upstream(self, targets):
+        """
+        Targets and every stage they depend on, transitively.
+
+        Args:
+            targets (iterable): Names of the stages to run.
+
+        Returns:
+            set of str: Names of the stages to consider.
+        """
+        selected, pending = set(), list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.dependencies(self.stages[name]))
+        return selected
+
+    @staticmethod
+    def hash_path(digest, path):
+        """
+        Feed the content of a file, or of every file of a directory, to a hash.
+
+        Args:
+            digest (hashlib object): Hash to update.
+            path (str): Absolute path of the file or directory.
+        """
+        if os.path.isdir(path):
+            files = sorted(os.path.join(directory, name) for directory, _, names in os.walk(path) for name in names
+                           if not name.endswith('.tmp'))
+        elif os.path.isfile(path):
+            files = [path]
+        else:
+            digest.update(f'missing:{path}'.encode())
+            return
+
+        for file_path in files:
+            digest.update(os.path.relpath(file_path, ROOT_SOURCE).encode())
+            with open(file_path, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(block)
+
+    def fingerprint(self, stage):
+        """
+        Hash of the inputs of a stage and of the code it runs.
+
+        Args:
+            stage (Stage): Stage of the pipeline.
+
+        Returns:
+            str: Hexadecimal sha256.
+        """
+        digest = hashlib.sha256()
+        code = [stage.script] + sorted(os.path.join('datacommon', name) for name in os.listdir(os.path.join(ROOT_SOURCE, 'datacommon'))
+                                       if name.endswith('.py'))
+        for path in code + stage.inputs:
+            self.hash_path(digest, os.path.join(ROOT_SOURCE, path))
+        return digest.hexdigest()
+
+    def load_state(self):
+        if os.path.exists(self.state_file):
+            with open(self.state_file, encoding='utf-8') as file:
+                return json.load(file)
+        return {}
+
+    def save_state(self, state):
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        temporary_path = f'{self.state_file}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump(state, file, indent=2, sort_keys=True)
+        os.replace(temporary_path, self.state_file)
+
+    def run_stage(self, stage, state, force=False):
+        """
+        Run a stage unless its fingerprint is unchanged.
+
+        Args:
+            stage (Stage): Stage of the pipeline.
+            state (dict): Fingerprints of the last successful runs.
+            force (bool): Run the stage even if its fingerprint is unchanged.
+
+        Returns:
+            tuple: (fingerprint, True if the stage was run).
+        """
+        fingerprint = self.fingerprint(stage)
+        outputs_exist = all(os.path.exists(os.path.join(ROOT_SOURCE, path)) for path in stage.outputs)
+        if not force and state.get(stage.name) == fingerprint and outputs_exist:
+            print(f"=========== SKIP {stage.name} (unchanged) ===========")
+            return fingerprint, False
+
+        print(f"=========== RUN {stage.name} ===========")
+        script_path = os.path.join(ROOT_SOURCE, stage.script)
+        start = time.time()
+        subprocess.run([sys.executable, os.path.basename(script_path)], cwd=os.path.dirname(script_path), check=True)
+        print(f"=========== {stage.name} DONE in {time.time() - start:.4f} s ===========")
+        return fingerprint, True
+
+    def run_process(self, targets=None, force=()):
+        """
+        Run the targets and their upstream stages in dependency order.
+
+        When a stage fails, the stages depending on it are not run and the
+        independent ones still complete; the error is raised at the end.
+
+        Args:
+            targets (iterable): Names of the stages to bring up to date, all if None.
+            force (iterable): Names of the stages to run even if unchanged.
+
+        Returns:
+            dict: 'run', 'skipped' or 'failed' for each stage considered.
+        """
+        selected = self.upstream(targets or self.stages)
+        dependencies = {name: self.dependencies(self.stages[name]) & selected for name in selected}
+        state = self.load_state()
+        status, errors, running = {}, [], {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(status) < len(selected):
+                for name in sorted(selected - set(status) - set(running.values())):
+                    upstream = [status.get(dependency) for dependency in dependencies[name]]
+                    if 'failed' in upstream or 'blocked' in upstream:
+                        status[name] = 'blocked'
+                    elif all(upstream_status in ('run', 'skipped') for upstream_status in upstream):
+                        running[executor.submit(self.run_stage, self.stages[name], dict(state), name in force)] = name
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        fingerprint, was_run = future.result()
+                    except Exception as error:
+                        status[name] = 'failed'
+                        errors.append(error)
+                        print(f"=========== {name} FAILED: {error} ===========")
+                    else:
+                        status[name] = 'run' if was_run else 'skipped'
+                        state[name] = fingerprint
+                        self.save_state(state)
+
+        if errors:
+            raise errors[0]
+        return status
+
+if __name__ == "__main__":
+    # Étapes à mettre à jour en arguments, toutes par défaut ; "--force" relance les étapes demandées
+    arguments = [argument for argument in sys.argv[1:] if argument != '--force']
+
+    runner = DataRunner()
+    start = time.time()
+    print(runner.run_process(arguments or None, force=(arguments or list(runner.stages)) if '--force' in sys.argv else ()))
+    end = time.time()
+    print('{:.4f} s'.format(end - start))
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+# Encodage des CSV du dépôt, le BOM éventuel est retiré à la lecture
+ENCODING = 'utf-8-sig'
+
+ESPECE = pd.CategoricalDtype(['CHAT', 'CHIEN'])
+STRING = pd.StringDtype('pyarrow')
+COUNT = pd.UInt32Dtype()
+YEAR = pd.UInt16Dtype()
+
+# Type de chaque colonne connue, sous ses différents noms selon les extractions
+COLUMNS = {
+    'ESPECE': ESPECE, 'Espece': ESPECE,
+    'VILLE': STRING, 'VILLE_2': STRING, 'VILLE_3': STRING, 'Ville': STRING, 'NEW_VILLE': STRING, 'nom_comm': STRING,
+    'COORDONNEES': STRING,
+    'CODE POSTAL': STRING, 'Code postal': STRING, 'postal_code': STRING,
+    'CODE INSEE': STRING, 'insee_com': STRING, 'code_insee': STRING,
+    'POPULATION': COUNT, 'Population': COUNT, 'CHAT': COUNT, 'CHIEN': COUNT,
+    'ANNEE': YEAR, 'Annee': YEAR,
+}
+
+# Codes postaux et INSEE, sur cinq caractères
+CODES = ['CODE POSTAL', 'Code postal', 'postal_code', 'CODE INSEE', 'insee_com', 'code_insee']
+
+def read_dtypes(columns=None):
+    """
+    Dtypes to pass to pd.read_csv or pd.read_excel.
+
+    Codes are read as strings so that their leading zeros are kept, counts as
+    narrow nullable integers (quoted values such as "1" are parsed as well).
+
+    Args:
+        columns (iterable): Columns of the file, all the known columns if None.
+
+    Returns:
+        dict: Dtype of every known column.
+    """
+    if columns is None:
+        return dict(COLUMNS)
+    return {column: COLUMNS[column] for column in columns if column in COLUMNS}
+
+def pad_codes(data):
+    """
+    Restore the leading zero of the codes that lost it, e.g. '1400' → '01400'.
+
+    Only codes of four digits are padded: department-only or malformed postal
+    codes are left as they are for the matching steps.
+
+    Args:
+        data (pd.DataFrame): Data with string codes.
+
+    Returns:
+        pd.DataFrame: Data with the codes on five characters.
+    """
+    for column in data.columns.intersection(CODES):
+        codes = data[column].astype(STRING)
+        data[column] = codes.where(~codes.str.fullmatch(r'\d{4}').fillna(False), '0' + codes)
+    return data
+
+def apply_schema(data):
+    """
+    Cast the known columns of a DataFrame to the shared dtypes.
+
+    Used on frames that were not parsed with read_dtypes, e.g. read from the
+    store or built in memory. Columns already of the right dtype are not
+    copied.
+
+    Args:
+        data (pd.DataFrame): Data to cast.
+
+    Returns:
+        pd.DataFrame: Data with the shared dtypes.
+
+    Raises:
+        TypeError: If a text column holds lists or arrays, whose text would not be the one of the CSV files.
+    """
+    dtypes = {column: dtype for column, dtype in read_dtypes(data.columns).items() if data[column].dtype != dtype}
+    for column, dtype in dtypes.items():
+        if dtype == STRING:
+            # Les codes lus comme nombres ne doivent pas garder de décimale
+            values = data[column]
+            if values.dtype == object and values.map(lambda value: isinstance(value, (list, tuple, np.ndarray))).any():
+                raise TypeError(f"Column '{column}' holds lists or arrays, they must be written as text by the stage that built them")
+            if pd.api.types.is_float_dtype(values):
+                values = values.astype('Int64')
+            data[column] = values.astype(STRING)
+        else:
+            data[column] = data[column].astype(dtype)
+    return pad_codes(data) if data.columns.intersection(CODES).size else data
@@ -0,0 +1,153 @@
+import pandas as pd
+import geopandas as gpd
+import pyarrow.parquet as pq
+import os
+import re
+
+# Magasin partagé par défaut, à la racine du dépôt, ou celui de la variable DATASTORE_SOURCE (ex. pour les benchmarks)
+STORE_SOURCE = os.environ.get('DATASTORE_SOURCE', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'store'))
+
+class DataStore():
+    """
+    Class for the intermediate store shared by the pipeline stages.
+
+    Every stage writes its output as a Parquet dataset partitioned by stage and
+    year, and the next stage reads it back from there:
+
+        <store_source>/stage=<stage>/year=<year>/part-0.parquet
+
+    Outputs that are not split by year use the partition "year=all".
+    GeoDataFrames are written as GeoParquet and read back with their geometry.
+    """
+
+    def __init__(self, store_source=STORE_SOURCE):
+        """
+        Initializes the DataStore instance.
+
+        Args:
+            store_source (str): Path to the root directory of the store.
+        """
+        self.store_source = store_source
+
+    def partition_path(self, stage, year=None):
+        """
+        Path of the Parquet file of a partition.
+
+        Args:
+            stage (str): Name of the stage.
+            year (int): Year of the partition, None for the whole stage.
+
+        Returns:
+            str: Path to the Parquet file.
+        """
+        return os.path.join(self.store_source, f'stage={stage}', f'year={"all" if year is None else year}', 'part-0.parquet')
+
+    def exists(self, stage, year=None):
+        """
+        Check whether a partition has been written.
+
+        Args:
+            stage (str): Name of the stage.
+            year (int): Year of the partition, None for the whole stage.
+
+        Returns:
+            bool: True if the partition exists.
+        """
+        return os.path.isfile(self.partition_path(stage, year))
+
+    def years(self, stage):
+        """
+        List the years written for a stage.
+
+        Args:
+            stage (str): Name of the stage.
+
+        Returns:
+            list of int: Sorted years of the stage.
+        """
+        stage_path = os.path.join(self.store_source, f'stage={stage}')
+        if not os.path.exists(stage_path):
+            return []
+
+        years = []
+        for name in os.listdir(stage_path):
+            match = re.match(r"^year=(\d{4})$", name)
+            if match and os.path.isfile(os.path.join(stage_path, name, 'part-0.parquet')):
+                years.append(int(match.group(1)))
+        return sorted(years)
+
+    def write(self, data, stage, year=None):
+        """
+        Write a partition, replacing its previous content.
+
+        The file is written next to its destination and then renamed, so a
+        reader never sees a partially written partition. Object columns mixing
+        several Python types (e.g. strings and floats) are written as strings.
+
+        Args:
+            data (pd.DataFrame): Data to write, a GeoDataFrame keeps its geometry.
+            stage (str): Name of the stage.
+            year (int): Year of the partition, None for the whole stage.
+        """
+        path = self.partition_path(stage, year)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        for column in data.columns[data.dtypes == object]:
+            if data[column].dropna().map(type).nunique() > 1:
+                data = data.assign(**{column: data[column].where(data[column].isna(), data[column].astype(str))})
+
+        temporary_path = f'{path}.tmp'
+        data.to_parquet(temporary_path, index=False)
+        os.replace(temporary_path, path)
+
+    def remove(self, stage, year=None):
+        """
+        Remove a partition.
+
+        Args:
+            stage (str): Name of the stage.
+            year (int): Year of the partition, None for the whole stage.
+        """
+        path = self.partition_path(stage, year)
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+    def read(self, stage, year=None, columns=None):
+        """
+        Read a partition.
+
+        Args:
+            stage (str): Name of the stage.
+            year (int): Year of the partition, None for the whole stage.
+            columns (list): Columns to read, all if None.
+
+        Returns:
+            pd.DataFrame or gpd.GeoDataFrame: Content of the partition.
+        """
+        path = self.partition_path(stage, year)
+        metadata = pq.read_schema(path).metadata or {}
+
+        if b'geo' in metadata:
+            return gpd.read_parquet(path, columns=columns)
+        return pd.read_parquet(path, columns=columns)
+
+    def read_chunks(self, stage, year=None, chunksize=1000):
+        """
+        Read a partition by chunks, like pd.read_csv with a chunksize.
+
+        The index of the chunks continues from one chunk to the next.
+
+        Args:
+            stage (str): Name of the stage.
+            year (int): Year of the partition, None for the whole stage.
+            chunksize (int): Number of rows per chunk.
+
+        Yields:
+            pd.DataFrame: Chunks of the partition.
+        """
+        start = 0
+        for batch in pq.ParquetFile(self.partition_path(stage, year)).iter_batches(batch_size=chunksize):
+            chunk = batch.to_pandas()
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
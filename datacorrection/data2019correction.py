@@ -1,12 +1,15 @@
 import numpy as np
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score, explained_variance_score, median_absolute_error
 import matplotlib.pyplot as plt
 import os
+import sys
 import time
 import pandas as pd
 import geopandas as gpd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.datametrics import METRICS
+
 class DataLoading():
     """
     Class for loading data from various sources.
@@ -16,11 +19,14 @@ class DataLoading():
 
     def loading_from_geojson(self):
         """
-        Load GeoJSON data into a GeoDataFrame.
+        Load the joined data into a GeoDataFrame.
 
         Returns:
-        - GeoDataFrame: GeoDataFrame loaded from the GeoJSON file.
+        - GeoDataFrame: Output of datageocoding from the intermediate store, or loaded from the GeoJSON file.
         """
+        store = DataStore()
+        if store.exists('geocoding'):
+            return store.read('geocoding')
         if os.path.exists(self.data_source):
             geojson = gpd.read_file(self.data_source, rows=20)
             return geojson
@@ -30,19 +36,64 @@ class DataLoading():
 class DataProcessing():
     def __init__(self):
         super().__init__()
-        
-    def apply_regression(self, x, y):
-        x = np.array(x, dtype=np.float64).reshape(-1, 1)
-        y = np.array(y)
+    
+    def apply_regression(self, x, y, predict_years):
+        """
+        Fit a least-squares line on every series of y at once.
+
+        The slope and intercept have a closed form for a single regressor, so
+        all series (communes, species) are solved in one broadcasted operation.
+
+        Parameters:
+        - x (array-like): Years of the observations, shape (n_years,).
+        - y (array-like): Observations, shape (..., n_years), one series per leading index.
+        - predict_years (array-like): Years to predict, shape (n_predict,).
+
+        Returns:
+        - Tuple of arrays: slopes (...), intercepts (...) and predictions (..., n_predict).
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+
+        x_mean = x.mean()
+        x_centered = x - x_mean
+        y_mean = y.mean(axis=-1)
+
+        coeff = (y - y_mean[..., None]) @ x_centered / (x_centered @ x_centered)
+        origine = y_mean - coeff * x_mean
+        predict = origine[..., None] + coeff[..., None] * np.asarray(predict_years, dtype=np.float64)
+
+        return coeff, origine, predict
+
+    def model_quality(self, original, predict):
+        """
+        Compute the quality metrics of every series at once.
+
+        Scores follow the scikit-learn definitions, including the value given to
+        R² and explained variance when a series is constant.
+
+        Parameters:
+        - original (array-like): Observations, shape (..., n_years).
+        - predict (array-like): Fitted values, shape (..., n_years).
+
+        Returns:
+        - Tuple of arrays: MSE, RMSE, MAE, R², explained variance and MedAE, shape (...).
+        """
+        original = np.asarray(original, dtype=np.float64)
+        residual = original - np.asarray(predict, dtype=np.float64)
 
-        model = LinearRegression()
-        model.fit(x, y)
+        mse = np.mean(residual ** 2, axis=-1)
+        rmse = np.sqrt(mse)
+        mae = np.mean(np.abs(residual), axis=-1)
+        medae = np.median(np.abs(residual), axis=-1)
 
-        coeff = model.coef_[0]
-        origine = model.intercept_
-        predict_2019 = int(model.predict([[2019]])[0])
+        variance = np.var(original, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r2 = np.where(variance > 0, 1 - mse / variance, np.where(mse == 0, 1.0, 0.0))
+            residual_variance = np.var(residual, axis=-1)
+            evs = np.where(variance > 0, 1 - residual_variance / variance, np.where(residual_variance == 0, 1.0, 0.0))
 
-        return coeff, origine, predict_2019
+        return mse, rmse, mae, r2, evs, medae
         
 class DataPipeline(DataLoading, DataProcessing):
     """
@@ -51,58 +102,61 @@ class DataPipeline(DataLoading, DataProcessing):
     def __init__(self):
         super().__init__(data_source)
 
-    def run_process(self, data_source):
-        data_load = DataLoading(data_source)
-        data = data_load.loading_from_geojson()
-        
-        data_process = DataProcessing()
-        
-        list_chat_coeff, list_chien_coeff = [], []
-        list_chat_ord, list_chien_ord = [], []
-        list_chat_2019, list_chien_2019 = [], []
-        list_chat_mse, list_chien_mse = [], []
-        list_chat_rmse, list_chien_rmse = [], []
-        list_chat_mae, list_chien_mae = [], []
-        list_chat_r2, list_chien_r2 = [], []
-        list_chat_evs, list_chien_evs = [], []
-        list_chat_medae, list_chien_medae = [], []
-        
-        for i in range(len(data)): 
-            list_years = ['2017', '2018', '2019']
-            list_chat = [data['CHAT_2017'][i], data['CHAT_2018'][i], data['CHAT_2020'][i]]
-            list_chien = [data['CHIEN_2017'][i], data['CHIEN_2018'][i], data['CHIEN_2020'][i]]
-            
-            # Pour les chats :
-            coeff, ordonnee, predict_chat = data_process.apply_regression(list_years, list_chat)
-            
-            ## Ajout aux listes
-            list_chat_coeff.append(coeff), list_chat_ord.append(ordonnee), list_chat_2019.append(predict_chat)
-               
-            # Pour les chiens :
-            coeff, ordonnee, predict_chien = data_process.apply_regression(list_years, list_chien)
-                        
-            ## Ajout aux listes
-            list_chien_coeff.append(coeff), list_chien_ord.append(ordonnee), list_chien_2019.append(predict_chien)
-              
-        result = data.copy()
-        
-        result['coef_chat'] = list_chat_coeff
-        result['coef_chien'] = list_chien_coeff
+    def run_process(self, data_source, list_years=(2017, 2018, 2020), predict_years=(2019,), report=False):
+        """
+        Fit the trend of every commune and predict the requested years.
+
+        Parameters:
+        - data_source (str): Path to the GeoJSON file of the joined data.
+        - list_years (tuple): Years used to fit the trends.
+        - predict_years (tuple): Years to predict.
+        - report (bool): Also export the result to an Excel report.
+
+        Returns:
+        - None
+        """
+        with METRICS.stage('correction') as metrics:
+            data_load = DataLoading(data_source)
+            data = data_load.loading_from_geojson()
         
-        result['ordonnees_chat'] = list_chat_ord
-        result['ordonnees_chien'] = list_chien_ord  
-          
-        result['CHAT_2019_PREDICT'] = list_chat_2019
-        result['CHIEN_2019_PREDICT'] = list_chien_2019
+            metrics.rows_in = len(data)
+            data_process = DataProcessing()
+
+            # Une série par commune et par espèce : (espèce, commune, année)
+            species = ['CHAT', 'CHIEN']
+            y = np.stack([data[[f'{espece}_{year}' for year in list_years]].fillna(0).to_numpy(dtype=np.float64)
+                          for espece in species])
+
+            coeff, ordonnee, predict = data_process.apply_regression(list_years, y, predict_years)
+            fitted = ordonnee[..., None] + coeff[..., None] * np.asarray(list_years, dtype=np.float64)
+            quality = data_process.model_quality(y, fitted)
+
+            result = data.copy()
+
+            for i, espece in enumerate(species):
+                name = espece.lower()
+                result[f'coef_{name}'] = coeff[i]
+                result[f'ordonnees_{name}'] = ordonnee[i]
+
+                for j, year in enumerate(predict_years):
+                    result[f'{espece}_{year}_PREDICT'] = np.trunc(predict[i, :, j]).astype(np.int64)
+
+                for metric, values in zip(['mse', 'rmse', 'mae', 'r2', 'evs', 'medae'], quality):
+                    result[f'{metric}_{name}'] = values[i]
         
-        with pd.ExcelWriter(f'./result/result.xlsx', engine='openpyxl', mode="w") as writer:
-            result.to_excel(writer, header=True, index=True) 
+            metrics.rows_out = len(result)
+            DataStore().write(result, 'correction')
+
+            if report:
+                with pd.ExcelWriter(f'./result/result.xlsx', engine='openpyxl', mode="w") as writer:
+                    result.to_excel(writer, header=True, index=True) 
 
     def pipeline_running(self, data_source):        
         start = time.time()
         DataPipeline().run_process(data_source)
         end = time.time()
         print('{:.4f} s'.format(end - start))
+        METRICS.export('data2019correction')
         
 if __name__ == "__main__":
     data_source = "./data/data_join.geojson"
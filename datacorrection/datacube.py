@@ -0,0 +1,314 @@
+import numpy as np
+import os
+import re
+import sys
+import time
+import pandas as pd
+import geopandas as gpd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.datametrics import METRICS
+from datacommon.datamatch import MERGER_SOURCE, department
+
+class DataLoading():
+    """
+    Class for loading the joined data of all years and the administrative levels of the communes.
+    """
+    def __init__(self, data_source, commune_source=MERGER_SOURCE):
+        """
+        Initialize the DataLoading class.
+
+        Parameters:
+        - data_source (str): Path to the GeoJSON file of the joined data, used when the store is empty.
+        - commune_source (str): Path to the v_commune_<year>.csv file of the Insee.
+        """
+        self.data_source = data_source
+        self.commune_source = commune_source
+
+    def loading_from_geojson(self):
+        """
+        Load the joined data, with the surfaces of calculdensite when they are available.
+
+        Returns:
+        - GeoDataFrame: Output of calculdensite or datageocoding from the intermediate store, or loaded from the GeoJSON file.
+        """
+        store = DataStore()
+        for stage in ('density', 'geocoding'):
+            if store.exists(stage):
+                return store.read(stage)
+        if os.path.exists(self.data_source):
+            geojson = gpd.read_file(self.data_source)
+            return geojson
+        else:
+            return f"File from {self.data_source} doesn't exist"
+
+    def loading_levels(self):
+        """
+        Department and region of every commune code of the Insee table.
+
+        Delegated and associated communes and municipal arrondissements take
+        the department and region of their parent commune.
+
+        Returns:
+        - DataFrame: 'DEP' and 'REG' indexed by 'insee_com'.
+        """
+        communes = pd.read_csv(self.commune_source, dtype=str, usecols=['TYPECOM', 'COM', 'REG', 'DEP', 'COMPARENT'])
+        current = communes[communes['TYPECOM'] == 'COM'].drop_duplicates('COM').set_index('COM')[['DEP', 'REG']]
+
+        parent = communes['COMPARENT'].where(communes['TYPECOM'] != 'COM', communes['COM'])
+        levels = current.reindex(parent.to_numpy())
+        levels.index = pd.Index(communes['COM'].to_numpy(), name='insee_com')
+        return levels[~levels.index.duplicated()].dropna()
+
+    @staticmethod
+    def list_years(data):
+        """
+        List the years present as 'CHAT_<year>' and 'CHIEN_<year>' columns.
+
+        Parameters:
+        - data (DataFrame): Wide table of the joined data.
+
+        Returns:
+        - list of int: Sorted years found in the columns.
+        """
+        years = {int(match.group(1)) for match in map(re.compile(r"^(?:CHAT|CHIEN)_(\d{4})$").match, data.columns) if match}
+        return sorted(years)
+
+class DataProcessing():
+    """
+    Class for rolling the counts of the communes up to the departments, the regions and France.
+
+    Every year is a table with one row per level and code: the counts, the
+    surface, the densities and the change since the previous year of the
+    cube, so that a dashboard reads a few rows instead of grouping the wide
+    table of the communes.
+    """
+    SPECIES = ['CHAT', 'CHIEN']
+    LEVELS = ['commune', 'departement', 'region', 'france']
+    # Projection équivalente (LAEA Europe), comme calculdensite
+    AREA_CRS = 'EPSG:3035'
+
+    def __init__(self, data, levels):
+        """
+        Initialize the DataProcessing class.
+
+        Parameters:
+        - data (GeoDataFrame): Wide table with 'insee_com', 'CHAT_<year>', 'CHIEN_<year>' and 'SURFACE_KM2' or a geometry.
+        - levels (DataFrame): Output of DataLoading.loading_levels.
+        """
+        self.data = data.set_index(data['insee_com'].astype(str))
+
+        # Communes absentes de la table de l'Insee : département tiré du code, région du département
+        regions = levels.drop_duplicates('DEP').set_index('DEP')['REG']
+        self.levels = levels.reindex(self.data.index)
+        missing = self.levels['DEP'].isna()
+        self.levels.loc[missing, 'DEP'] = department(self.levels.index[missing].to_series()).to_numpy()
+        self.levels['REG'] = self.levels['REG'].fillna(self.levels['DEP'].map(regions)).fillna('')
+
+        if 'SURFACE_KM2' in self.data.columns:
+            self.surface = self.data['SURFACE_KM2'].astype(np.float64)
+        else:
+            self.surface = pd.Series(self.data.geometry.to_crs(self.AREA_CRS).area.to_numpy() / 1e6, index=self.data.index)
+
+    def communes(self, year):
+        """
+        Counts and surface of every commune for a year.
+
+        Parameters:
+        - year (int): Year of the counts.
+
+        Returns:
+        - DataFrame: 'CHAT', 'CHIEN' and 'SURFACE_KM2' indexed by 'insee_com'.
+        """
+        counts = {espece: self.data[f'{espece}_{year}'].astype(np.float64) if f'{espece}_{year}' in self.data else np.nan
+                  for espece in self.SPECIES}
+        return pd.DataFrame({**counts, 'SURFACE_KM2': self.surface}, index=self.data.index).rename_axis('insee_com')
+
+    def rollup(self, communes):
+        """
+        Sum the counts and surfaces of the communes by level.
+
+        Parameters:
+        - communes (DataFrame): Output of communes.
+
+        Returns:
+        - DataFrame: 'LEVEL', 'CODE', the counts, 'SURFACE_KM2' and the densities, sorted by level and code.
+        """
+        codes = {
+            'commune': communes.index.to_numpy(),
+            'departement': self.levels['DEP'].to_numpy(),
+            'region': self.levels['REG'].to_numpy(),
+            'france': np.full(len(communes), 'FR'),
+        }
+        columns = self.SPECIES + ['SURFACE_KM2']
+
+        cube = pd.concat([communes[columns].groupby(codes[level], sort=True).sum(min_count=1)
+                          .rename_axis('CODE').reset_index().assign(LEVEL=level) for level in self.LEVELS], ignore_index=True)
+        for espece in self.SPECIES:
+            cube[f'{espece}_DENSITE'] = cube[espece] / cube['SURFACE_KM2']
+
+        cube['LEVEL'] = pd.Categorical(cube['LEVEL'], categories=self.LEVELS)
+        return cube[['LEVEL', 'CODE'] + columns + [f'{espece}_DENSITE' for espece in self.SPECIES]]
+
+    def changes(self, cube, previous):
+        """
+        Add the change of the counts since the previous year.
+
+        Parameters:
+        - cube (DataFrame): Output of rollup.
+        - previous (DataFrame or None): Cube of the previous year, no change if None.
+
+        Returns:
+        - DataFrame: cube with the '<species>_VARIATION' (difference) and '<species>_EVOLUTION' (ratio) columns.
+        """
+        cube = cube.drop(columns=[column for column in cube.columns if column.endswith(('_VARIATION', '_EVOLUTION'))])
+        if previous is None:
+            before = pd.DataFrame(np.nan, index=cube.index, columns=self.SPECIES)
+        else:
+            before = cube[['LEVEL', 'CODE']].merge(previous[['LEVEL', 'CODE'] + self.SPECIES], on=['LEVEL', 'CODE'], how='left')
+
+        for espece in self.SPECIES:
+            variation = cube[espece].to_numpy() - before[espece].to_numpy()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cube[f'{espece}_VARIATION'] = variation
+                cube[f'{espece}_EVOLUTION'] = np.where(before[espece].to_numpy() > 0, variation / before[espece].to_numpy(), np.nan)
+        return cube
+
+class DataStoring():
+    """
+    Class for storing the cube in the "cube" stage of the intermediate store, one partition per year.
+    """
+    def __init__(self, store):
+        """
+        Initialize the DataStoring class.
+
+        Parameters:
+        - store (DataStore): Intermediate store.
+        """
+        self.store = store
+
+    def stored_years(self):
+        return self.store.years('cube')
+
+    def load_cube(self, year):
+        """
+        Load the cube of a year.
+
+        Parameters:
+        - year (int): Year of the cube.
+
+        Returns:
+        - DataFrame or None: Cube of the year, None if it was not built.
+        """
+        if self.store.exists('cube', year):
+            return self.store.read('cube', year)
+        return None
+
+    def save_cube(self, cube, year):
+        self.store.write(cube, 'cube', year)
+
+    def query(self, level, years=None, codes=None):
+        """
+        Rows of a level, e.g. the regions of every year, read from the store without the other levels.
+
+        Parameters:
+        - level (str): 'commune', 'departement', 'region' or 'france'.
+        - years (iterable of int): Years to read, all if None.
+        - codes (iterable of str): Codes to keep, all if None.
+
+        Returns:
+        - DataFrame: Rows of the level with a 'YEAR' column.
+        """
+        filters = [('LEVEL', '=', level)] + ([('CODE', 'in', list(codes))] if codes is not None else [])
+        rows = [pd.read_parquet(self.store.partition_path('cube', year), filters=filters).assign(YEAR=year)
+                for year in (years or self.stored_years())]
+        return pd.concat(rows, ignore_index=True) if rows else pd.DataFrame()
+
+class DataPipeline(DataLoading, DataProcessing, DataStoring):
+    """
+    Class representing the incremental cube pipeline.
+    """
+    def __init__(self, store=None):
+        DataStoring.__init__(self, store or DataStore())
+
+    def unchanged(self, cube, communes):
+        """
+        Check whether the stored cube of a year was built from the same communes.
+
+        Parameters:
+        - cube (DataFrame or None): Stored cube of the year.
+        - communes (DataFrame): Output of communes.
+
+        Returns:
+        - bool: True if the counts and surfaces of every commune are the same.
+        """
+        if cube is None:
+            return False
+        stored = cube[cube['LEVEL'] == 'commune'].set_index('CODE')[communes.columns]
+        if not stored.index.sort_values().equals(communes.index.sort_values()):
+            return False
+        return np.allclose(stored.loc[communes.index].to_numpy(), communes.to_numpy(), equal_nan=True)
+
+    def run_process(self, data, levels, list_years):
+        """
+        Build the cube of the years whose communes changed, and the changes of the years that follow them.
+
+        Parameters:
+        - data (GeoDataFrame): Wide table of the joined data.
+        - levels (DataFrame): Output of DataLoading.loading_levels.
+        - list_years (list): Years of the wide table.
+
+        Returns:
+        - list of int: Years whose partition was written.
+        """
+        data_process = DataProcessing(data, levels)
+        years = sorted(set(self.stored_years()) | set(list_years))
+        written = []
+        previous, previous_rebuilt = None, False
+
+        for year in years:
+            cube, rebuilt = self.load_cube(year), False
+            if year in list_years:
+                communes = data_process.communes(year)
+                if not self.unchanged(cube, communes):
+                    with METRICS.stage('cube', year) as metrics:
+                        print(f"=========== ROLLUP CUBE FOR {year} ===========")
+                        cube, rebuilt = data_process.rollup(communes), True
+                        metrics.rows_in = len(communes)
+                        metrics.rows_out = len(cube)
+
+            # Les évolutions d'une année dépendent des effectifs de l'année précédente du cube
+            if cube is not None and (rebuilt or previous_rebuilt):
+                cube = data_process.changes(cube, previous)
+                self.save_cube(cube, year)
+                written.append(year)
+            previous, previous_rebuilt = cube, rebuilt
+
+        return written
+
+    def pipeline_running(self, data_source):
+        """
+        Update the cube with the years of the joined data.
+
+        Parameters:
+        - data_source (str): Path to the GeoJSON file of the joined data.
+
+        Returns:
+        - None
+        """
+        data_load = DataLoading(data_source)
+        data = data_load.loading_from_geojson()
+
+        start = time.time()
+        written = self.run_process(data, data_load.loading_levels(), self.list_years(data))
+        end = time.time()
+        print(f"Cube written for {written}")
+        print('{:.4f} s'.format(end - start))
+        METRICS.export('datacube')
+
+if __name__ == "__main__":
+    data_source = "./data/data_join.geojson"
+
+    pipeline = DataPipeline()
+    pipeline.pipeline_running(data_source)
@@ -0,0 +1,263 @@
+import numpy as np
+import os
+import re
+import sys
+import time
+import pandas as pd
+import geopandas as gpd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.dataschema import ENCODING, read_dtypes, pad_codes, apply_schema
+from datacommon.datametrics import METRICS
+
+class DataLoading():
+    """
+    Class for loading the communes and the geocoded data of every year.
+    """
+    def __init__(self, data_source, geojson_source):
+        """
+        Initialize the DataLoading class.
+
+        Parameters:
+        - data_source (str): Path to the directory containing the "<year>-geocode.csv" files.
+        - geojson_source (str): Path to the GeoJSON file of the communes.
+        """
+        self.data_source = data_source
+        self.geojson_source = geojson_source
+
+    def loading_from_geojson(self):
+        """
+        Load GeoJSON data into a GeoDataFrame.
+
+        Returns:
+        - GeoDataFrame: GeoDataFrame loaded from the GeoJSON file.
+        """
+        if os.path.exists(self.geojson_source):
+            geojson = gpd.read_file(self.geojson_source)
+            return geojson
+        else:
+            return f"File from {self.geojson_source} doesn't exist"
+
+    def list_years(self):
+        """
+        List the years available in the intermediate store and the data source directory.
+
+        Returns:
+        - list of int: Sorted years found.
+        """
+        years = set(DataStore().years('grouping'))
+        for name in os.listdir(self.data_source):
+            match = re.match(r"^(\d{4})-geocode\.csv$", name)
+            if match:
+                years.add(int(match.group(1)))
+        return sorted(years)
+
+    def loading_year(self, year):
+        """
+        Load the geocoded data of a single year.
+
+        Parameters:
+        - year (int): Year of the data.
+
+        Returns:
+        - DataFrame: DataFrame loaded from the "grouping" stage of the store, or from the CSV file of the year.
+        """
+        store = DataStore()
+        if store.exists('grouping', year):
+            return apply_schema(store.read('grouping', year))
+        return pad_codes(pd.read_csv(os.path.join(self.data_source, f"{year}-geocode.csv"), header=0, sep=';',
+                                     encoding=ENCODING, dtype=read_dtypes()))
+
+class DataProcessing():
+    """
+    Class for assembling the wide table of the communes and filling missing years.
+    """
+    SPECIES = ['CHAT', 'CHIEN']
+
+    def assemble(self, communes, list_df, list_year):
+        """
+        Build the wide table of the communes with one keyed join on the INSEE code.
+
+        Parameters:
+        - communes (DataFrame): Communes with 'insee_com' and 'nom_comm'.
+        - list_df (list of DataFrames): Geocoded data of every year with 'CODE INSEE', 'CHAT' and 'CHIEN'.
+        - list_year (list): Years of the DataFrames.
+
+        Returns:
+        - DataFrame: One row per commune with the 'CHAT_<year>' and 'CHIEN_<year>' columns.
+        """
+        data = pd.concat([df[['CODE INSEE', 'CHAT', 'CHIEN']].assign(ANNEE=year) for df, year in zip(list_df, list_year)],
+                         ignore_index=True)
+        data = data.dropna(subset=['CODE INSEE'])
+
+        wide = data.groupby(['CODE INSEE', 'ANNEE'])[self.SPECIES].sum().unstack('ANNEE')
+        wide.columns = [f'{espece}_{year}' for espece, year in wide.columns]
+        wide = wide[[f'{espece}_{year}' for espece in self.SPECIES for year in sorted(list_year)]]
+
+        result = communes[['insee_com', 'nom_comm']].merge(wide, how='left', left_on='insee_com', right_index=True)
+        result[wide.columns] = result[wide.columns].fillna(0).astype(np.int64)
+
+        return result
+
+    @staticmethod
+    def fill_weights(known_years, target_years, method):
+        """
+        Weights expressing every target year as a combination of the known years.
+
+        Linear interpolation, nearest year and least-squares trend are all linear
+        in the observations, so a target column is the product of the known
+        columns with one column of these weights.
+
+        Parameters:
+        - known_years (list): Years with observed values.
+        - target_years (list): Years to fill.
+        - method (str): 'linear', 'nearest' or 'regression'.
+
+        Returns:
+        - ndarray: Weights of shape (len(known_years), len(target_years)).
+        """
+        x = np.asarray(known_years, dtype=np.float64)
+        weights = np.zeros((len(x), len(target_years)))
+
+        for j, target in enumerate(target_years):
+            if method == 'nearest':
+                weights[np.argmin(np.abs(x - target)), j] = 1
+
+            elif method == 'regression':
+                x_centered = x - x.mean()
+                weights[:, j] = 1 / len(x) + x_centered * (target - x.mean()) / (x_centered @ x_centered)
+
+            elif method == 'linear':
+                before, after = np.flatnonzero(x < target), np.flatnonzero(x > target)
+                if len(before) and len(after):
+                    lo, hi = before[-1], after[0]
+                elif len(before) > 1:
+                    lo, hi = before[-2], before[-1]
+                elif len(after) > 1:
+                    lo, hi = after[0], after[1]
+                else:
+                    weights[np.argmin(np.abs(x - target)), j] = 1
+                    continue
+                t = (target - x[lo]) / (x[hi] - x[lo])
+                weights[lo, j], weights[hi, j] = 1 - t, t
+
+            else:
+                raise ValueError(f"Unknown fill method: {method}")
+
+        return weights
+
+    def fill_years(self, data, target_years, method='linear'):
+        """
+        Fill the 'CHAT_<year>' and 'CHIEN_<year>' columns of the target years.
+
+        The values of the target years are recomputed from the other years, the
+        target columns are created if missing. Results are truncated to
+        non-negative integers.
+
+        Parameters:
+        - data (DataFrame): Wide table of the communes.
+        - target_years (list): Years to fill.
+        - method (str): 'linear', 'nearest' or 'regression'.
+
+        Returns:
+        - DataFrame: Wide table with the target years filled.
+        """
+        data = data.copy()
+
+        for espece in self.SPECIES:
+            known_years = sorted(int(col.split('_')[1]) for col in data.columns
+                                 if re.match(rf"^{espece}_\d{{4}}$", col) and int(col.split('_')[1]) not in target_years)
+            weights = self.fill_weights(known_years, target_years, method)
+
+            known = data[[f'{espece}_{year}' for year in known_years]].to_numpy(dtype=np.float64)
+            filled = np.clip(np.trunc(known @ weights), 0, None).astype(np.int64)
+            data[[f'{espece}_{year}' for year in target_years]] = filled
+
+        columns = [col for col in data.columns if not re.match(r"^(CHAT|CHIEN)_\d{4}$", col)]
+        years = sorted({int(col.split('_')[1]) for col in data.columns if re.match(r"^(CHAT|CHIEN)_\d{4}$", col)})
+        return data[columns + [f'{espece}_{year}' for espece in self.SPECIES for year in years]]
+
+class DataExporting():
+    """
+    Class for exporting the filled table.
+    """
+    def __init__(self, final_data):
+        self.final_data = final_data
+
+    def export_store(self):
+        """
+        Export the filled table to the "filling" stage of the intermediate store.
+
+        Returns:
+        - None
+        """
+        DataStore().write(self.final_data, 'filling')
+
+    def export_xlsx(self, output_file):
+        """
+        Export the filled table to an Excel report.
+
+        Parameters:
+        - output_file (str): Path to the Excel file.
+
+        Returns:
+        - None
+        """
+        if not os.path.exists('./result/'):
+            os.mkdir('./result/')
+
+        self.final_data.to_excel(output_file, index=False)
+
+class DataPipeline(DataLoading, DataProcessing, DataExporting):
+    """
+    Class representing the assembling and gap-filling pipeline.
+    """
+    def __init__(self, data_source, geojson_source):
+        super().__init__(data_source, geojson_source)
+
+    def run_process(self, target_years, method='linear'):
+        """
+        Assemble every year of the data source and fill the target years.
+
+        Parameters:
+        - target_years (list): Years to fill.
+        - method (str): 'linear', 'nearest' or 'regression'.
+
+        Returns:
+        - DataFrame: Filled wide table of the communes.
+        """
+        with METRICS.stage('filling') as metrics:
+            communes = self.loading_from_geojson()
+            list_year = self.list_years()
+
+            print(f"=========== ASSEMBLE DATA FOR ALL YEARS ===========")
+            list_df = [self.loading_year(year) for year in list_year]
+            metrics.rows_in = sum(len(df) for df in list_df)
+            data = self.assemble(communes, list_df, list_year)
+
+            print(f"=========== FILL {', '.join(map(str, target_years))} ({method}) ===========")
+            final_data = self.fill_years(data, target_years, method)
+            metrics.rows_out = len(final_data)
+
+        return final_data
+
+    def pipeline_running(self, target_years, method='linear', output_file=None):
+        start = time.time()
+        final_data = self.run_process(target_years, method)
+
+        print(f"=========== EXPORT DATA ===========")
+        DataExporting(final_data).export_store()
+        if output_file:
+            DataExporting(final_data).export_xlsx(output_file)
+        end = time.time()
+        print('{:.4f} s'.format(end - start))
+        METRICS.export('datafilling')
+
+if __name__ == "__main__":
+    data_source = "../datageocoding/data/"
+    geojson_source = "./data/communes.geojson"
+    output_file = "./result/format_data.xlsx"
+
+    pipeline = DataPipeline(data_source, geojson_source)
+    pipeline.pipeline_running([2019], method='linear', output_file=output_file)
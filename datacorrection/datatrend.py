@@ -0,0 +1,355 @@
+import numpy as np
+import os
+import re
+import sys
+import time
+import pandas as pd
+import geopandas as gpd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.datametrics import METRICS
+
+class DataLoading():
+    """
+    Class for loading the joined data of all years.
+    """
+    def __init__(self, data_source):
+        self.data_source = data_source
+
+    def loading_from_geojson(self):
+        """
+        Load the joined data into a GeoDataFrame.
+
+        Returns:
+        - GeoDataFrame: Output of datageocoding from the intermediate store, or loaded from the GeoJSON file.
+        """
+        store = DataStore()
+        if store.exists('geocoding'):
+            return store.read('geocoding')
+        if os.path.exists(self.data_source):
+            geojson = gpd.read_file(self.data_source)
+            return geojson
+        else:
+            return f"File from {self.data_source} doesn't exist"
+
+    @staticmethod
+    def list_years(data):
+        """
+        List the years present as 'CHAT_<year>' and 'CHIEN_<year>' columns.
+
+        Parameters:
+        - data (DataFrame): Wide table of the joined data.
+
+        Returns:
+        - list of int: Sorted years found in the columns.
+        """
+        years = {int(match.group(1)) for match in map(re.compile(r"^(?:CHAT|CHIEN)_(\d{4})$").match, data.columns) if match}
+        return sorted(years)
+
+class DataProcessing():
+    """
+    Class for maintaining the per-commune sufficient statistics of the trends.
+
+    For every commune and species the table keeps n, Σx, Σy, Σxy and Σx², so
+    adding or retracting a year only touches that year's counts.
+    """
+    SPECIES = ['CHAT', 'CHIEN']
+    STATISTICS = ['N', 'SX', 'SY', 'SXY', 'SXX']
+
+    # Les années sont centrées sur cette origine pour limiter les erreurs d'arrondi
+    ORIGIN = 2000
+
+    def __init__(self, statistics=None):
+        """
+        Initialize the DataProcessing class.
+
+        Parameters:
+        - statistics (DataFrame): Sufficient statistics indexed by 'insee_com', empty if None.
+        """
+        if statistics is None:
+            columns = [f'{stat}_{espece}' for espece in self.SPECIES for stat in self.STATISTICS]
+            statistics = pd.DataFrame(columns=columns, index=pd.Index([], name='insee_com'), dtype=np.float64)
+        self.statistics = statistics
+
+    def contribution(self, counts, year):
+        """
+        Compute the contribution of one year to the sufficient statistics.
+
+        Parameters:
+        - counts (DataFrame): 'CHAT' and 'CHIEN' counts of the year indexed by 'insee_com'.
+        - year (int): Year of the counts.
+
+        Returns:
+        - DataFrame: Contribution of the year, with the columns of the statistics table.
+        """
+        x = float(year - self.ORIGIN)
+        contribution = {}
+
+        for espece in self.SPECIES:
+            y = counts[espece].astype(np.float64)
+            observed = y.notna().astype(np.float64)
+            y = y.fillna(0)
+            contribution[f'N_{espece}'] = observed
+            contribution[f'SX_{espece}'] = observed * x
+            contribution[f'SY_{espece}'] = y
+            contribution[f'SXY_{espece}'] = y * x
+            contribution[f'SXX_{espece}'] = observed * x * x
+
+        return pd.DataFrame(contribution, index=counts.index)[self.statistics.columns]
+
+    def add_year(self, counts, year):
+        """
+        Add the counts of a year to the statistics.
+
+        Parameters:
+        - counts (DataFrame): 'CHAT' and 'CHIEN' counts of the year indexed by 'insee_com'.
+        - year (int): Year of the counts.
+
+        Returns:
+        - DataFrame: Updated statistics.
+        """
+        self.statistics = self.statistics.add(self.contribution(counts, year), fill_value=0)
+        return self.statistics
+
+    def retract_year(self, counts, year):
+        """
+        Remove the counts of a previously added year from the statistics.
+
+        Parameters:
+        - counts (DataFrame): Counts that were added for the year, indexed by 'insee_com'.
+        - year (int): Year of the counts.
+
+        Returns:
+        - DataFrame: Updated statistics.
+        """
+        self.statistics = self.statistics.sub(self.contribution(counts, year), fill_value=0)
+        self.statistics = self.statistics[self.statistics[[f'N_{espece}' for espece in self.SPECIES]].sum(axis=1) > 0]
+        return self.statistics
+
+    def coefficients(self):
+        """
+        Compute the slope and intercept of every commune from the statistics.
+
+        Communes with less than two observed years get NaN coefficients.
+
+        Returns:
+        - DataFrame: 'coef_<espece>' and 'ordonnees_<espece>' columns indexed by 'insee_com'.
+        """
+        result = pd.DataFrame(index=self.statistics.index)
+
+        for espece in self.SPECIES:
+            n, sx, sy, sxy, sxx = (self.statistics[f'{stat}_{espece}'].to_numpy() for stat in self.STATISTICS)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                denominator = n * sxx - sx * sx
+                coeff = np.where(denominator > 0, (n * sxy - sx * sy) / denominator, np.nan)
+                origine = (sy - coeff * sx) / n - coeff * self.ORIGIN
+
+            result[f'coef_{espece.lower()}'] = coeff
+            result[f'ordonnees_{espece.lower()}'] = origine
+
+        return result
+
+class DataStoring():
+    """
+    Class for storing the statistics table and the counts added for each year.
+
+    The statistics are kept in the "trend" stage of the intermediate store and
+    the counts of each year in the "trend_counts" stage, so that a corrected
+    year can be retracted without re-reading the other years.
+    """
+    def __init__(self, store):
+        """
+        Initialize the DataStoring class.
+
+        Parameters:
+        - store (DataStore): Intermediate store.
+        """
+        self.store = store
+
+    def stored_years(self):
+        """
+        List the years already added to the statistics.
+
+        Returns:
+        - list of int: Sorted years of the store.
+        """
+        return self.store.years('trend_counts')
+
+    def load_statistics(self):
+        """
+        Load the statistics table.
+
+        Returns:
+        - DataFrame or None: Statistics indexed by 'insee_com', None if the store is empty.
+        """
+        if self.store.exists('trend'):
+            return self.store.read('trend').set_index('insee_com')
+        return None
+
+    def load_year(self, year):
+        """
+        Load the counts added for a year.
+
+        Parameters:
+        - year (int): Year of the counts.
+
+        Returns:
+        - DataFrame: 'CHAT' and 'CHIEN' counts indexed by 'insee_com'.
+        """
+        return self.store.read('trend_counts', year).set_index('insee_com')
+
+    def save(self, statistics, year=None, counts=None):
+        """
+        Save the statistics table and, if given, the counts added for a year.
+
+        Parameters:
+        - statistics (DataFrame): Statistics indexed by 'insee_com'.
+        - year (int): Year of the counts.
+        - counts (DataFrame): Counts added for the year.
+
+        Returns:
+        - None
+        """
+        self.store.write(statistics.reset_index(), 'trend')
+        if year is not None:
+            self.store.write(counts.reset_index(), 'trend_counts', year)
+
+    def remove_year(self, year):
+        """
+        Remove the counts stored for a year, once retracted from the statistics.
+
+        Parameters:
+        - year (int): Year of the counts.
+
+        Returns:
+        - None
+        """
+        self.store.remove('trend_counts', year)
+
+class DataPipeline(DataLoading, DataProcessing, DataStoring):
+    """
+    Class representing the incremental trend pipeline.
+    """
+    def __init__(self, store=None):
+        DataStoring.__init__(self, store or DataStore())
+        DataProcessing.__init__(self, self.load_statistics())
+
+    def unchanged(self, counts, year):
+        """
+        Check whether a year was already added with the same counts.
+
+        Parameters:
+        - counts (DataFrame): 'CHAT' and 'CHIEN' counts of the year indexed by 'insee_com'.
+        - year (int): Year of the counts.
+
+        Returns:
+        - bool: True if the stored counts of the year are the same for every commune.
+        """
+        if year not in self.stored_years():
+            return False
+        stored = self.load_year(year)
+        if not stored.index.sort_values().equals(counts.index.sort_values()):
+            return False
+        return np.allclose(stored.loc[counts.index, self.SPECIES].to_numpy(dtype=np.float64, na_value=np.nan),
+                           counts[self.SPECIES].to_numpy(dtype=np.float64, na_value=np.nan), equal_nan=True)
+
+    @staticmethod
+    def year_counts(data, year):
+        """
+        Counts of a year of the wide table.
+
+        Parameters:
+        - data (DataFrame): Wide table indexed by 'insee_com'.
+        - year (int): Year of the counts.
+
+        Returns:
+        - DataFrame: 'CHAT' and 'CHIEN' counts indexed by 'insee_com'.
+        """
+        return data[[f'CHAT_{year}', f'CHIEN_{year}']].rename(columns={f'CHAT_{year}': 'CHAT', f'CHIEN_{year}': 'CHIEN'})
+
+    def update_year(self, counts, year):
+        """
+        Add a year to the statistics, replacing it if it was already added.
+
+        Parameters:
+        - counts (DataFrame): 'CHAT' and 'CHIEN' counts of the year indexed by 'insee_com'.
+        - year (int): Year of the counts.
+
+        Returns:
+        - None
+        """
+        if year in self.stored_years():
+            self.retract_year(self.load_year(year), year)
+        self.add_year(counts, year)
+        self.save(self.statistics, year, counts)
+
+    def retract(self, year):
+        """
+        Retract a year from the statistics, e.g. before its corrected delivery.
+
+        Parameters:
+        - year (int): Year to retract.
+
+        Returns:
+        - None
+        """
+        self.retract_year(self.load_year(year), year)
+        self.save(self.statistics)
+        self.remove_year(year)
+
+    def run_process(self, data, list_years):
+        """
+        Add the given years of the wide table and return the coefficients.
+
+        Parameters:
+        - data (DataFrame): Wide table with 'insee_com', 'CHAT_<year>' and 'CHIEN_<year>' columns.
+        - list_years (list): Years to add or replace.
+
+        Returns:
+        - DataFrame: Coefficients of every commune.
+        """
+        data = data.set_index('insee_com')
+
+        for year in list_years:
+            with METRICS.stage('trend', year) as metrics:
+                print(f"=========== UPDATE TREND FOR {year} ===========")
+                counts = self.year_counts(data, year)
+                self.update_year(counts, year)
+                metrics.rows_in = len(counts)
+                metrics.rows_out = len(self.statistics)
+
+        return self.coefficients()
+
+    def pipeline_running(self, data_source, output_file):
+        """
+        Add the years of the joined data that are not in the store yet, and
+        replace those whose counts changed since they were added.
+
+        Parameters:
+        - data_source (str): Path to the GeoJSON file of the joined data.
+        - output_file (str): Path to the CSV file of the coefficients.
+
+        Returns:
+        - None
+        """
+        data = DataLoading(data_source).loading_from_geojson()
+        # Une année livrée à nouveau avec d'autres effectifs est retirée puis ajoutée
+        indexed = data.set_index('insee_com')
+        list_years = [year for year in self.list_years(data) if not self.unchanged(self.year_counts(indexed, year), year)]
+
+        start = time.time()
+        result = self.run_process(data, list_years)
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        result.to_csv(output_file, sep=';')
+        end = time.time()
+        print('{:.4f} s'.format(end - start))
+        METRICS.export('datatrend')
+
+if __name__ == "__main__":
+    data_source = "./data/data_join.geojson"
+    output_file = "./result/trend.csv"
+
+    pipeline = DataPipeline()
+    pipeline.pipeline_running(data_source, output_file)
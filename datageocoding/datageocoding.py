@@ -1,8 +1,16 @@
 import pandas as pd
 import geopandas as gpd
+import hashlib
 import os
+import re
+import sys
 import time
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.dataschema import ENCODING, read_dtypes, pad_codes, apply_schema
+from datacommon.datametrics import METRICS
+
 class DataLoading():
     """
     Class for loading data from various sources.
@@ -26,14 +34,58 @@ class DataLoading():
         - Tuple of Pandas DataFrames: DataFrames loaded from CSV files.
         """
         if os.path.exists(self.data_source):
-            df2017 = pd.read_csv(os.path.join(self.data_source, "2017-geocode.csv"), header=0, sep=';')
-            df2018 = pd.read_csv(os.path.join(self.data_source, "2018-geocode.csv"), header=0, sep=';')
-            df2019 = pd.read_csv(os.path.join(self.data_source, "2019-geocode.csv"), header=0, sep=';')
-            df2020 = pd.read_csv(os.path.join(self.data_source, "2020-geocode.csv"), header=0, sep=';')
-            return df2017, df2018, df2019, df2020
+            return tuple(self.loading_year(year) for year in self.list_years())
         else:
             return f"File from {self.data_source} doesn't exist"
 
+    def list_years(self):
+        """
+        List the years available in the intermediate store and the data source directory.
+
+        Every year of the "grouping" stage of the store and every file named
+        "<year>-geocode.csv" is picked up, so a new year only needs to be
+        written to the store or dropped in the directory.
+
+        Returns:
+        - list of int: Sorted years found.
+        """
+        years = set(DataStore().years('grouping'))
+        for name in os.listdir(self.data_source):
+            match = re.match(r"^(\d{4})-geocode\.csv$", name)
+            if match:
+                years.add(int(match.group(1)))
+        return sorted(years)
+
+    def year_source(self, year):
+        """
+        Path of the file holding the geocoded data of a year.
+
+        Parameters:
+        - year (int): Year of the data.
+
+        Returns:
+        - str: Path to the Parquet partition of the store if it exists, to the CSV file otherwise.
+        """
+        store = DataStore()
+        if store.exists('grouping', year):
+            return store.partition_path('grouping', year)
+        return os.path.join(self.data_source, f"{year}-geocode.csv")
+
+    def loading_year(self, year):
+        """
+        Load the geocoded data of a single year.
+
+        Parameters:
+        - year (int): Year of the data.
+
+        Returns:
+        - DataFrame: DataFrame loaded from the store or from the CSV file of the year.
+        """
+        store = DataStore()
+        if store.exists('grouping', year):
+            return apply_schema(store.read('grouping', year))
+        return pad_codes(pd.read_csv(self.year_source(year), header=0, sep=';', dtype=read_dtypes(), encoding=ENCODING))
+
     def loading_from_geojson(self):
         """
         Load GeoJSON data into a GeoDataFrame.
@@ -71,21 +123,131 @@ class DataProcessing():
         Returns:
         - GeoDataFrame: Resulting GeoDataFrame after spatial join and aggregation.
         """
+        return self.assemble([self.sum_year(df, list_year[i]) for i, df in enumerate(list_df)])
+
+    def sum_year(self, df, year):
+        """
+        Spatially join the points of a single year and sum them by commune.
+
+        Parameters:
+        - df (DataFrame): Geocoded data of the year with 'LON', 'LAT', 'CHAT' and 'CHIEN'.
+        - year (int): Year used for labeling columns.
+
+        Returns:
+        - DataFrame: One row per 'insee_com' with the 'CHAT_<year>' and 'CHIEN_<year>' sums.
+        """
+        gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['LON'], df['LAT']), crs='EPSG:4326')
+        gdf = gdf.rename(columns={'CHAT': f'CHAT_{year}', 'CHIEN': f'CHIEN_{year}'})
+        joined_data = gpd.sjoin(self.geojson, gdf, how='left', op='contains')
+
+        # Taux de points tombant dans une commune
+        METRICS.count('matched', joined_data['index_right'].nunique())
+        METRICS.count('match_attempts', len(gdf))
+
+        grouped_data = joined_data.groupby('insee_com', as_index=False).agg({f'CHAT_{year}': 'sum', f'CHIEN_{year}': 'sum'})
+
+        return grouped_data
+
+    def assemble(self, list_grouped):
+        """
+        Build the wide table from per-year sums.
+
+        Parameters:
+        - list_grouped (list of DataFrames): Outputs of sum_year, one per year.
+
+        Returns:
+        - GeoDataFrame: Communes with the 'CHAT_<year>' and 'CHIEN_<year>' columns of every year.
+        """
         data_join = self.geojson.copy()
-        
-        for i, df in enumerate(list_df):    
-            gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['LON'], df['LAT']), crs='EPSG:4326')
-            gdf = gdf.rename(columns={'CHAT': f'CHAT_{list_year[i]}', 'CHIEN': f'CHIEN_{list_year[i]}'})
-            data_join['geometry'] = data_join.geometry
-            joined_data = gpd.sjoin(data_join, gdf, how='left', op='contains')
-
-            grouped_data = joined_data.groupby('insee_com', as_index=False).agg({f'CHAT_{list_year[i]}': 'sum', f'CHIEN_{list_year[i]}': 'sum',
-                                                                                 'insee_com':'first'})
-            
+
+        for grouped_data in list_grouped:
             data_join = data_join.merge(grouped_data, how='left', on='insee_com')
-            
+
         return data_join
 
+class DataCaching():
+    """
+    Class for caching the per-year sums by commune.
+
+    A cached year is keyed by the hash of its input file and the hash of the
+    reference GeoJSON, so a year is only recomputed when one of them changes.
+    """
+    def __init__(self, cache_source):
+        """
+        Initialize the DataCaching class.
+
+        Parameters:
+        - cache_source (str): Path to the directory holding the cached years.
+        """
+        self.cache_source = cache_source
+
+    @staticmethod
+    def file_hash(path):
+        """
+        Compute the SHA-256 hash of a file, reading it by blocks.
+
+        Parameters:
+        - path (str): Path to the file.
+
+        Returns:
+        - str: Hexadecimal digest of the file content.
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def cache_path(self, year, key):
+        """
+        Path of the cached sums of a year for a given key.
+
+        Parameters:
+        - year (int): Year of the data.
+        - key (str): Combined hash of the input and reference files.
+
+        Returns:
+        - str: Path to the cached CSV file.
+        """
+        return os.path.join(self.cache_source, f"{year}-{key}.csv")
+
+    def get(self, year, key):
+        """
+        Load the cached sums of a year if its key matches.
+
+        Parameters:
+        - year (int): Year of the data.
+        - key (str): Combined hash of the input and reference files.
+
+        Returns:
+        - DataFrame or None: Cached sums, or None on a cache miss.
+        """
+        path = self.cache_path(year, key)
+        if os.path.isfile(path):
+            return pd.read_csv(path, header=0, sep=';', dtype=read_dtypes())
+        return None
+
+    def put(self, year, key, grouped_data):
+        """
+        Store the sums of a year, replacing any previous entry of that year.
+
+        Parameters:
+        - year (int): Year of the data.
+        - key (str): Combined hash of the input and reference files.
+        - grouped_data (DataFrame): Sums of the year by 'insee_com'.
+
+        Returns:
+        - None
+        """
+        if not os.path.exists(self.cache_source):
+            os.mkdir(self.cache_source)
+
+        for name in os.listdir(self.cache_source):
+            if name.startswith(f"{year}-"):
+                os.remove(os.path.join(self.cache_source, name))
+
+        grouped_data.to_csv(self.cache_path(year, key), sep=';', index=False)
+
 class DataExporting():
     """
     Class for exporting data to different formats.
@@ -99,13 +261,20 @@ class DataExporting():
         """
         self.final_data = final_data
 
-    def export_csv(self):
+    def export_store(self):
+        """
+        Export data to the "geocoding" stage of the intermediate store.
+
+        Returns:
+        - None
         """
-        Export data to CSV format.
+        DataStore().write(self.final_data, 'geocoding')
 
-        Creates a result directory if it doesn't exist and appends to an existing Excel file.
+    def export_xlsx(self):
+        """
+        Export data to an Excel report.
 
-        If the Excel file doesn't exist, it creates a new one.
+        Creates a result directory if it doesn't exist and overwrites the previous report.
 
         Returns:
         - None
@@ -113,12 +282,8 @@ class DataExporting():
         if not os.path.exists('./result/'):
             os.mkdir('./result/')
 
-        if os.path.isfile(f'./result/data_join.xlsx'):
-            with pd.ExcelWriter(f'./result/data_join.xlsx', engine='openpyxl', mode="a") as writer:
-                self.final_data.to_excel(writer, header=True, index=True)
-        else:
-            with pd.ExcelWriter(f'./result/data_join.xlsx', engine='openpyxl', mode="w") as writer:
-                self.final_data.to_excel(writer, header=True, index=True)
+        with pd.ExcelWriter(f'./result/data_join.xlsx', engine='openpyxl', mode="w") as writer:
+            self.final_data.to_excel(writer, header=True, index=True)
 
 class DataPipeline(DataLoading, DataProcessing, DataExporting):
     """
@@ -127,27 +292,63 @@ class DataPipeline(DataLoading, DataProcessing, DataExporting):
     def __init__(self):
         super().__init__(data_source, geojson_source)
 
-    def run_process(self, list_df, list_year, data_load):
+    def run_process(self, list_year, data_load, cache_source='./cache/', report=False):
         """
         Run the entire data processing pipeline.
 
+        Only the years whose input file or reference GeoJSON changed since the
+        last run are joined again, the other years are read from the cache.
+
         Parameters:
-        - list_df (list of DataFrames): List of DataFrames to be used in the pipeline.
-        - list_year (list): List of corresponding years for labeling columns.
+        - list_year (list): List of years to join.
         - data_load (DataLoading): DataLoading object for loading data.
+        - cache_source (str): Path to the directory holding the cached years.
+        - report (bool): Also export the data to an Excel report.
 
         Returns:
         - None
         """
-        geojson = data_load.loading_from_geojson()
-        
-        data_process = DataProcessing(geojson)
-        print(f"=========== JOIN DATA FOR ALL YEARS ===========")
-        data_join = data_process.sum_with_geojson(list_df, list_year)        
-        
-        data_export = DataExporting(data_join)
-        print(f"=========== EXPORT DATA ===========")
-        data_export.export_csv()
+        with METRICS.stage('geocoding') as metrics:
+            geojson = data_load.loading_from_geojson()
+            
+            data_process = DataProcessing(geojson)
+            data_cache = DataCaching(cache_source)
+            geojson_hash = data_cache.file_hash(data_load.geojson_source)
+
+            list_grouped = []
+            for year in list_year:
+                with METRICS.stage('geocoding', year) as year_metrics:
+                    key = hashlib.sha256((data_cache.file_hash(data_load.year_source(year)) + geojson_hash).encode()).hexdigest()[:16]
+                    grouped_data = data_cache.get(year, key)
+
+                    if grouped_data is None:
+                        print(f"=========== JOIN DATA FOR {year} ===========")
+                        data_year = data_load.loading_year(year)
+                        year_metrics.rows_in = len(data_year)
+                        grouped_data = data_process.sum_year(data_year, year)
+                        data_cache.put(year, key, grouped_data)
+                        year_metrics.count('cache_misses')
+                    else:
+                        print(f"=========== CACHED DATA FOR {year} ===========")
+                        year_metrics.count('cache_hits')
+
+                    year_metrics.rows_out = len(grouped_data)
+
+                metrics.count('rows_in', year_metrics.rows_in)
+                metrics.count('cache_hits', year_metrics.cache_hits)
+                metrics.count('cache_misses', year_metrics.cache_misses)
+                metrics.match(year_metrics.matched, year_metrics.match_attempts)
+                list_grouped.append(grouped_data)
+
+            print(f"=========== ASSEMBLE DATA FOR ALL YEARS ===========")
+            data_join = data_process.assemble(list_grouped)
+            metrics.rows_out = len(data_join)
+            
+            data_export = DataExporting(data_join)
+            print(f"=========== EXPORT DATA ===========")
+            data_export.export_store()
+            if report:
+                data_export.export_xlsx()
 
     def pipeline_running(self, data_source, geojson_source):
         """
@@ -161,14 +362,13 @@ class DataPipeline(DataLoading, DataProcessing, DataExporting):
         - None
         """
         data_load = DataLoading(data_source, geojson_source)
-        df2017, df2018, df2019, df2020 = data_load.loading_from_xlsx()
-        df_list = [df2017, df2018, df2019, df2020]
-        years = [2017, 2018, 2019, 2020]
+        years = data_load.list_years()
         
         start = time.time()
-        DataPipeline().run_process(df_list, years, data_load)
+        DataPipeline().run_process(years, data_load)
         end = time.time()
         print('{:.4f} s'.format(end - start))
+        METRICS.export('datageocoding')
 
 if __name__ == "__main__":
     data_source = "./data/"
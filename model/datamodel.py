@@ -0,0 +1,392 @@
+import geopandas as gpd
+import itertools
+import numpy as np
+import pandas as pd
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datacommon.datastore import DataStore
+from datacommon.datametrics import METRICS
+from datavariable import DataLoading as VariableLoading, DataProcessing as VariableProcessing
+
+# Pénalités testées, en unités des variables standardisées (0 pour les moindres carrés)
+LAMBDAS = np.concatenate([[0.0], np.logspace(-2, 4, 25)])
+
+class RidgeModel():
+    """
+    Class fitting ridge regressions of several targets at once through one SVD.
+
+    The covariates are standardized and the targets centered, so that the
+    intercept is not penalized. With X = U S Vᵀ, the fit for a penalty λ only
+    rescales UᵀY by s²/(s²+λ): every target and every penalty of a sweep
+    come from the same decomposition, and the diagonal of the hat matrix
+    gives the leave-one-out and k-fold errors without refitting.
+    """
+
+    def __init__(self, X, Y):
+        """
+        Initializes the RidgeModel instance.
+
+        Args:
+            X (array-like): Covariates, one row per commune.
+            Y (array-like): Targets, one column per target.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64).reshape(len(X), -1)
+
+        self.n = len(X)
+        self.x_mean = X.mean(axis=0)
+        self.x_scale = X.std(axis=0)
+        self.x_scale[self.x_scale == 0] = 1.0
+        self.y_mean = Y.mean(axis=0)
+        self.Y = Y - self.y_mean
+
+        U, s, Vt = np.linalg.svd((X - self.x_mean) / self.x_scale, full_matrices=False)
+        # Les directions de valeur singulière nulle (variables colinéaires) sont ignorées
+        rank = s > s[0] * 1e-10 if s.size else s > 0
+        self.U, self.s, self.Vt = U[:, rank], s[rank], Vt[rank]
+        self.UtY = self.U.T @ self.Y
+        self.U2t = (self.U ** 2).T
+
+    def shrinkage(self, lambdas):
+        """
+        Shrinkage factor s²/(s²+λ) of every singular direction.
+
+        Args:
+            lambdas (array-like): Penalties.
+
+        Returns:
+            ndarray: One row per penalty, one column per direction.
+        """
+        s2 = self.s ** 2
+        return s2 / (s2 + np.asarray(lambdas, dtype=np.float64)[:, None])
+
+    def coefficients(self, lam=0.0):
+        """
+        Coefficients of every target, in the units of the covariates.
+
+        Args:
+            lam (float): Penalty.
+
+        Returns:
+            tuple: Coefficients (covariates × targets) and intercepts (targets).
+        """
+        beta = self.Vt.T @ ((self.s / (self.s ** 2 + lam))[:, None] * self.UtY) / self.x_scale[:, None]
+        return beta, self.y_mean - self.x_mean @ beta
+
+    def residuals(self, lambdas):
+        """
+        In-sample residuals of every penalty and target.
+
+        Args:
+            lambdas (array-like): Penalties.
+
+        Returns:
+            ndarray: Residuals of shape (penalties, targets, rows).
+        """
+        return self.Y.T - (self.shrinkage(lambdas)[:, None, :] * self.UtY.T) @ self.U.T
+
+    def leverage(self, lambdas):
+        """
+        Diagonal of the hat matrix of every penalty, intercept included.
+
+        Args:
+            lambdas (array-like): Penalties.
+
+        Returns:
+            ndarray: Leverages of shape (penalties, rows).
+        """
+        return self.shrinkage(lambdas) @ self.U2t + 1.0 / self.n
+
+    def loo(self, lambdas=LAMBDAS):
+        """
+        Leave-one-out and generalized cross-validation errors, in closed form.
+
+        The leave-one-out residual of a row is its residual divided by
+        1 - h, h being its leverage. The residual sum of squares of the GCV
+        only needs UᵀY: ‖e‖² = ‖Y‖² - Σ (2d - d²)(UᵀY)².
+
+        Args:
+            lambdas (array-like): Penalties.
+
+        Returns:
+            tuple: LOO and GCV mean squared errors, each of shape (penalties, targets).
+        """
+        shrinkage = self.shrinkage(lambdas)
+        residuals = self.residuals(lambdas)
+        residuals /= (1.0 - self.leverage(lambdas))[:, None, :]
+        loo_mse = np.square(residuals, out=residuals).mean(axis=2)
+
+        rss = np.sum(self.Y ** 2, axis=0) - (2 * shrinkage - shrinkage ** 2) @ self.UtY ** 2
+        degrees = shrinkage.sum(axis=1) + 1.0
+        gcv_mse = rss / self.n / ((1.0 - degrees / self.n) ** 2)[:, None]
+        return loo_mse, gcv_mse
+
+    def kfold(self, folds, lambdas=LAMBDAS):
+        """
+        K-fold cross-validation error, in closed form.
+
+        The residuals of a held-out fold F are (I - H_FF)⁻¹ e_F. H_FF has the
+        rank of the design plus one, so the inverse is applied through the
+        Woodbury identity on a matrix of that size instead of the fold size.
+
+        Args:
+            folds (array-like): Fold of every row.
+            lambdas (array-like): Penalties.
+
+        Returns:
+            ndarray: Mean squared errors of shape (penalties, targets).
+        """
+        folds = np.asarray(folds)
+        residuals = self.residuals(lambdas)
+        shrinkage = self.shrinkage(lambdas)
+        squared = np.zeros((len(shrinkage), self.Y.shape[1]))
+
+        for fold in np.unique(folds):
+            rows = folds == fold
+            for index, factors in enumerate(shrinkage):
+                # H_FF = A Aᵀ avec A = [U_F √d, 1/√n]
+                A = np.hstack([self.U[rows] * np.sqrt(factors), np.full((rows.sum(), 1), 1.0 / np.sqrt(self.n))])
+                e = residuals[index][:, rows].T
+                inner = np.linalg.solve(np.eye(A.shape[1]) - A.T @ A, A.T @ e)
+                squared[index] += np.sum((e + A @ inner) ** 2, axis=0)
+
+        return squared / self.n
+
+class DataLoading(VariableLoading):
+    """
+    Class loading the targets and the covariates of the model.
+    """
+
+    def __init__(self, data_source, variable_source=None, cache_source=None):
+        """
+        Initializes the DataLoading instance.
+
+        Args:
+            data_source (str): GeoJSON of the communes with the counts, used when the store has no 'geocoding' stage.
+            variable_source (str): Directory of the covariate workbooks, the default of datavariable if None.
+            cache_source (str): Directory of the cached workbooks, the default of datavariable if None.
+        """
+        defaults = VariableLoading()
+        super().__init__(variable_source or defaults.variable_source, cache_source or defaults.cache_source)
+        self.data_source = data_source
+
+    def loading_targets(self):
+        """
+        Load the number of cats and dogs by commune.
+
+        Returns:
+            DataFrame: 'CHAT_<year>' and 'CHIEN_<year>' columns indexed by the INSEE code.
+        """
+        store = DataStore()
+        if store.exists('geocoding'):
+            data = store.read('geocoding')
+        else:
+            data = gpd.read_file(self.data_source)
+        return pd.DataFrame(data.drop(columns='geometry', errors='ignore')).set_index('insee_com')
+
+class DataProcessing():
+    """
+    Class fitting the model and selecting its covariates.
+    """
+
+    def __init__(self, design, targets):
+        """
+        Initializes the DataProcessing instance.
+
+        Args:
+            design (pd.DataFrame): Covariates, one row per commune.
+            targets (pd.DataFrame): Targets, aligned with design.
+        """
+        self.design = design
+        self.targets = targets
+
+    @staticmethod
+    def join(variables, counts, targets):
+        """
+        Join the covariates and the targets on the INSEE code.
+
+        Communes without any declared animal, or with a missing covariate,
+        are left out.
+
+        Args:
+            variables (pd.DataFrame): Covariates indexed by 'codgeo'.
+            counts (pd.DataFrame): Counts indexed by the INSEE code.
+            targets (list): Columns of counts to model.
+
+        Returns:
+            tuple: Covariates and targets, on the same rows.
+        """
+        data = variables.join(counts[targets], how='inner').dropna()
+        data = data[(data[targets] != 0).any(axis=1)]
+        return data[variables.columns], data[targets]
+
+    def folds(self, k=10, seed=0):
+        """
+        Random assignment of the rows to k folds.
+
+        Args:
+            k (int): Number of folds.
+            seed (int): Seed of the random generator.
+
+        Returns:
+            ndarray: Fold of every row.
+        """
+        return np.random.default_rng(seed).permutation(len(self.design)) % k
+
+    def sweep(self, lambdas=LAMBDAS, folds=None):
+        """
+        Cross-validation errors of every penalty, for every target.
+
+        Args:
+            lambdas (array-like): Penalties.
+            folds (array-like): Fold of every row, no k-fold error if None.
+
+        Returns:
+            pd.DataFrame: One row per penalty and target, with the LOO, GCV and k-fold errors and the LOO R².
+        """
+        model = RidgeModel(self.design, self.targets)
+        loo_mse, gcv_mse = model.loo(lambdas)
+        errors = {'loo_mse': loo_mse, 'gcv_mse': gcv_mse}
+        if folds is not None:
+            errors['kfold_mse'] = model.kfold(folds, lambdas)
+
+        variance = self.targets.var(ddof=0).to_numpy()
+        rows = []
+        for index, lam in enumerate(lambdas):
+            for column, target in enumerate(self.targets.columns):
+                row = {'target': target, 'lambda': lam}
+                row.update({name: error[index, column] for name, error in errors.items()})
+                row['loo_r2'] = 1.0 - loo_mse[index, column] / variance[column]
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+    def coefficients(self, best):
+        """
+        Coefficients of every target, fitted with its own penalty.
+
+        Args:
+            best (pd.DataFrame): 'target' and 'lambda' of the retained fits.
+
+        Returns:
+            pd.DataFrame: One column per target, one row per covariate plus 'intercept'.
+        """
+        model = RidgeModel(self.design, self.targets)
+        columns = {}
+        for column, target in enumerate(self.targets.columns):
+            lam = best.loc[best['target'] == target, 'lambda'].iloc[0]
+            beta, intercept = model.coefficients(lam)
+            columns[target] = np.append(beta[:, column], intercept[column])
+        return pd.DataFrame(columns, index=list(self.design.columns) + ['intercept'])
+
+    def select_subsets(self, max_size=None, lambdas=LAMBDAS):
+        """
+        Leave-one-out error of every subset of covariates, with the best penalty of each target.
+
+        One SVD per subset serves every target and every penalty.
+
+        Args:
+            max_size (int): Largest subset, all the covariates if None.
+            lambdas (array-like): Penalties.
+
+        Returns:
+            pd.DataFrame: One row per subset and target, sorted by error.
+        """
+        covariates = list(self.design.columns)
+        variance = self.targets.var(ddof=0).to_numpy()
+        rows = []
+        for size in range(1, (max_size or len(covariates)) + 1):
+            for subset in itertools.combinations(covariates, size):
+                loo_mse, _ = RidgeModel(self.design[list(subset)], self.targets).loo(lambdas)
+                best = loo_mse.argmin(axis=0)
+                for column, target in enumerate(self.targets.columns):
+                    rows.append({'target': target, 'variables': '+'.join(subset), 'size': size,
+                                 'lambda': lambdas[best[column]], 'loo_mse': loo_mse[best[column], column],
+                                 'loo_r2': 1.0 - loo_mse[best[column], column] / variance[column]})
+
+        return pd.DataFrame(rows).sort_values(['target', 'loo_mse'], ignore_index=True)
+
+class DataExporting():
+    """
+    Class exporting the results of the model.
+    """
+
+    def __init__(self, output_source):
+        """
+        Initializes the DataExporting instance.
+
+        Args:
+            output_source (str): Directory of the results.
+        """
+        self.output_source = output_source
+
+    def export_csv(self, data, name, index=False):
+        """
+        Export a result as a CSV file.
+
+        Args:
+            data (pd.DataFrame): Result to export.
+            name (str): Name of the file without extension.
+            index (bool): Write the index.
+        """
+        os.makedirs(self.output_source, exist_ok=True)
+        data.to_csv(os.path.join(self.output_source, f'{name}.csv'), sep=';', index=index)
+
+class DataPipeline(DataLoading, DataProcessing, DataExporting):
+    """
+    Class defining the model pipeline.
+    """
+
+    def __init__(self):
+        super().__init__(data_source)
+
+    def pipeline_running(self, data_source, output_source, year=2020, variable_year=2020, k=10, max_size=None):
+        """
+        Fit the model of the cats and dogs of a year on the covariates of the Insee.
+
+        Args:
+            data_source (str): GeoJSON of the communes with the counts.
+            output_source (str): Directory of the results.
+            year (int): Year of the counts.
+            variable_year (int): Year of the covariates.
+            k (int): Number of folds of the k-fold error.
+            max_size (int): Largest subset of covariates, all if None.
+        """
+        with METRICS.stage('model', year) as metrics:
+            data_load = DataLoading(data_source)
+            print("=========== LOADING DATA ===========")
+            variables = VariableProcessing(data_load.loading_variables(years=[variable_year])).design_matrix()
+            counts = data_load.loading_targets()
+
+            design, targets = DataProcessing.join(variables, counts, [f'CHAT_{year}', f'CHIEN_{year}'])
+            metrics.rows_in = len(design)
+            data_process = DataProcessing(design, targets)
+
+            print("=========== REGULARIZATION SWEEP ===========")
+            sweep = data_process.sweep(LAMBDAS, data_process.folds(k))
+            best = sweep.loc[sweep.groupby('target')['loo_mse'].idxmin()]
+            print(best)
+
+            print("=========== SUBSET SELECTION ===========")
+            subsets = data_process.select_subsets(max_size)
+            metrics.rows_out = len(subsets)
+
+            print("=========== EXPORT RESULTS ===========")
+            data_export = DataExporting(output_source)
+            data_export.export_csv(sweep, 'sweep')
+            data_export.export_csv(data_process.coefficients(best), 'coefficients', index=True)
+            data_export.export_csv(subsets, 'subsets')
+
+        METRICS.export('datamodel')
+
+if __name__ == "__main__":
+    data_source = "../calculdensite/data/data_join.geojson"
+    output_source = "./result/"
+
+    start = time.time()
+    pipeline = DataPipeline()
+    pipeline.pipeline_running(data_source, output_source)
+    end = time.time()
+    print('{:.4f} s'.format(end - start))
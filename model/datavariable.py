@@ -0,0 +1,202 @@
+import pandas as pd
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Dossier du modèle, les chemins par défaut ne dépendent pas du répertoire courant
+MODEL_SOURCE = os.path.dirname(os.path.abspath(__file__))
+VARIABLE_SOURCE = os.path.join(MODEL_SOURCE, 'data_variable')
+CACHE_SOURCE = os.path.join(MODEL_SOURCE, 'cache')
+
+# Valeur manquante des exports de l'Insee
+MISSING_VALUE = 'N/A - résultat non disponible'
+
+# Colonnes d'identification des classeurs de l'Insee, les autres sont les variables
+KEYS = ['codgeo', 'libgeo', 'an']
+
+def cache_path(path, cache_source):
+    """
+    Path of the cached copy of a workbook, keyed by its modification time.
+
+    Args:
+        path (str): Path to the workbook.
+        cache_source (str): Directory of the cached copies.
+
+    Returns:
+        str: Path to the Parquet file.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_source, f'{name}-{os.stat(path).st_mtime_ns}.parquet')
+
+def read_cached(path, cache_source, header=4, years=None):
+    """
+    Read a workbook from its cached copy, parsing the Excel file only when it changed.
+
+    Top-level function so that it can be sent to the worker processes.
+    Codes are read as strings so that their leading zeros are kept, and the
+    "not available" values of the Insee become missing values. The copies of
+    older versions of the workbook are removed.
+
+    Args:
+        path (str): Path to the workbook.
+        cache_source (str): Directory of the cached copies.
+        header (int): Row of the column names.
+        years (list): Years to keep from the 'an' column, all if None.
+
+    Returns:
+        pd.DataFrame: Content of the workbook.
+    """
+    cached = cache_path(path, cache_source)
+    filters = [('an', 'in', list(years))] if years is not None else None
+
+    if os.path.isfile(cached):
+        return pd.read_parquet(cached, filters=filters)
+
+    data = pd.read_excel(path, header=header, dtype={'codgeo': str})
+    values = data.columns.difference(KEYS)
+    data[values] = data[values].replace(MISSING_VALUE, None).apply(pd.to_numeric, errors='coerce')
+
+    os.makedirs(cache_source, exist_ok=True)
+    name = os.path.splitext(os.path.basename(path))[0]
+    for old in glob.glob(os.path.join(cache_source, f'{name}-*.parquet')):
+        os.remove(old)
+    temporary_path = f'{cached}.tmp'
+    data.to_parquet(temporary_path, index=False)
+    os.replace(temporary_path, cached)
+
+    if years is not None and 'an' in data:
+        data = data[data['an'].isin(years)].reset_index(drop=True)
+    return data
+
+class DataLoading():
+    """
+    Class loading the Insee covariates of the model.
+
+    Every workbook is parsed once and cached as a Parquet file next to the
+    model; the workbooks that are new or were modified are parsed in parallel
+    worker processes, the others are read back from the cache.
+    """
+
+    def __init__(self, variable_source=VARIABLE_SOURCE, cache_source=CACHE_SOURCE, max_workers=None):
+        """
+        Initializes the DataLoading instance.
+
+        Args:
+            variable_source (str): Directory of the covariate workbooks.
+            cache_source (str): Directory of the cached copies.
+            max_workers (int): Number of worker processes, one per CPU if None.
+        """
+        self.variable_source = variable_source
+        self.cache_source = cache_source
+        self.max_workers = max_workers
+
+    def loading_variables(self, years=None, names=None):
+        """
+        Load the covariate workbooks.
+
+        Args:
+            years (list): Years to keep, all if None.
+            names (list): Names of the workbooks without extension, all if None.
+
+        Returns:
+            dict: DataFrame of every workbook, by name.
+        """
+        paths = sorted(glob.glob(os.path.join(self.variable_source, '*.xlsx')))
+        paths = {os.path.splitext(os.path.basename(path))[0]: path for path in paths}
+        if names is not None:
+            paths = {name: paths[name] for name in names}
+
+        stale = {name: path for name, path in paths.items() if not os.path.isfile(cache_path(path, self.cache_source))}
+        variables = {name: read_cached(path, self.cache_source, years=years) for name, path in paths.items() if name not in stale}
+
+        if len(stale) > 1:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                results = executor.map(read_cached, stale.values(), [self.cache_source] * len(stale),
+                                       [4] * len(stale), [years] * len(stale))
+                variables.update(zip(stale.keys(), results))
+        else:
+            variables.update({name: read_cached(path, self.cache_source, years=years) for name, path in stale.items()})
+
+        return {name: variables[name] for name in paths}
+
+    def loading_counts(self, count_source=os.path.join(MODEL_SOURCE, 'data.xlsx')):
+        """
+        Load the number of cats and dogs by commune and year, from the cache as well.
+
+        Args:
+            count_source (str): Path to the workbook of the counts.
+
+        Returns:
+            pd.DataFrame: 'CHAT_<year>' and 'CHIEN_<year>' columns indexed by 'nom_comm'.
+        """
+        return read_cached(count_source, self.cache_source, header=0).set_index('nom_comm')
+
+class DataProcessing():
+    """
+    Class building the design matrix of the model from the covariates.
+    """
+
+    def __init__(self, variables):
+        """
+        Initializes the DataProcessing instance.
+
+        Args:
+            variables (dict): DataFrame of every workbook, by name.
+        """
+        self.variables = variables
+
+    def design_matrix(self, exclude=()):
+        """
+        Join every covariate on the commune code in a single keyed concat.
+
+        Example:
+            variables = DataLoading().loading_variables(years=[2020])
+            design = DataProcessing(variables).design_matrix()
+
+        Args:
+            exclude (iterable): Names of the workbooks to leave out.
+
+        Returns:
+            pd.DataFrame: One column per covariate, indexed by 'codgeo' (and 'an' when several years are loaded).
+        """
+        columns = []
+        for name, data in self.variables.items():
+            if name in exclude:
+                continue
+            keys = ['codgeo', 'an'] if data['an'].nunique() > 1 else ['codgeo']
+            values = data.columns.difference(KEYS)
+            columns.append(data.set_index(keys)[values])
+
+        return pd.concat(columns, axis=1, join='outer').sort_index()
+
+class DataPipeline(DataLoading, DataProcessing):
+    """
+    Class defining the loading pipeline of the covariates.
+    """
+
+    def __init__(self):
+        super().__init__(VARIABLE_SOURCE, CACHE_SOURCE)
+
+    def pipeline_running(self, years=(2020,)):
+        """
+        Load the covariates of the given years and build the design matrix.
+
+        Args:
+            years (iterable): Years to keep.
+
+        Returns:
+            pd.DataFrame: Design matrix of the model.
+        """
+        print("=========== LOADING VARIABLES ===========")
+        variables = self.loading_variables(years=list(years))
+        print("=========== DESIGN MATRIX ===========")
+        return DataProcessing(variables).design_matrix()
+
+if __name__ == "__main__":
+    start = time.time()
+    pipeline = DataPipeline()
+    design = pipeline.pipeline_running()
+    print(design.describe())
+    end = time.time()
+    print('{:.4f} s'.format(end - start))
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# Les étapes sont des scripts lancés depuis leur répertoire, sans paquet
+ROOT_SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ['', 'datacleaning', 'datacleaning2', 'datacorrection', 'calculdensite']:
+    sys.path.insert(0, os.path.join(ROOT_SOURCE, directory))
+
+from datacommon.datastore import DataStore
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """
+    Empty intermediate store, used by every DataStore() built during the test.
+    """
+    monkeypatch.setattr(DataStore.__init__, '__defaults__', (str(tmp_path / 'store'),))
+    return DataStore()
@@ -0,0 +1,39 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from calculdensite import DataProcessing, DataExporting
+
+def communes():
+    return gpd.GeoDataFrame({
+        'insee_com': ['01001', '01002', '01004'],
+        'CHAT_2019': pd.array([10, pd.NA, 30], dtype='UInt32'),
+        'CHIEN_2019': pd.array([5, 6, 7], dtype='UInt32'),
+    }, geometry=[shapely.box(5.0, 46.0, 5.1, 46.1), shapely.box(5.1, 46.0, 5.2, 46.1), None], crs='EPSG:4326')
+
+def test_density_with_missing_counts_and_geometries(tmp_path):
+    result = DataProcessing(communes(), str(tmp_path / 'area.csv')).calculate_density()
+
+    assert result['SURFACE_KM2'].notna().tolist() == [True, True, False]
+    assert np.isnan(result.loc[1, 'CHAT_2019_DENSITE'])
+    assert result.loc[1, 'CHIEN_2019_DENSITE'] == 6 / result.loc[1, 'SURFACE_KM2']
+    assert np.isnan(result.loc[2, 'CHIEN_2019_DENSITE'])
+
+def test_area_cache_keeps_current_geometries(tmp_path):
+    cache_source = str(tmp_path / 'area.csv')
+    DataProcessing(communes(), cache_source).calculate_area()
+    DataProcessing(communes().iloc[:1], cache_source).calculate_area()
+
+    assert len(pd.read_csv(cache_source)) == 1
+
+def test_flatgeobuf_writes_every_list_as_text(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = communes().iloc[:2]
+    data['COORDONNEES'] = pd.Series([None, np.array([5.15, 46.05])], dtype=object)
+    DataExporting(data).export_flatgeobuf('communes.fgb')
+
+    # L'index spatial réordonne les entités
+    written = gpd.read_file('communes.fgb').set_index('insee_com').sort_index()
+    assert written['COORDONNEES'].tolist() == [None, '[5.15, 46.05]']
+    assert written['CHAT_2019'].isna().tolist() == [False, True]
@@ -0,0 +1,33 @@
+import pandas as pd
+
+from datacleaning import DataExporting
+from datagrouping import DataLoading, DataProcessing
+
+def cleaned_year():
+    # Sortie de DataPipeline.geocoding : coordonnées en listes, un échec sans coordonnées
+    return pd.DataFrame({
+        'ESPECE': pd.Categorical(['CHAT', 'CHIEN', 'CHAT', 'CHIEN'], categories=['CHAT', 'CHIEN']),
+        'CODE POSTAL': ['01400', '01400', '75001', '13001'],
+        'VILLE': ['Châtillon-sur-Chalaronne', 'Châtillon-sur-Chalaronne', 'Paris', 'Marseille'],
+        'POPULATION': [12, 3, 40, 7],
+        'VILLE_2': ['CHATILLON SUR CHALARONNE', 'CHATILLON SUR CHALARONNE', 'PARIS', 'MARSEILLE'],
+        'COORDONNEES': [[4.957, 46.118], [4.957, 46.118], [2.347, 48.859], [-0.5, 43.3]],
+    })
+
+def test_coordinates_are_stored_as_text(store):
+    DataExporting().export_store(cleaned_year(), 2019)
+
+    stored = store.read('cleaning', 2019)
+    assert stored['COORDONNEES'].tolist() == ['[4.957, 46.118]', '[4.957, 46.118]', '[2.347, 48.859]', '[-0.5, 43.3]']
+
+def test_cleaning_to_grouping_round_trip(store):
+    DataExporting().export_store(cleaned_year(), 2019)
+
+    chunks = list(DataLoading('./data/', None).loading_year(2019))
+    data = pd.concat(chunks, ignore_index=True)
+    process = DataProcessing(data, None)
+    grouped = process.group(process.verify_corres(data)[0]).set_index('VILLE')
+
+    assert grouped.loc['Châtillon-sur-Chalaronne', ['CHAT', 'CHIEN']].tolist() == [12, 3]
+    assert grouped['LON'].tolist() == ['4.957', '-0.5', '2.347']
+    assert grouped['LAT'].tolist() == ['46.118', '43.3', '48.859']
@@ -0,0 +1,124 @@
+import types
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+
+from datacommon.dataschema import apply_schema
+import datacleaning2
+import datagrouping
+
+NAMES = ['Bourg-en-Bresse', 'Oyonnax', 'Ambérieu-en-Bugey', 'Belley', 'Gex', 'Laon', 'Saint-Quentin', 'Soissons',
+         'Moulins', 'Vichy', 'Montluçon', 'Digne-les-Bains', 'Manosque', 'Gap', 'Briançon', 'Nice', 'Antibes',
+         'Cannes', 'Grasse', 'Privas', 'Aubenas', 'Charleville-Mézières', 'Sedan', 'Foix', 'Pamiers', 'Troyes',
+         'Carcassonne', 'Narbonne', 'Rodez', 'Millau', 'Marseille', 'Aix-en-Provence', 'Arles', 'Caen', 'Bayeux']
+
+@pytest.fixture
+def communes():
+    rng = np.random.default_rng(1)
+    lon, lat = rng.uniform(-1, 7, len(NAMES)), rng.uniform(43, 50, len(NAMES))
+    return gpd.GeoDataFrame({
+        'insee_com': [f'{number:02d}{number * 7:03d}' for number in range(1, len(NAMES) + 1)],
+        'nom_comm': NAMES,
+        'postal_code': [f'{number:02d}{number * 3:03d}' for number in range(1, len(NAMES) + 1)],
+        'geo_point_2d': [{'lon': x, 'lat': y} for x, y in zip(lon, lat)],
+    }, geometry=gpd.points_from_xy(lon, lat), crs='EPSG:4326')
+
+@pytest.fixture
+def pipelines(monkeypatch, communes):
+    # Ni service résident, ni fichier des communes : le GeoJSON est donné en mémoire
+    for module in (datacleaning2, datagrouping):
+        monkeypatch.setattr(module, 'service_client', lambda: None)
+    return types.SimpleNamespace(loading_from_geojson=lambda: communes.copy())
+
+def deliveries(rows, seed):
+    """
+    A delivery and its correction: rows removed, changed, added and duplicated.
+    """
+    rng = np.random.default_rng(seed)
+    first = rows.sample(frac=1, random_state=seed).reset_index(drop=True)
+    second = first.drop(index=rng.choice(len(first), 40, replace=False))
+    changed = rng.choice(second.index, 40, replace=False)
+    second.loc[changed, second.columns[-1]] = second.loc[changed, second.columns[-1]] + 5
+    second = pd.concat([second, rows.sample(60, random_state=seed + 1), second.iloc[:5]], ignore_index=True)
+    return apply_schema(first), apply_schema(second)
+
+def chunks(data):
+    return [data.iloc[start:start + 100] for start in range(0, len(data), 100)]
+
+def compare(delta, full, key):
+    """
+    Same keys, same sums and same dtypes.
+
+    The other columns take the value of the first row of a group, which
+    may be another row after a correction.
+    """
+    assert delta.dtypes.to_dict() == full.dtypes.to_dict()
+    sums = lambda data: data.groupby(key(data).to_numpy())[['CHAT', 'CHIEN']].sum().sort_index()
+    pd.testing.assert_frame_equal(sums(delta), sums(full))
+
+def test_grouping2_delta_equals_full(store, pipelines):
+    rng = np.random.default_rng(2)
+    names = np.array(NAMES + ['Villeinconnue', 'Nowhere'], dtype=object)[rng.integers(0, len(NAMES) + 2, 600)]
+    rows = pd.DataFrame({
+        'Ville': [name.upper() if number % 3 else name.replace('-', ' ') for number, name in enumerate(names)],
+        'Code postal': [f'{number:05d}' for number in rng.integers(1000, 95999, 600)],
+        'Espece': rng.choice(['CHAT', 'CHIEN'], 600),
+        'Population': rng.integers(1, 20, 600),
+    })
+    first, second = deliveries(rows, 3)
+    pipeline = datacleaning2.DataPipeline.__new__(datacleaning2.DataPipeline)
+
+    pipeline.run_process(pipelines, chunks(first), 2019)
+    pipeline.run_process(pipelines, chunks(second), 2019)
+    delta = store.read('grouping2', 2019)
+
+    store.remove('grouping2', 2019)
+    pipeline.run_process(pipelines, chunks(second), 2019, delta=False)
+    compare(delta, store.read('grouping2', 2019), lambda data: data['VILLE_2'])
+
+def test_grouping_delta_equals_full(store, pipelines):
+    rng = np.random.default_rng(4)
+    names = np.array(NAMES, dtype=object)[rng.integers(0, len(NAMES), 600)]
+    geocoded = rng.random(600) < 0.8
+    rows = pd.DataFrame({
+        'ESPECE': rng.choice(['CHAT', 'CHIEN'], 600),
+        'CODE POSTAL': [f'{number:05d}' for number in rng.integers(1000, 95999, 600)],
+        'VILLE': np.where(geocoded, names, 'Ailleurs'),
+        'VILLE_2': [name.upper() if number % 4 else f'{name} CEDEX' for number, name in enumerate(names)],
+        'COORDONNEES': [f'[{x:.3f}, {y:.3f}]' for x, y in zip(rng.uniform(-1, 7, 600), rng.uniform(43, 50, 600))],
+        'POPULATION': rng.integers(1, 20, 600),
+    })
+    first, second = deliveries(rows, 5)
+    pipeline = datagrouping.DataPipeline.__new__(datagrouping.DataPipeline)
+
+    pipeline.run_process(pipelines, chunks(first), 2019)
+    pipeline.run_process(pipelines, chunks(second), 2019)
+    delta = store.read('grouping', 2019)
+
+    for stage in ('grouping', datagrouping.GROUPS, 'grouping-rows'):
+        store.remove(stage, 2019)
+    pipeline.run_process(pipelines, chunks(second), 2019)
+    # Groupes par commune, puis par ville du géocodeur, puis par ville d'origine
+    compare(delta, store.read('grouping', 2019),
+            lambda data: data['VILLE_3'].fillna(data['VILLE'].where(data['VILLE'] != '', data['VILLE_2'])))
+
+def test_grouping_same_delivery_has_no_delta(store, pipelines):
+    rng = np.random.default_rng(6)
+    names = np.array(NAMES, dtype=object)[rng.integers(0, len(NAMES), 300)]
+    rows = apply_schema(pd.DataFrame({
+        'ESPECE': rng.choice(['CHAT', 'CHIEN'], 300),
+        'CODE POSTAL': [f'{number:05d}' for number in rng.integers(1000, 95999, 300)],
+        # Villes du géocodeur trop différentes : vidées par verify_corres
+        'VILLE': np.where(rng.random(300) < 0.7, names, 'Ailleurs'),
+        'VILLE_2': names,
+        'COORDONNEES': [f'[{x:.3f}, {y:.3f}]' for x, y in zip(rng.uniform(-1, 7, 300), rng.uniform(43, 50, 300))],
+        'POPULATION': rng.integers(1, 20, 300),
+    }))
+    pipeline = datagrouping.DataPipeline.__new__(datagrouping.DataPipeline)
+    pipeline.run_process(pipelines, chunks(rows.copy()), 2019)
+
+    data_delta = datagrouping.DataDelta('grouping', datagrouping.VERSION)
+    added, removed, kept = data_delta.diff(rows, data_delta.previous(2019), list(rows.columns))
+    assert (len(added), len(removed), len(kept)) == (0, 0, 300)
@@ -0,0 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from datacommon import datanormalize
+from datacommon.datanormalize import normalize_city
+
+def test_normalize_city():
+    result = normalize_city(pd.Series(['ST-ETIENNE CEDEX 01', 'Bar/Seine (10)', None, 'Œuilly']))
+
+    assert result.tolist()[:2] == ['saint etienne', 'bar sur seine']
+    assert pd.isna(result[2])
+    assert result[3] == 'oeuilly'
+
+def test_memo_shared_by_threads(monkeypatch):
+    # Memo petit : vidé sans cesse pendant que d'autres threads le lisent
+    monkeypatch.setattr(datanormalize, 'MEMO', {})
+    monkeypatch.setattr(datanormalize, 'MEMO_SIZE', 50)
+    batches = [pd.Series([f'Ville {chr(65 + (batch + number) % 26)}{number}' for number in range(40)]) for batch in range(64)]
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(normalize_city, batches))
+
+    for batch, result in zip(batches, results):
+        assert result.tolist() == datanormalize.normalize_values(batch).tolist()
+    assert len(datanormalize.MEMO) <= 50
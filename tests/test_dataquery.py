@@ -0,0 +1,51 @@
+import duckdb
+import numpy as np
+import pandas as pd
+import pytest
+
+from datacommon.dataquery import DataQuery
+from datacommon.dataschema import apply_schema
+import datacleaning2
+import datagrouping
+
+def matched_year(size=3000, seed=0):
+    # Lignes de grouping2 après la correspondance : le code postal brut diffère souvent du code retenu
+    rng = np.random.default_rng(seed)
+    communes = pd.DataFrame({
+        'VILLE_2': [f'COMMUNE {number}' for number in range(400)],
+        'CODE POSTAL': [f'{number:05d}' for number in rng.integers(1000, 95999, 400)],
+        'CODE INSEE': [f'{number:05d}' for number in rng.integers(1000, 95999, 400)],
+        'COORDONNEES': [f'[{lon:.3f}, {lat:.3f}]' for lon, lat in zip(rng.uniform(-4, 8, 400), rng.uniform(42, 51, 400))],
+    })
+    rows = communes.iloc[rng.integers(0, len(communes), size)].reset_index(drop=True)
+    rows.loc[rng.random(size) < 0.1, ['VILLE_2', 'CODE POSTAL', 'CODE INSEE', 'COORDONNEES']] = ''
+    raw = rows['CODE POSTAL'].where(rng.random(size) < 0.5, rows['CODE POSTAL'].str[:2] + ' ' + rows['CODE POSTAL'].str[2:4])
+    return apply_schema(pd.DataFrame({
+        'Ville': rows['VILLE_2'].str.lower(),
+        'Code postal': raw,
+        'Espece': rng.choice(['CHAT', 'CHIEN'], size),
+        'Population': rng.integers(1, 30, size),
+        **rows,
+    }))
+
+@pytest.mark.parametrize('module, data', [
+    (datacleaning2, matched_year),
+    (datagrouping, lambda: matched_year().rename(columns={'VILLE_2': 'VILLE', 'Ville': 'VILLE_2', 'Espece': 'ESPECE',
+                                                          'Population': 'POPULATION'})),
+])
+def test_duckdb_backend_matches_pandas(module, data):
+    process = module.DataProcessing(None, None) if module is datagrouping else module.DataProcessing(None)
+    key = 'VILLE' if module is datagrouping else 'VILLE_2'
+
+    expected = process.group(data(), 'pandas').sort_values(key, ignore_index=True)
+    result = process.group(data(), 'duckdb').sort_values(key, ignore_index=True)
+
+    pd.testing.assert_frame_equal(result[expected.columns], expected)
+    assert (result[['CHAT', 'CHIEN']].dtypes == expected[['CHAT', 'CHIEN']].dtypes).all()
+
+def test_connection_is_closed_with_the_block():
+    with DataQuery() as query:
+        grouped = query.pivot_species(matched_year(100), ['VILLE_2'], 'Espece', 'Population')
+    assert grouped['CHAT'].sum() + grouped['CHIEN'].sum() > 0
+    with pytest.raises(duckdb.ConnectionException):
+        query.connection.execute('SELECT 1')
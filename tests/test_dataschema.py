@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from datacommon.dataschema import STRING, COUNT, apply_schema
+
+def test_apply_schema_casts_known_columns():
+    data = apply_schema(pd.DataFrame({'CODE INSEE': [1400.0, 75056.0], 'CHAT': [1.0, 2.0], 'COORDONNEES': ['[4.9, 46.1]', None]}))
+
+    assert data['CODE INSEE'].tolist() == ['01400', '75056']
+    assert data['CHAT'].dtype == COUNT
+    assert data['COORDONNEES'].dtype == STRING
+
+@pytest.mark.parametrize('coordinates', [[4.92, 46.15], np.array([4.92, 46.15])])
+def test_apply_schema_rejects_arrays(coordinates):
+    # Le texte d'un ndarray serait '[ 4.92 46.15]', sans virgule
+    with pytest.raises(TypeError, match='COORDONNEES'):
+        apply_schema(pd.DataFrame({'COORDONNEES': [coordinates, None]}))
@@ -0,0 +1,32 @@
+import json
+import threading
+import types
+from http.server import ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from dataservice import handler
+
+@pytest.fixture
+def server():
+    service = types.SimpleNamespace(match=lambda payload: {'positions': [-1] * len(payload['cities'])},
+                                    geocode=lambda payload: {'results': []}, health=lambda: {'status': 'ok'})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+@pytest.mark.parametrize('body', [[1], 'cities', 3, None])
+def test_payload_that_is_not_an_object_is_rejected(server, body):
+    response = httpx.post(f'{server}/match', content=json.dumps(body), timeout=5)
+
+    assert response.status_code == 400
+    assert 'JSON object' in response.json()['error']
+
+def test_payload_is_answered(server):
+    response = httpx.post(f'{server}/match', json={'cities': ['Paris', 'Lyon']}, timeout=5)
+
+    assert response.status_code == 200
+    assert response.json() == {'positions': [-1, -1]}
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+from datacommon.datastore import DataStore
+from datatrend import DataPipeline
+
+def joined(seed):
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({'insee_com': [f'{number:05d}' for number in range(1001, 1051)]})
+    for year in (2017, 2018, 2019, 2020):
+        for espece in ('CHAT', 'CHIEN'):
+            data[f'{espece}_{year}'] = pd.array(rng.integers(0, 200, len(data)), dtype='UInt32')
+    data.loc[3, 'CHAT_2018'] = pd.NA
+    return data
+
+def run(store, data, output_file):
+    store.write(data, 'geocoding')
+    DataPipeline(store).pipeline_running(None, str(output_file))
+    return pd.read_csv(output_file, sep=';', dtype={'insee_com': str}).set_index('insee_com')
+
+def test_redelivered_year_replaces_its_counts(store, tmp_path):
+    first = joined(0)
+    run(store, first, tmp_path / 'result' / 'trend.csv')
+
+    # 2019 livrée à nouveau, corrigée
+    second = first.copy()
+    second['CHAT_2019'] = pd.array(np.random.default_rng(1).integers(0, 200, len(second)), dtype='UInt32')
+    result = run(store, second, tmp_path / 'result' / 'trend.csv')
+
+    expected = run(DataStore(str(tmp_path / 'full')), second, tmp_path / 'full' / 'trend.csv')
+
+    pd.testing.assert_frame_equal(result, expected)
+    assert store.years('trend_counts') == [2017, 2018, 2019, 2020]
+
+def test_unchanged_years_are_not_added_again(store, tmp_path):
+    data = joined(0)
+    run(store, data, tmp_path / 'trend.csv')
+    pipeline = DataPipeline(store)
+
+    indexed = data.set_index('insee_com')
+    assert all(pipeline.unchanged(pipeline.year_counts(indexed, year), year) for year in (2017, 2018, 2019, 2020))
@@ -0,0 +1,31 @@
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from densitytiles import DataProcessing
+
+def communes(geometries):
+    return gpd.GeoDataFrame({
+        'insee_com': ['01001', '01002', '01004'],
+        'CHAT_2019_DENSITE': [1.5, 2.0, 0.5],
+    }, geometry=geometries, crs='EPSG:4326')
+
+def test_commune_without_geometry_has_no_tiles():
+    located = [shapely.box(5.0, 46.0, 5.1, 46.1), shapely.box(5.1, 46.0, 5.2, 46.1)]
+    process = DataProcessing(communes(located + [None]), max_zoom=6)
+    index = process.communes_index()
+
+    assert index.loc['01004', 'hash'] == DataProcessing.NO_GEOMETRY
+    assert index.loc['01004', ['minx', 'miny', 'maxx', 'maxy']].isna().all()
+    # Les tuiles sont celles des seules communes localisées
+    expected = DataProcessing(communes(located + [located[0]]), max_zoom=6)
+    assert process.changed_tiles(None, index) == expected.changed_tiles(None, expected.communes_index())
+
+def test_commune_losing_its_geometry_redraws_its_tiles():
+    located = [shapely.box(5.0, 46.0, 5.1, 46.1), shapely.box(5.1, 46.0, 5.2, 46.1), shapely.box(-1.0, 44.0, -0.9, 44.1)]
+    before = DataProcessing(communes(located), max_zoom=6)
+    after = DataProcessing(communes(located[:2] + [None]), max_zoom=6)
+
+    changed = after.changed_tiles(before.communes_index(), after.communes_index())
+    assert changed == before.tiles_of_bounds(before.geojson.geometry.bounds.to_numpy()[2:])
+    assert all(after.render_tile(*tile) is None for tile in changed if tile[0] == 6)